@@ -110,7 +110,7 @@ class Call(DeviceAction):
 
     def generate_duration(self, distribution):
         for i in range(33):
-            duration_minutes = int(distribution.get_value())
+            duration_minutes = int(distribution.get_value(return_array=False))
             duration_seconds = random.randint(0, 59)
             duration = timedelta(minutes=duration_minutes, seconds=duration_seconds)
             try:
@@ -0,0 +1,52 @@
+from sqlalchemy import select, func
+
+
+class IdAllocator:
+    # Reserves blocks of ids per table, so rows get their ids on creation and can be written without flushes.
+    # Shards of parallel simulation take every shards_count-th block, so their ids never intersect.
+    BLOCK_SIZE = 1000
+
+    def __init__(self, session, block_size=BLOCK_SIZE, shard_num=0, shards_count=1, max_ids=None):
+        self.session = session
+        self.block_size = block_size
+        self.shard_num = shard_num
+        self.shards_count = shards_count
+        # Maximal ids of the main base by table names, shards don't have all of its rows
+        self.max_ids = max_ids
+        self.blocks = {}
+        self.next_starts = {}
+
+    def reset(self):
+        # Forgets reserved blocks after the base was changed by someone else
+        self.blocks = {}
+        self.next_starts = {}
+
+    def reserve(self, entity):
+        table = entity.__table__
+        block = self.blocks.get(table)
+        if block is None or block[0] > block[1]:
+            start = self.reserve_block(table)
+            block = self.blocks[table] = [start, start+self.block_size-1]
+        row_id = block[0]
+        block[0] += 1
+        return row_id
+
+    def reserve_block(self, table):
+        if self.session.get_bind().dialect.name == 'postgresql' and self.shards_count == 1:
+            # Mapped rows take ids from the same sequence, so the block is taken from it too
+            sequence_name = self.session.execute(
+                select([func.pg_get_serial_sequence('"%s"' % table.name, 'id')])).scalar()
+            block_end = self.session.execute(
+                select([func.setval(sequence_name, func.nextval(sequence_name)+self.block_size-1)])).scalar()
+            return block_end-self.block_size+1
+
+        if table not in self.next_starts:
+            if self.max_ids is not None:
+                max_id = self.max_ids.get(table.name)
+            else:
+                self.session.flush()
+                max_id = self.session.execute(select([func.max(table.c.id)])).scalar()
+            self.next_starts[table] = (max_id or 0)+1+self.shard_num*self.block_size
+        start = self.next_starts[table]
+        self.next_starts[table] += self.shards_count*self.block_size
+        return start
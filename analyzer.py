@@ -1,22 +1,29 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from itertools import product
+from tempfile import TemporaryDirectory
 from time import time
+import json
+import multiprocessing
+import os
+import pickle
 
 from sqlalchemy import and_, or_, between
-from sqlalchemy.orm.exc import NoResultFound
 
 from entities.customer import *
 from entities.service import *
 from entities.location import *
 from entities.payment import *
+from entities.analysis import *
 
 import numpy as np
-from sklearn.feature_extraction import DictVectorizer
+from scipy import sparse
 from sklearn import preprocessing
-from sklearn.cluster import KMeans, DBSCAN, MiniBatchKMeans, Birch
+from sklearn.cluster import KMeans, MiniBatchKMeans, Birch
 from sklearn.decomposition import PCA
 from sklearn import metrics
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.pyplot as plt
+
+from neighbors import IndexedDBSCAN, neighbors_cache
 
 
 class ClusteringAlgorithm:
@@ -26,193 +33,415 @@ class ClusteringAlgorithm:
 
     def get_estimator(self):
         if self.algorithm == 'K-Means':
-            return KMeans(n_clusters=self.params['clusters'], n_jobs=-1)
+            return KMeans(n_clusters=self.params['clusters'])
         elif self.algorithm == 'DBSCAN':
-            return DBSCAN(eps=self.params['eps'])
+            return IndexedDBSCAN(eps=self.params['eps'])
+        elif self.algorithm == 'BIRCH':
+            return Birch(n_clusters=self.params['clusters'],
+                         threshold=self.params['threshold'], branching_factor=self.params['branching'])
+        else:
+            raise NotImplementedError
+
+    def can_fit_by_chunks(self):
+        return self.algorithm in ('K-Means', 'BIRCH')
+
+    def get_partial_estimator(self):
+        # Estimators which can be fitted chunk by chunk
+        if self.algorithm == 'K-Means':
+            return MiniBatchKMeans(n_clusters=self.params['clusters'])
         elif self.algorithm == 'BIRCH':
             return Birch(n_clusters=self.params['clusters'],
                          threshold=self.params['threshold'], branching_factor=self.params['branching'])
+        else:
+            raise NotImplementedError('%s can not be fitted by chunks' % self.algorithm)
+
+    def describe(self):
+        return ' '.join([self.algorithm] + ['%s=%s' % (name, value) for name, value in sorted(self.params.items())])
+
+
+def get_algorithms_grid(algorithms, clusters=(None,), eps=(0.5,), thresholds=(0.5,), branchings=(50,)):
+    # Every combination of parameters used by the algorithm, clusters=None means amount of original clusters
+    grid = []
+    for name in algorithms:
+        if name == 'K-Means':
+            combinations = [{'clusters': k} for k in clusters]
+        elif name == 'DBSCAN':
+            combinations = [{'eps': value} for value in eps]
+        elif name == 'BIRCH':
+            combinations = [{'clusters': k, 'threshold': threshold, 'branching': branching}
+                            for k, threshold, branching in product(clusters, thresholds, branchings)]
         else:
             raise NotImplementedError
+        for params in combinations:
+            algorithm = ClusteringAlgorithm(name)
+            algorithm.params.update({name: value for name, value in params.items() if value is not None})
+            grid.append(algorithm)
+    return grid
+
+
+# Models needed to extend the analysis: estimators, scalers, widths of cluster masks and the device clusters
+SAVED_MODELS = ['params', 'device_feature_names', 'device_scaler', 'device_estimator', 'device_ids', 'device_labels',
+                'device_original_labels', 'device_clusters_amount', 'account_scaler', 'account_estimator',
+                'account_clusters_amount', 'customer_scaler', 'customer_estimator']
+
+
+# Feature matrices of the sweep, workers read them from the memory mapped files
+sweep_data = None
+
+
+def load_sweep_data(directory):
+    global sweep_data
+    sweep_data = {name[:-len('.npy')]: np.load(os.path.join(directory, name), mmap_mode='r')
+                  for name in os.listdir(directory)}
+
+
+def get_member_clusters(positions, labels):
+    # Clusters of members by their rows in analyzed ones, -1 for members that weren't analyzed
+    clusters = np.full(len(positions), -1, dtype=np.int64)
+    known = positions >= 0
+    clusters[known] = labels[positions[known]]
+    return clusters
+
+
+def fit_sweep_configuration(configuration):
+    # Fitting sets amounts of clusters of every level, so the configuration itself is kept intact
+    algorithm = ClusteringAlgorithm(configuration.algorithm)
+    algorithm.params.update(configuration.params)
+    analyzer = ActivityAnalyzer(None, None)
+    description = configuration.describe()
+    start_time = time()
+    try:
+        # Amount of device clusters can be set by the grid, other levels use their original ones
+        device_labels = sweep_data['device_labels']
+        device_clusters_amount = algorithm.params.get('clusters', len(set(device_labels) - {-1}))
+        _, estimated_device_labels, _, _ = analyzer.fit_level(sweep_data['devices'], device_clusters_amount,
+                                                              algorithm)
+
+        device_clusters = get_member_clusters(sweep_data['account_device_positions'], estimated_device_labels)
+        device_masks = analyzer.get_clusters_mask(sweep_data['account_device_rows'], device_clusters,
+                                                  len(sweep_data['accounts']),
+                                                  len(set(estimated_device_labels) - {-1}))
+        account_labels = sweep_data['account_labels']
+        _, estimated_account_labels, _, _ = analyzer.fit_level(
+            np.hstack((sweep_data['accounts'], device_masks.toarray())), len(set(account_labels)), algorithm)
+
+        account_clusters = get_member_clusters(sweep_data['customer_account_positions'], estimated_account_labels)
+        account_masks = analyzer.get_clusters_mask(sweep_data['customer_account_rows'], account_clusters,
+                                                   len(sweep_data['customers']),
+                                                   len(set(estimated_account_labels) - {-1}))
+        customer_labels = sweep_data['customer_labels']
+        _, estimated_customer_labels, _, _ = analyzer.fit_level(
+            np.hstack((sweep_data['customers'], account_masks.toarray())), len(set(customer_labels) - {-1}),
+            algorithm)
+
+        # Silhouette is skipped, it's not used for ranking
+        levels_metrics = {
+            'device': analyzer.get_metrics(None, estimated_device_labels, device_labels),
+            'account': analyzer.get_metrics(None, estimated_account_labels, account_labels),
+            'customer': analyzer.get_metrics(None, estimated_customer_labels, customer_labels),
+        }
+        levels_metrics['device']['clusters'] = len(set(estimated_device_labels) - {-1})
+    except Exception as error:
+        # Failed configuration is reported with the results, the rest of the sweep goes on
+        return description, None, time()-start_time, '%s: %s' % (type(error).__name__, error)
+
+    return description, levels_metrics, time()-start_time, None
 
 
 class ActivityAnalyzer:
+    # Silhouette is quadratic in the number of rows, so bigger data is sampled
+    SILHOUETTE_SAMPLE_SIZE = 10000
+
     def __init__(self, main_session, test_session):
         self.main_session = main_session
         self.test_session = test_session
-
-    def get_devices_info(self, date_from, date_to, db_session):
+        # Headless mode doesn't plot and prints metrics as JSON, to metrics_file if it's set
+        self.headless = False
+        self.metrics_file = None
+        self.silhouette_sample_size = self.SILHOUETTE_SAMPLE_SIZE
+
+    # Device features that don't depend on the values of categorical ones
+    DEVICE_FEATURES = ['calls', 'avg_call_duration', 'sms', 'mms', 'internet_sessions_count', 'internet_usage',
+                       'other_usages', 'balance_checks', 'other_requests', 'location_changes']
+    BASIC_SERVICES = ['outgoing_call', 'sms', 'mms', 'internet']
+
+    def get_device_feature_names(self, db_session):
+        # Categorical features are one-hot encoded like DictVectorizer does
+        types = db_session.query(Device.type).distinct()
+        tariffs = db_session.query(Tariff.name).join(Device, Device.tariff_id == Tariff.id).distinct()
+        return self.DEVICE_FEATURES + \
+            ['tariff=%s' % name for name in sorted(row.name for row in tariffs if row.name is not None)] + \
+            ['type=%s' % name for name in sorted(row.type for row in types if row.type is not None)]
+
+    def filter_ids(self, query, column, id_range, id_query=None):
+        if id_range is not None:
+            query = query.filter(between(column, *id_range))
+        if id_query is not None:
+            query = query.filter(column.in_(id_query.subquery()))
+        return query
+
+    def get_id_ranges(self, column, chunk_size, db_session):
+        # Keyset pagination, so chunks are found without offsets
+        last_id = None
+        while True:
+            query = db_session.query(column).order_by(column)
+            if last_id is not None:
+                query = query.filter(column > last_id)
+            ids = query.limit(chunk_size).all()
+            if not ids:
+                return
+            yield ids[0][0], ids[-1][0]
+            last_id = ids[-1][0]
+
+    def get_devices_info(self, date_from, date_to, db_session, feature_names=None, id_range=None, id_query=None):
+        # All features are aggregated by a few grouped queries instead of queries for every device
         date_begin = datetime(date_from.year, date_from.month, date_from.day, 0, 0, 0)
         date_end = datetime(date_to.year, date_to.month, date_to.day, 23, 59, 59)
 
-        devices = db_session.query(Device).order_by(Device.id).all()
-        devices_info = []
-        device_original_labels = []
-        device_ids = []
-
-        i = 0
-        for device in devices:
-            device_info = {'type': device.type,
-                           'tariff': device.tariff.name}
-
-            # Getting device services, which could be used on given time period
-            # TODO: Date from?
-            connected_services = db_session.query(DeviceService).\
-                filter(and_(DeviceService.device_id == device.id,
-                            or_(DeviceService.date_to.is_(None),
-                                DeviceService.date_to >= date_begin))).all()
-
-            requests = db_session.query(Service.name, Request.type, db.func.count(Request.id)).\
-                join(Request, and_(Request.service_id == Service.id,
-                                   Request.device_id == device.id,
-                                   between(Request.date_from, date_begin, date_end))).\
-                group_by(Service.name).all()
-
-            for service_name, request_type, request_count in requests:
-                if service_name == 'Balance request':
-                    device_info['balance_checks'] = request_count
-                else:
-                    if 'other_requests' not in device_info:
-                        device_info['other_requests'] = request_count
-                    else:
-                        device_info['other_requests'] += request_count
-
-            locations = db_session.query(Location).filter(and_(Location.device_id == device.id,
-                                                               between(Location.date_from,
-                                                                       date_begin, date_end))).all()
-            device_info['location_changes'] = len(locations)
-            # TODO: Parse locations
-
-            for device_service in connected_services:
-                service = device_service.service
-                try:
-                    total_usage, usage_amount = db_session.query(db.func.count(ServiceLog.id),
-                                                                        db.func.sum(ServiceLog.amount)).\
-                        filter(and_(ServiceLog.device_service == device_service,
-                                    ServiceLog.action_type == 'usage',
-                                    between(ServiceLog.date_from, date_begin, date_end))).\
-                        group_by(ServiceLog.device_service_id).one()
-                except NoResultFound:
-                    total_usage = 0
-                    usage_amount = 0
-
-                if total_usage > 0:
-                    avg_amount = usage_amount/total_usage
-                else:
-                    avg_amount = 0
-
-                if service.name == 'outgoing_call':
-                    device_info['calls'] = total_usage
-                    device_info['avg_call_duration'] = avg_amount
-                elif service.name == 'sms':
-                    device_info['sms'] = total_usage
-                elif service.name == 'mms':
-                    device_info['mms'] = total_usage
-                elif service.name == 'internet':
-                    device_info['internet_sessions_count'] = usage_amount
-                    device_info['internet_usage'] = total_usage*usage_amount
-                else:
-                    if 'other_usages' not in device_info:
-                        device_info['other_usages'] = total_usage
-                    else:
-                        device_info['other_usages'] += total_usage
-
-            devices_info.append(device_info)
-            device_ids.append(device.id)
-            device_original_labels.append(device.cluster_id)
-            i += 1
-
-        return devices_info, device_original_labels, device_ids
-
-    def get_clusters_mask(self, clusters, n):
-        mask = np.zeros(n)
-        for cluster in clusters:
-            mask[cluster] += 1
-        return mask
+        devices = db_session.query(Device.id, Device.cluster_id, Device.type, Tariff.name).\
+            outerjoin(Tariff, Device.tariff_id == Tariff.id).\
+            order_by(Device.id)
+        devices = self.filter_ids(devices, Device.id, id_range, id_query).all()
+        device_ids = [device.id for device in devices]
+        device_original_labels = [device.cluster_id for device in devices]
+
+        # Chunks of one analysis must have the same columns
+        if feature_names is None:
+            feature_names = self.get_device_feature_names(db_session)
+        columns = {name: i for i, name in enumerate(feature_names)}
+        features = np.zeros((len(devices), len(feature_names)))
+
+        for i, device in enumerate(devices):
+            if device.type is not None:
+                features[i, columns['type=%s' % device.type]] = 1
+            if device.name is not None:
+                features[i, columns['tariff=%s' % device.name]] = 1
+
+        # Usages of the services, which could be used on given time period, services with the same name are summed
+        # TODO: Date from?
+        usages = db_session.query(DeviceService.device_id, Service.name,
+                                  db.func.count(ServiceLog.id), db.func.sum(ServiceLog.amount)).\
+            join(DeviceService, ServiceLog.device_service_id == DeviceService.id).\
+            join(Service, DeviceService.service_id == Service.id).\
+            filter(and_(ServiceLog.action_type == 'usage',
+                        between(ServiceLog.date_from, date_begin, date_end),
+                        or_(DeviceService.date_to.is_(None),
+                            DeviceService.date_to >= date_begin))).\
+            group_by(DeviceService.device_id, Service.name)
+        usages = self.filter_ids(usages, DeviceService.device_id, id_range, id_query).all()
+        rows, service_names, total_usage, usage_amount = self.get_grouped_columns(device_ids, usages, 4)
+        total_usage, usage_amount = total_usage.astype(np.float64), usage_amount.astype(np.float64)
+
+        calls = service_names == 'outgoing_call'
+        features[rows[calls], columns['calls']] = total_usage[calls]
+        features[rows[calls], columns['avg_call_duration']] = usage_amount[calls]/total_usage[calls]
+        for name in ('sms', 'mms'):
+            mask = service_names == name
+            features[rows[mask], columns[name]] = total_usage[mask]
+        internet = service_names == 'internet'
+        features[rows[internet], columns['internet_sessions_count']] = usage_amount[internet]
+        features[rows[internet], columns['internet_usage']] = total_usage[internet]*usage_amount[internet]
+        other = ~np.isin(service_names, self.BASIC_SERVICES)
+        np.add.at(features[:, columns['other_usages']], rows[other], total_usage[other])
+
+        requests = db_session.query(Request.device_id, Service.name, db.func.count(Request.id)).\
+            join(Service, Request.service_id == Service.id).\
+            filter(between(Request.date_from, date_begin, date_end)).\
+            group_by(Request.device_id, Service.name)
+        requests = self.filter_ids(requests, Request.device_id, id_range, id_query).all()
+        rows, service_names, request_count = self.get_grouped_columns(device_ids, requests, 3)
+        request_count = request_count.astype(np.float64)
+
+        balance_checks = service_names == 'Balance request'
+        features[rows[balance_checks], columns['balance_checks']] = request_count[balance_checks]
+        np.add.at(features[:, columns['other_requests']], rows[~balance_checks], request_count[~balance_checks])
+
+        locations = db_session.query(Location.device_id, db.func.count(Location.id)).\
+            filter(between(Location.date_from, date_begin, date_end)).\
+            group_by(Location.device_id)
+        locations = self.filter_ids(locations, Location.device_id, id_range, id_query).all()
+        rows, location_changes = self.get_grouped_columns(device_ids, locations, 2)
+        features[rows, columns['location_changes']] = location_changes
+        # TODO: Parse locations
+
+        return features, feature_names, device_original_labels, device_ids
+
+    def get_grouped_columns(self, ids, grouped_rows, width):
+        # Splits rows of (id, ...) into columns, ids are replaced by their positions in sorted ids
+        grouped_rows = [row for row in grouped_rows if row[0] is not None]
+        columns = [np.array(column, dtype=object) for column in zip(*grouped_rows)]
+        if not columns:
+            columns = [np.empty(0, dtype=object) for _ in range(width)]
+        positions = np.searchsorted(np.asarray(ids), columns[0].astype(np.int64))
+        return [positions] + columns[1:]
+
+    def fit_devices_by_chunks(self, date_from, date_to, db_session, algorithm, chunk_size):
+        # Out-of-core clustering: only one chunk of device features is kept in memory at once
+        feature_names = self.get_device_feature_names(db_session)
+        id_ranges = list(self.get_id_ranges(Device.id, chunk_size, db_session))
+
+        def read_chunks():
+            for id_range in id_ranges:
+                yield self.get_devices_info(date_from, date_to, db_session, feature_names, id_range)
+
+        min_max_scaler = preprocessing.MinMaxScaler()
+        for features, _, _, _ in read_chunks():
+            min_max_scaler.partial_fit(features)
+
+        original_clusters = db_session.query(Device.cluster_id).distinct()
+        algorithm.params['clusters'] = len({row.cluster_id for row in original_clusters} - {-1})
+        estimator = algorithm.get_partial_estimator()
+        # The first fitted part must have at least as many rows as clusters, so small chunks are joined
+        buffered = []
+        for features, _, _, _ in read_chunks():
+            buffered.append(min_max_scaler.transform(features))
+            if sum(len(part) for part in buffered) >= algorithm.params['clusters']:
+                estimator.partial_fit(np.vstack(buffered))
+                buffered = []
+        if buffered:
+            estimator.partial_fit(np.vstack(buffered))
+
+        estimated_labels, original_labels, device_ids = [], [], []
+        for features, _, labels, ids in read_chunks():
+            estimated_labels.append(estimator.predict(min_max_scaler.transform(features)))
+            original_labels.append(np.array(labels))
+            device_ids.append(np.array(ids, dtype=np.int64))
+
+        return np.concatenate(estimated_labels), np.concatenate(original_labels), np.concatenate(device_ids), \
+            min_max_scaler, estimator
+
+    def get_clusters_mask(self, rows, clusters, rows_count, clusters_amount):
+        # Amounts of members of every cluster per row, noise points are skipped
+        rows = np.asarray(rows, dtype=np.intp)
+        clusters = np.asarray(clusters, dtype=np.intp)
+        known = clusters >= 0
+        return sparse.coo_matrix((np.ones(np.count_nonzero(known)), (rows[known], clusters[known])),
+                                 shape=(rows_count, clusters_amount)).tocsr()
 
     def get_accounts_info(self, device_cluster_match, device_clusters_amount, db_session):
-        accounts = db_session.query(Account).order_by(Account.id).all()
-        account_infos = []
-        account_original_labels = []
-        account_ids = []
-        device_masks = []
-
-        for account in accounts:
-            account_info = {
-                'trust_category': account.trust_category,
-                'credit_limit': float(account.credit_limit),
-                'bill_group': account.bill_group,
-                'calc_method_id': account.calculation_method_id
-            }
-            payments = db_session.query(Payment.method_id,
-                                        db.func.sum(Payment.amount), db.func.count(Payment.id)).\
-                join(PaymentMethod, PaymentMethod.id == Payment.method_id).\
-                join(Balance, Balance.id == Payment.balance_id).\
-                join(Account, Account.id == Balance.account_id).\
-                filter(Account.id == account.id).\
-                group_by(Payment.method_id).all()
-
-            for method_id, payment_sum, payment_count in payments:
-                if 'payment_sum' not in account_info:
-                    account_info['payment_sum'] = float(payment_sum)
-                else:
-                    account_info['payment_sum'] += float(payment_sum)
-
-            devices = db_session.query(Device).filter_by(account_id=account.id).all()
-            account_info['devices_amount'] = len(devices)
-            device_clusters = []
-            for device in devices:
-                device_clusters.append(device_cluster_match[device.id])
-            device_cluster_mask = self.get_clusters_mask(device_clusters, device_clusters_amount)
-
-            device_masks.append(device_cluster_mask)
-            account_original_labels.append(account.cluster_id)
-            account_infos.append(account_info)
-            account_ids.append(account.id)
-
-        return account_infos, account_original_labels, device_masks, account_ids
+        features, feature_names, account_original_labels, account_ids, rows, device_ids = \
+            self.get_accounts_features(db_session)
+        device_clusters = [device_cluster_match.get(device_id, -1) for device_id in device_ids]
+        device_masks = self.get_clusters_mask(rows, device_clusters, len(account_ids), device_clusters_amount)
+
+        return features, feature_names, account_original_labels, device_masks, account_ids
+
+    def get_accounts_features(self, db_session):
+        # Features which don't depend on device clusters and rows of accounts with their devices
+        accounts = db_session.query(Account.id, Account.cluster_id, Account.trust_category, Account.credit_limit,
+                                    Account.bill_group, Account.calculation_method_id).\
+            order_by(Account.id).all()
+        account_ids = [account.id for account in accounts]
+        account_original_labels = [account.cluster_id for account in accounts]
+
+        feature_names = ['trust_category', 'credit_limit', 'bill_group', 'calc_method_id', 'payment_sum',
+                         'devices_amount']
+        columns = {name: i for i, name in enumerate(feature_names)}
+        features = np.zeros((len(accounts), len(feature_names)))
+        for i, account in enumerate(accounts):
+            features[i, columns['trust_category']] = account.trust_category
+            features[i, columns['credit_limit']] = float(account.credit_limit)
+            features[i, columns['bill_group']] = account.bill_group
+            features[i, columns['calc_method_id']] = account.calculation_method_id
+
+        payments = db_session.query(Balance.account_id, db.func.sum(Payment.amount)).\
+            join(Payment, Payment.balance_id == Balance.id).\
+            join(PaymentMethod, PaymentMethod.id == Payment.method_id).\
+            group_by(Balance.account_id).all()
+        rows, payment_sum = self.get_grouped_columns(account_ids, payments, 2)
+        features[rows, columns['payment_sum']] = payment_sum.astype(np.float64)
+
+        devices = db_session.query(Device.account_id, Device.id).all()
+        rows, device_ids = self.get_grouped_columns(account_ids, devices, 2)
+        np.add.at(features[:, columns['devices_amount']], rows, 1)
+
+        return features, feature_names, account_original_labels, account_ids, rows, device_ids
 
     def get_customers_info(self, account_cluster_match, account_clusters_amount, db_session):
-        customers = db_session.query(Customer).order_by(Customer.id).all()
-        customer_infos = []
-        customer_original_labels = []
-        customer_ids = []
-        account_masks = []
-
-        for customer in customers:
-            customer_info = {
-                'customer_type': customer.type,
-                'status': customer.status,
-                'rank': customer.rank,
-            }
-            # TODO: Individual and Organization features
-            if customer.type == 'individual':
-                pass
-            else:
-                pass
-
-            agreements = db_session.query(CustomerAgreement).filter_by(customer_id=customer.id).all()
-            customer_info['agreements_amount'] = len(agreements)
-
-            accounts_cluster_mask = np.zeros(account_clusters_amount)
-            # Accumulating information about all accounts
-            for agreement in agreements:
-                accounts = db_session.query(Account).filter_by(agreement_id=agreement.id).all()
-
-                account_clusters = []
-                for account in accounts:
-                    account_clusters.append(account_cluster_match[account.id])
-                account_cluster_mask = self.get_clusters_mask(account_clusters, account_clusters_amount)
-                accounts_cluster_mask += account_cluster_mask
-
-            account_masks.append(accounts_cluster_mask)
-            customer_original_labels.append(customer.cluster_id)
-            customer_infos.append(customer_info)
-            customer_ids.append(customer.id)
+        features, feature_names, customer_original_labels, customer_ids, rows, account_ids = \
+            self.get_customers_features(db_session)
+        account_clusters = [account_cluster_match.get(account_id, -1) for account_id in account_ids]
+        account_masks = self.get_clusters_mask(rows, account_clusters, len(customer_ids), account_clusters_amount)
+
+        return features, feature_names, customer_original_labels, account_masks, customer_ids
+
+    def get_customers_features(self, db_session):
+        # Features which don't depend on account clusters and rows of customers with their accounts
+        customers = db_session.query(Customer.id, Customer.cluster_id, Customer.type, Customer.status,
+                                     Customer.rank).\
+            order_by(Customer.id).all()
+        customer_ids = [customer.id for customer in customers]
+        customer_original_labels = [customer.cluster_id for customer in customers]
+
+        # TODO: Individual and Organization features
+        types = sorted({customer.type for customer in customers if customer.type is not None})
+        statuses = sorted({customer.status for customer in customers if customer.status is not None})
+        feature_names = ['rank', 'agreements_amount'] + ['customer_type=%s' % name for name in types] + \
+            ['status=%s' % name for name in statuses]
+        columns = {name: i for i, name in enumerate(feature_names)}
+        features = np.zeros((len(customers), len(feature_names)))
+        for i, customer in enumerate(customers):
+            features[i, columns['rank']] = customer.rank
+            if customer.type is not None:
+                features[i, columns['customer_type=%s' % customer.type]] = 1
+            if customer.status is not None:
+                features[i, columns['status=%s' % customer.status]] = 1
+
+        agreements = db_session.query(CustomerAgreement.customer_id, db.func.count(CustomerAgreement.id)).\
+            group_by(CustomerAgreement.customer_id).all()
+        rows, agreements_amount = self.get_grouped_columns(customer_ids, agreements, 2)
+        features[rows, columns['agreements_amount']] = agreements_amount.astype(np.float64)
+
+        # Accumulating information about accounts of all agreements
+        accounts = db_session.query(CustomerAgreement.customer_id, Account.id).\
+            join(Account, Account.agreement_id == CustomerAgreement.id).all()
+        rows, account_ids = self.get_grouped_columns(customer_ids, accounts, 2)
+
+        return features, feature_names, customer_original_labels, customer_ids, rows, account_ids
+
+    def get_customers_activity(self, date_from, date_to, db_session):
+        # Amounts of events of customers by action type and by hour of day, used for sampling of test load
+        date_begin = datetime(date_from.year, date_from.month, date_from.day, 0, 0, 0)
+        date_end = datetime(date_to.year, date_to.month, date_to.day, 23, 59, 59)
 
-        return customer_infos, customer_original_labels, account_masks, customer_ids
+        customer_ids = [row.id for row in db_session.query(Customer.id).order_by(Customer.id)]
+        device_customers = db_session.query(Device.id.label('device_id'), CustomerAgreement.customer_id).\
+            join(Account, Account.id == Device.account_id).\
+            join(CustomerAgreement, CustomerAgreement.id == Account.agreement_id).subquery()
+
+        usages = db_session.query(device_customers.c.customer_id, Service.name,
+                                  db.extract('hour', ServiceLog.date_from), db.func.count(ServiceLog.id)).\
+            join(DeviceService, DeviceService.device_id == device_customers.c.device_id).\
+            join(ServiceLog, ServiceLog.device_service_id == DeviceService.id).\
+            join(Service, DeviceService.service_id == Service.id).\
+            filter(between(ServiceLog.date_from, date_begin, date_end)).\
+            group_by(device_customers.c.customer_id, Service.name, db.extract('hour', ServiceLog.date_from)).all()
+        requests = db_session.query(device_customers.c.customer_id, db.literal('request'),
+                                    db.extract('hour', Request.date_from), db.func.count(Request.id)).\
+            join(Request, Request.device_id == device_customers.c.device_id).\
+            filter(between(Request.date_from, date_begin, date_end)).\
+            group_by(device_customers.c.customer_id, db.extract('hour', Request.date_from)).all()
+        locations = db_session.query(device_customers.c.customer_id, db.literal('location'),
+                                     db.extract('hour', Location.date_from), db.func.count(Location.id)).\
+            join(Location, Location.device_id == device_customers.c.device_id).\
+            filter(between(Location.date_from, date_begin, date_end)).\
+            group_by(device_customers.c.customer_id, db.extract('hour', Location.date_from)).all()
+
+        rows, types, hours, counts = self.get_grouped_columns(customer_ids, usages+requests+locations, 4)
+        type_names, type_columns = np.unique(types.astype(str), return_inverse=True)
+        feature_names = ['type=%s' % name for name in type_names] + ['hour=%d' % hour for hour in range(24)]
+        # Every event is counted once by its type and once by its hour
+        activity = sparse.coo_matrix((np.concatenate((counts, counts)).astype(np.float64),
+                                      (np.concatenate((rows, rows)),
+                                       np.concatenate((type_columns, len(type_names)+hours.astype(np.int64))))),
+                                     shape=(len(customer_ids), len(feature_names))).tocsr()
+        return customer_ids, feature_names, activity
 
     def plot_data(self, data, labels):
+        # Plotting is imported only when it's needed, so headless analysis works without display
+        from mpl_toolkits.mplot3d import Axes3D
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
         pca = PCA(n_components=3)
@@ -222,91 +451,316 @@ class ActivityAnalyzer:
         print('Projected vectors variance:')
         print(pca.explained_variance_ratio_)
 
-        ax.scatter(X[:, 0], X[:, 1], X[:, 2], c=labels.astype(np.float))
+        ax.scatter(X[:, 0], X[:, 1], X[:, 2], c=labels.astype(np.float64))
         plt.show()
 
-    def print_metrics(self, data, labels, labels_real):
-        print("Homogeneity: %0.3f" % metrics.homogeneity_score(labels_real, labels))
-        print("Completeness: %0.3f" % metrics.completeness_score(labels_real, labels))
-        print("V-measure: %0.3f" % metrics.v_measure_score(labels_real, labels))
-        print("Adjusted Rand Index: %0.3f"
-              % metrics.adjusted_rand_score(labels_real, labels))
-        print("Adjusted Mutual Information: %0.3f"
-              % metrics.adjusted_mutual_info_score(labels_real, labels))
-        print("Silhouette Coefficient: %0.3f"
-              % metrics.silhouette_score(data, labels))
-
-    def analyze(self, date_from, date_to, base_type, algorithm: ClusteringAlgorithm):
+    def get_metrics(self, data, labels, labels_real):
+        result = {
+            'homogeneity': metrics.homogeneity_score(labels_real, labels),
+            'completeness': metrics.completeness_score(labels_real, labels),
+            'v_measure': metrics.v_measure_score(labels_real, labels),
+            'adjusted_rand_index': metrics.adjusted_rand_score(labels_real, labels),
+            'adjusted_mutual_information': metrics.adjusted_mutual_info_score(labels_real, labels),
+            'silhouette': None,
+        }
+        # Silhouette is defined only for 2..n-1 clusters
+        if data is not None and 1 < len(set(labels)) < len(labels):
+            sample_size = None
+            if self.silhouette_sample_size and len(labels) > self.silhouette_sample_size:
+                sample_size = self.silhouette_sample_size
+            result['silhouette'] = metrics.silhouette_score(data, labels, sample_size=sample_size, random_state=0)
+        return result
+
+    def print_metrics(self, level_metrics):
+        print("Homogeneity: %0.3f" % level_metrics['homogeneity'])
+        print("Completeness: %0.3f" % level_metrics['completeness'])
+        print("V-measure: %0.3f" % level_metrics['v_measure'])
+        print("Adjusted Rand Index: %0.3f" % level_metrics['adjusted_rand_index'])
+        print("Adjusted Mutual Information: %0.3f" % level_metrics['adjusted_mutual_information'])
+        if level_metrics['silhouette'] is not None:
+            print("Silhouette Coefficient: %0.3f" % level_metrics['silhouette'])
+
+    def write_metrics(self, date_from, date_to, base_type, algorithm, analysis_time, levels_metrics):
+        report = {
+            'date_from': date_from.isoformat(),
+            'date_to': date_to.isoformat(),
+            'base': base_type,
+            'algorithm': algorithm.algorithm,
+            'params': algorithm.params,
+            'time': analysis_time,
+            'levels': levels_metrics,
+        }
+        line = json.dumps(report, default=float)
+        if self.metrics_file:
+            with open(self.metrics_file, 'a') as metrics_file:
+                metrics_file.write(line + '\n')
+        else:
+            print(line)
+
+    def get_positions(self, ids, analyzed_ids):
+        # Rows of ids in sorted analyzed ids, -1 for missing ones
+        ids = np.asarray(ids, dtype=np.int64)
+        analyzed_ids = np.asarray(analyzed_ids, dtype=np.int64)
+        if not len(analyzed_ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(analyzed_ids, ids), len(analyzed_ids)-1)
+        return np.where(analyzed_ids[positions] == ids, positions, -1)
+
+    def sweep(self, date_from, date_to, base_type, algorithms, workers=1):
+        # Features are extracted once and every configuration is fitted on the same matrices
         if base_type == 'main':
             db_session = self.main_session
         else:
             db_session = self.test_session
 
-        print('Analyzing data')
+        print('Sweeping %d clustering configurations' % len(algorithms))
         start_time = time()
 
-        vectorizer = DictVectorizer()
+        devices_features, _, device_labels, device_ids = self.get_devices_info(date_from, date_to, db_session)
+        accounts_features, _, account_labels, account_ids, account_rows, account_device_ids = \
+            self.get_accounts_features(db_session)
+        customers_features, _, customer_labels, customer_ids, customer_rows, customer_account_ids = \
+            self.get_customers_features(db_session)
+        print('Features extracted in %f seconds' % (time()-start_time))
+
+        results = []
+        with TemporaryDirectory() as directory:
+            arrays = {
+                'devices': preprocessing.MinMaxScaler().fit_transform(devices_features),
+                'device_labels': device_labels,
+                'accounts': accounts_features,
+                'account_labels': account_labels,
+                'account_device_rows': account_rows,
+                'account_device_positions': self.get_positions(account_device_ids, device_ids),
+                'customers': customers_features,
+                'customer_labels': customer_labels,
+                'customer_account_rows': customer_rows,
+                'customer_account_positions': self.get_positions(customer_account_ids, account_ids),
+            }
+            for name, array in arrays.items():
+                np.save(os.path.join(directory, name + '.npy'), np.asarray(array))
+
+            # Device neighbors graph is built once for the largest eps, forked workers get it from the cache
+            eps = [algorithm.params['eps'] for algorithm in algorithms if algorithm.algorithm == 'DBSCAN']
+            if eps:
+                neighbors_cache.get_graph(arrays['devices'], max(eps))
+            del arrays, devices_features
+
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                         initializer=load_sweep_data, initargs=(directory,)) as executor:
+                    results = list(executor.map(fit_sweep_configuration, algorithms))
+            else:
+                load_sweep_data(directory)
+                results = [fit_sweep_configuration(algorithm) for algorithm in algorithms]
+
+        print('Sweep took %f seconds' % (time()-start_time))
+        self.print_sweep_results(results)
+        if self.headless:
+            for algorithm, (_, levels_metrics, fit_time, error) in zip(algorithms, results):
+                if error is None:
+                    self.write_metrics(date_from, date_to, base_type, algorithm, fit_time, levels_metrics)
+        return results
+
+    def print_sweep_results(self, results):
+        # Configurations are ranked by V-measure averaged over all levels
+        levels = ['device', 'account', 'customer']
+        succeeded = [result for result in results if result[3] is None]
+        succeeded.sort(key=lambda result: -np.mean([result[1][level]['v_measure'] for level in levels]))
+
+        header = '%4s  %-50s %8s' % ('Rank', 'Configuration', 'Clusters')
+        for level in levels:
+            header += '  %-9s %6s %6s %6s' % (level, 'Homog', 'V', 'ARI')
+        print(header + '  %8s' % 'Time')
+        for rank, (description, levels_metrics, fit_time, _) in enumerate(succeeded, 1):
+            line = '%4d  %-50s %8d' % (rank, description, levels_metrics['device']['clusters'])
+            for level in levels:
+                line += '  %-9s %6.3f %6.3f %6.3f' % ('', levels_metrics[level]['homogeneity'],
+                                                      levels_metrics[level]['v_measure'],
+                                                      levels_metrics[level]['adjusted_rand_index'])
+            print(line + '  %8.3f' % fit_time)
+
+        failed = [result for result in results if result[3] is not None]
+        if failed:
+            print('Failed configurations: %d of %d' % (len(failed), len(results)))
+        for description, _, _, error in failed:
+            print('%s failed: %s' % (description, error))
+
+    def get_updated_devices_query(self, date_from, date_to, last_device_id, db_session):
+        # Devices with any activity on given period and devices registered after the last analyzed one
+        date_begin = datetime(date_from.year, date_from.month, date_from.day, 0, 0, 0)
+        date_end = datetime(date_to.year, date_to.month, date_to.day, 23, 59, 59)
 
-        # Clustering devices
-        devices_info, device_labels, device_ids = self.get_devices_info(date_from, date_to, db_session)
-        processed_devices = vectorizer.fit_transform(devices_info).toarray()
+        usages = db_session.query(DeviceService.device_id).\
+            join(ServiceLog, ServiceLog.device_service_id == DeviceService.id).\
+            filter(between(ServiceLog.date_from, date_begin, date_end))
+        requests = db_session.query(Request.device_id).filter(between(Request.date_from, date_begin, date_end))
+        locations = db_session.query(Location.device_id).filter(between(Location.date_from, date_begin, date_end))
+        new_devices = db_session.query(Device.id).filter(Device.id > last_device_id)
+        return usages.union(requests, locations, new_devices)
+
+    def update_device_clusters(self, models, saved_date_to, date_from, date_to, db_session):
+        # Devices without new activity keep their clusters
+        saved_ids = models['device_ids']
+        updated_devices = self.get_updated_devices_query(saved_date_to+timedelta(days=1), date_to,
+                                                         int(saved_ids.max(initial=0)), db_session)
+        features, _, original_labels, ids = self.get_devices_info(date_from, date_to, db_session,
+                                                                  models['device_feature_names'],
+                                                                  id_query=updated_devices)
+        print('Assigning %d updated devices to existing clusters' % len(ids))
+
+        estimated_labels = models['device_estimator'].predict(models['device_scaler'].transform(features)) \
+            if ids else np.zeros(0, dtype=np.int64)
+
+        device_ids = np.union1d(saved_ids, np.array(ids, dtype=np.int64))
+        saved_rows = np.searchsorted(device_ids, saved_ids)
+        rows = np.searchsorted(device_ids, ids)
+
+        device_labels = np.full(len(device_ids), -1, dtype=np.int64)
+        device_labels[saved_rows] = models['device_labels']
+        device_labels[rows] = estimated_labels
+        device_original_labels = np.full(len(device_ids), -1, dtype=np.int64)
+        device_original_labels[saved_rows] = models['device_original_labels']
+        device_original_labels[rows] = original_labels
+
+        return device_labels, device_original_labels, device_ids
+
+    def fit_level(self, features, clusters_amount, algorithm, scaler=None, estimator=None):
+        # Saved scaler and estimator only assign data to the existing clusters
+        if estimator is None:
+            scaler = preprocessing.MinMaxScaler()
+            processed = scaler.fit_transform(features)
+            algorithm.params['clusters'] = clusters_amount
+            estimator = algorithm.get_estimator()
+            estimator.fit(processed)
+            return processed, estimator.labels_, scaler, estimator
+        else:
+            processed = scaler.transform(features)
+            return processed, estimator.predict(processed), scaler, estimator
+
+    def load_analysis(self, date_from, date_to, algorithm, db_session):
+        # Saved analysis can be extended only by the later activity with the same features and algorithm
+        if algorithm.algorithm == 'DBSCAN':
+            return None
+        analysis = self.get_saved_analyses(date_from, algorithm, db_session).order_by(Analysis.id.desc()).first()
+        if analysis is None or analysis.date_to > date_to:
+            return None
+
+        models = pickle.loads(analysis.models)
+        params = {name: value for name, value in algorithm.params.items() if name != 'clusters'}
+        if models['params'] != params or models['device_feature_names'] != self.get_device_feature_names(db_session):
+            return None
+        return analysis, models
+
+    def get_saved_analyses(self, date_from, algorithm, db_session):
+        # Analyses are kept by algorithm and start of the analyzed period
+        return db_session.query(Analysis).filter(Analysis.algorithm == algorithm.algorithm,
+                                                 Analysis.date_from == date_from)
+
+    def save_analysis(self, date_from, date_to, algorithm, models, assignments, db_session):
+        # Saved analysis replaces only the one with the same algorithm and start, committing is left to the caller
+        replaced_ids = [row.id for row in self.get_saved_analyses(date_from, algorithm, db_session)]
+        if replaced_ids:
+            db_session.query(ClusterAssignment).filter(ClusterAssignment.analysis_id.in_(replaced_ids)).\
+                delete(synchronize_session=False)
+            db_session.query(Analysis).filter(Analysis.id.in_(replaced_ids)).delete(synchronize_session=False)
+
+        # DBSCAN can't assign new points to its clusters, so its analysis is never extended and models aren't kept
+        saved_models = None
+        if algorithm.algorithm != 'DBSCAN':
+            models['params'] = {name: value for name, value in algorithm.params.items() if name != 'clusters'}
+            saved_models = pickle.dumps({name: models[name] for name in SAVED_MODELS})
+        analysis = Analysis(date_from=date_from, date_to=date_to, algorithm=algorithm.algorithm, models=saved_models)
+        db_session.add(analysis)
+        db_session.flush([analysis])
+
+        for level, ids, labels in assignments:
+            rows = [{'analysis_id': analysis.id, 'level': level, 'entity_id': int(entity_id), 'cluster': int(label)}
+                    for entity_id, label in zip(ids, labels)]
+            if rows:
+                db_session.execute(ClusterAssignment.__table__.insert(), rows)
+
+    def analyze(self, date_from, date_to, base_type, algorithm: ClusteringAlgorithm, chunk_size=None):
+        if base_type == 'main':
+            db_session = self.main_session
+        else:
+            db_session = self.test_session
 
-        min_max_scaler = preprocessing.MinMaxScaler()
-        processed_devices = min_max_scaler.fit_transform(processed_devices)
-        device_clusters_amount = len(set(device_labels) - {-1})
+        print('Analyzing data')
+        start_time = time()
 
-        algorithm.params['clusters'] = device_clusters_amount
-        device_estimator = algorithm.get_estimator()
-        device_estimator.fit(processed_devices)
-        estimated_device_labels = device_estimator.labels_
+        if chunk_size and not algorithm.can_fit_by_chunks():
+            print('%s can not be fitted by chunks, analyzing data in memory' % algorithm.algorithm)
+            chunk_size = None
+
+        saved = self.load_analysis(date_from, date_to, algorithm, db_session)
+        models = {}
+        if saved is not None:
+            analysis, models = saved
+            print('Updating analysis of period from %s to %s' % (analysis.date_from, analysis.date_to))
+
+        # Clustering devices
+        if saved is not None:
+            # Device features aren't saved, so there is no data for silhouette and plot
+            estimated_device_labels, device_labels, device_ids = \
+                self.update_device_clusters(models, analysis.date_to, date_from, date_to, db_session)
+            device_ids = device_ids.tolist()
+            processed_devices = None
+        elif chunk_size:
+            # Device features are not kept in memory, so there is no data for silhouette and plot
+            estimated_device_labels, device_labels, device_ids, device_scaler, device_estimator = \
+                self.fit_devices_by_chunks(date_from, date_to, db_session, algorithm, chunk_size)
+            device_ids = device_ids.tolist()
+            processed_devices = None
+            models.update(device_feature_names=self.get_device_feature_names(db_session),
+                          device_scaler=device_scaler, device_estimator=device_estimator)
+        else:
+            devices_features, device_feature_names, device_labels, device_ids = self.get_devices_info(date_from,
+                                                                                                      date_to,
+                                                                                                      db_session)
+            processed_devices, estimated_device_labels, device_scaler, device_estimator = \
+                self.fit_level(devices_features, len(set(device_labels) - {-1}), algorithm)
+            models.update(device_feature_names=device_feature_names,
+                          device_scaler=device_scaler, device_estimator=device_estimator)
 
         device_labels_set = set(estimated_device_labels)
         print('Estimated number of device clusters: %d' % (len(device_labels_set)))
         print(device_labels_set)
+        # Masks of the saved account estimator must keep their width
+        device_clusters_amount = models.get('device_clusters_amount', len(device_labels_set - {-1}))
 
         device_cluster_match = {}
         for i, device_id in enumerate(device_ids):
-            if device_id != -1:  # ignoring noise points
+            if estimated_device_labels[i] != -1:  # ignoring noise points
                 device_cluster_match[device_id] = estimated_device_labels[i]
 
-        accounts_info, account_labels, device_masks, account_ids = self.get_accounts_info(device_cluster_match,
-                                                                                          len(device_cluster_match),
-                                                                                          db_session)
-        processed_accounts = vectorizer.fit_transform(accounts_info).toarray()
-        account_clusters_amount = len(set(account_labels))
-
-        # Adding device clusters info to accounts
-        processed_accounts = np.concatenate((processed_accounts, device_masks), axis=1)
-        processed_accounts = min_max_scaler.fit_transform(processed_accounts)
+        accounts_features, account_feature_names, account_labels, device_masks, account_ids = \
+            self.get_accounts_info(device_cluster_match, device_clusters_amount, db_session)
 
-        algorithm.params['clusters'] = account_clusters_amount
-        account_estimator = algorithm.get_estimator()
-        account_estimator.fit(processed_accounts)
-        estimated_account_labels = account_estimator.labels_
+        # Adding device clusters info to accounts, masks are as wide as the number of clusters
+        accounts_features = np.hstack((accounts_features, device_masks.toarray()))
+        processed_accounts, estimated_account_labels, account_scaler, account_estimator = \
+            self.fit_level(accounts_features, len(set(account_labels)), algorithm,
+                           models.get('account_scaler'), models.get('account_estimator'))
 
         account_labels_set = set(estimated_device_labels)
         print('Estimated number of account clusters: %d' % (len(account_labels_set)))
         print(account_labels_set)
+        account_clusters_amount = models.get('account_clusters_amount', len(set(estimated_account_labels) - {-1}))
 
         account_cluster_match = {}
         for i, account_id in enumerate(account_ids):
-            if account_id != -1:
+            if estimated_account_labels[i] != -1:
                 account_cluster_match[account_id] = estimated_account_labels[i]
 
-        customers_info, customer_labels, account_masks, customer_ids = self.get_customers_info(account_cluster_match,
-                                                                                               len(account_cluster_match),
-                                                                                               db_session)
-        processed_customers = vectorizer.fit_transform(customers_info).toarray()
-        customer_clusters_amount = len(set(customer_labels) - {-1})
+        customers_features, customer_feature_names, customer_labels, account_masks, customer_ids = \
+            self.get_customers_info(account_cluster_match, account_clusters_amount, db_session)
 
         # Adding account clusters info to customers
-        processed_customers = np.concatenate((processed_customers, account_masks), axis=1)
-        processed_customers = min_max_scaler.fit_transform(processed_customers)
-
-        algorithm.params['clusters'] = customer_clusters_amount
-        customer_estimator = algorithm.get_estimator()
-        customer_estimator.fit(processed_customers)
-        estimated_customer_labels = customer_estimator.labels_
+        customers_features = np.hstack((customers_features, account_masks.toarray()))
+        processed_customers, estimated_customer_labels, customer_scaler, customer_estimator = \
+            self.fit_level(customers_features, len(set(customer_labels) - {-1}), algorithm,
+                           models.get('customer_scaler'), models.get('customer_estimator'))
 
         customer_labels_set = set(estimated_customer_labels)
         print('Estimated number of customer clusters: %d' % (len(customer_labels_set)))
@@ -322,16 +776,38 @@ class ActivityAnalyzer:
         print('Customer clusters')
         print(customer_clusters)
 
+        models.update(device_ids=np.asarray(device_ids, dtype=np.int64),
+                      device_labels=np.asarray(estimated_device_labels),
+                      device_original_labels=np.asarray(device_labels),
+                      device_clusters_amount=device_clusters_amount,
+                      account_scaler=account_scaler, account_estimator=account_estimator,
+                      account_clusters_amount=account_clusters_amount,
+                      customer_scaler=customer_scaler, customer_estimator=customer_estimator)
+        self.save_analysis(date_from, date_to, algorithm, models,
+                           [('device', device_ids, estimated_device_labels),
+                            ('account', account_ids, estimated_account_labels),
+                            ('customer', customer_ids, estimated_customer_labels)], db_session)
+
         end_time = time()
         print('Analyzing took %f seconds' % (end_time-start_time))
 
-        self.print_metrics(processed_devices, estimated_device_labels, device_labels)
-        self.plot_data(processed_devices, estimated_device_labels)
+        levels_metrics = {
+            'device': self.get_metrics(processed_devices, estimated_device_labels, device_labels),
+            'account': self.get_metrics(processed_accounts, estimated_account_labels, account_labels),
+            'customer': self.get_metrics(processed_customers, estimated_customer_labels, customer_labels),
+        }
+        if self.headless:
+            self.write_metrics(date_from, date_to, base_type, algorithm, end_time-start_time, levels_metrics)
+            return customer_clusters
+
+        self.print_metrics(levels_metrics['device'])
+        if processed_devices is not None:
+            self.plot_data(processed_devices, estimated_device_labels)
 
-        self.print_metrics(processed_accounts, estimated_account_labels, account_labels)
+        self.print_metrics(levels_metrics['account'])
         # self.plot_data(processed_accounts, estimated_account_labels)
 
-        self.print_metrics(processed_customers, estimated_customer_labels, customer_labels)
+        self.print_metrics(levels_metrics['customer'])
         # self.plot_data(processed_customers, estimated_customer_labels)
 
         return customer_clusters
@@ -0,0 +1,129 @@
+from decimal import Decimal, ROUND_CEILING
+
+import numpy as np
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+
+from catalog import PricingMatrix
+
+
+def get_group_starts(groups):
+    # Groups must be sorted
+    return np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1]))) if len(groups) else groups
+
+
+def group_cumsum(values, groups):
+    # Inclusive cumulative sums restarted at every group, groups must be sorted
+    if not len(values):
+        return values.copy()
+    sums = np.cumsum(values)
+    starts = get_group_starts(groups)
+    lengths = np.diff(np.append(starts, len(values)))
+    return sums-np.repeat(sums[starts]-values[starts], lengths)
+
+
+def group_sums(values, groups, groups_amount):
+    # Integer sums, bincount would count them in floats
+    sums = np.zeros(groups_amount, dtype=np.int64)
+    np.add.at(sums, groups, values)
+    return sums
+
+
+def get_money_places(values):
+    # Digits after the point needed to write all the values as integers
+    return max([-min(value.normalize().as_tuple().exponent, 0) for value in values if value.is_finite()] + [0])
+
+
+class BatchBilling:
+    # Usage events of a day rated at once. Packets are consumed per device and service in time order, the rest is
+    # priced by the pricing matrix and debited from balances until they run out. Nothing is paid or connected between
+    # the events, so packets and balances only decrease and both can be computed with cumulative sums.
+    # Money is counted in integer units of the smallest cost digit, so the results are the same as with decimals.
+    def __init__(self, pricing):
+        self.pricing = pricing
+        use_costs = [Decimal(cost.use_cost or 0) for cost in pricing.costs]
+        self.places = get_money_places(use_costs)
+        # Two zeros for the negative indexes of unresolved costs
+        self.cost_units = np.array([int(cost.scaleb(self.places)) for cost in use_costs] + [0, 0], dtype=np.int64)
+
+    def to_units(self, amount):
+        # Rounded up, so "debited < headroom" in units is the same as in decimals
+        return int(Decimal(amount).scaleb(self.places).to_integral_value(rounding=ROUND_CEILING))
+
+    def to_money(self, units):
+        return Decimal(int(units)).scaleb(-self.places)
+
+    def consume_packets(self, groups, amounts, packet_groups, packet_left):
+        # Packets of every group are given in the order of consumption. Everything demanded up to an event is
+        # covered while the packets of its group last.
+        unpaid = amounts.copy()
+        packet_left = packet_left.copy()
+        groups_amount = max(groups.max(initial=-1), packet_groups.max(initial=-1))+1
+        capacities = group_sums(packet_left, packet_groups, groups_amount)
+
+        consuming = np.flatnonzero(groups >= 0)
+        consuming = consuming[np.argsort(groups[consuming], kind='stable')]
+        consuming_groups = groups[consuming]
+        demanded = group_cumsum(amounts[consuming], consuming_groups)
+        covered = np.minimum(demanded, capacities[consuming_groups])
+        covered_before = np.minimum(demanded-amounts[consuming], capacities[consuming_groups])
+        unpaid[consuming] -= covered-covered_before
+
+        used = np.minimum(group_sums(amounts[consuming], consuming_groups, groups_amount), capacities)
+        packet_order = np.argsort(packet_groups, kind='stable')
+        ordered_groups = packet_groups[packet_order]
+        filled_before = group_cumsum(packet_left[packet_order], ordered_groups)-packet_left[packet_order]
+        packet_left[packet_order] -= np.clip(used[ordered_groups]-filled_before, 0, packet_left[packet_order])
+        return unpaid, packet_left
+
+    def debit_balances(self, balances, debts, headrooms):
+        # Balance pays while the sum debited before is below its headroom, then it is out of funds for the rest
+        order = np.argsort(balances, kind='stable')
+        debited_before = group_cumsum(debts[order], balances[order])-debts[order]
+        charged = np.empty(len(debts), dtype=bool)
+        charged[order] = debited_before < headrooms[balances[order]]
+        return charged, group_sums(debts[charged], balances[charged], len(headrooms))
+
+    def get_deferred(self, balances, result):
+        # Events of a balance after its first uncharged one. Handling of out of funds can replenish the balance, so
+        # they are rated again after it.
+        balances = np.asarray(balances, dtype=np.int64)
+        uncharged = result['billed'][~result['charged']]
+        first_uncharged = np.full(balances.max(initial=-1)+1, len(balances), dtype=np.int64)
+        np.minimum.at(first_uncharged, balances[uncharged], uncharged)
+        return np.arange(len(balances)) > first_uncharged[balances]
+
+    def rate(self, events, packet_groups, packet_left, headrooms):
+        # Events are dicts of arrays in time order: amount, is_free, service_id, operator_from_id, operator_to_id (-1
+        # without recipient), unlimited (not billed after packets), packets (group of packets, -1 without them) and
+        # balance (index of headroom). Headrooms are in units, packets left are in service units.
+        amounts = np.asarray(events['amount'], dtype=np.int64)
+        packets = np.asarray(events['packets'], dtype=np.int64)
+        balances = np.asarray(events['balance'], dtype=np.int64)
+        paid = ~np.asarray(events['is_free'], dtype=bool)
+
+        unpaid, packet_left = self.consume_packets(np.where(paid, packets, -1), np.where(paid, amounts, 0),
+                                                   np.asarray(packet_groups, dtype=np.int64),
+                                                   np.asarray(packet_left, dtype=np.int64))
+        unlimited = np.asarray(events['unlimited'], dtype=bool) & (packets >= 0)
+        billed = np.flatnonzero(paid & (unpaid > 0) & ~unlimited)
+        slowed = np.flatnonzero(paid & (unpaid > 0) & unlimited)
+
+        cost_indexes = self.pricing.get_cost_indexes(np.asarray(events['operator_from_id'])[billed],
+                                                     np.asarray(events['service_id'])[billed],
+                                                     np.asarray(events['operator_to_id'])[billed])
+        if (cost_indexes == PricingMatrix.NO_COST).any():
+            raise NoResultFound('No row was found for one()')
+        if (cost_indexes == PricingMatrix.MULTIPLE_COSTS).any():
+            raise MultipleResultsFound('Multiple rows were found for one()')
+
+        # Bill is written for the whole amount of the usage, not only for the part out of packets
+        debts = self.cost_units[cost_indexes]*amounts[billed]
+        charged, debits = self.debit_balances(balances[billed], debts, np.asarray(headrooms, dtype=np.int64))
+        return {
+            'billed': billed,
+            'slowed': slowed,
+            'debts': debts,
+            'charged': charged,
+            'packet_left': packet_left,
+            'debits': debits,
+        }
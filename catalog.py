@@ -0,0 +1,243 @@
+import numpy as np
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+
+from entities.location import *
+from entities.operator import *
+from entities.payment import *
+from entities.service import *
+
+
+def single(rows):
+    # Same contract as Query.one()
+    if not rows:
+        raise NoResultFound('No row was found for one()')
+    if len(rows) > 1:
+        raise MultipleResultsFound('Multiple rows were found for one()')
+    return rows[0]
+
+
+def add_to_index(index, key, row):
+    if key not in index:
+        index[key] = [row]
+    else:
+        index[key].append(row)
+
+
+class PricingMatrix:
+    # Costs compiled to one index array by service, sender operator and recipient operator, the last recipient
+    # column is for usages without recipient. Resolved as by the queries: the cost with the recipient operator,
+    # otherwise the single cost of the service and sender with any recipient, several matching costs are ambiguous.
+    # Memory is services * operators * (operators+1) int32 indexes and one dict entry per cost.
+    NO_COST = -1
+    MULTIPLE_COSTS = -2
+
+    def __init__(self, costs):
+        self.costs = list(costs)
+        self.service_ids = np.unique([cost.service_id for cost in self.costs]).astype(np.int64)
+        self.operator_ids = np.unique([cost.operator_from_id for cost in self.costs] +
+                                      [cost.operator_to_id for cost in self.costs
+                                       if cost.operator_to_id is not None]).astype(np.int64)
+        self.service_indexes = {int(service_id): i for i, service_id in enumerate(self.service_ids)}
+        self.operator_indexes = {int(operator_id): i for i, operator_id in enumerate(self.operator_ids)}
+        self.no_recipient = len(self.operator_ids)
+
+        shape = (len(self.service_ids), len(self.operator_ids))
+        exact = {}
+        counts = np.zeros(shape, dtype=np.int32)
+        fallback = np.full(shape, self.NO_COST, dtype=np.int32)
+        for i, cost in enumerate(self.costs):
+            service = self.service_indexes[cost.service_id]
+            operator_from = self.operator_indexes[cost.operator_from_id]
+            counts[service, operator_from] += 1
+            fallback[service, operator_from] = i
+            if cost.operator_to_id is not None:
+                key = (service, operator_from, self.operator_indexes[cost.operator_to_id])
+                exact[key] = self.MULTIPLE_COSTS if key in exact else i
+        fallback[counts > 1] = self.MULTIPLE_COSTS
+
+        self.cost_indexes = np.repeat(fallback[:, :, np.newaxis], len(self.operator_ids)+1, axis=2)
+        if exact:
+            keys = np.array(list(exact.keys()), dtype=np.int64)
+            self.cost_indexes[keys[:, 0], keys[:, 1], keys[:, 2]] = list(exact.values())
+
+    def get_cost(self, operator_from_id, service_id, operator_to_id=None):
+        service = self.service_indexes.get(service_id)
+        operator_from = self.operator_indexes.get(operator_from_id)
+        cost_index = self.NO_COST
+        if service is not None and operator_from is not None:
+            operator_to = self.operator_indexes.get(operator_to_id, self.no_recipient)
+            cost_index = self.cost_indexes[service, operator_from, operator_to]
+        if cost_index == self.NO_COST:
+            raise NoResultFound('No row was found for one()')
+        if cost_index == self.MULTIPLE_COSTS:
+            raise MultipleResultsFound('Multiple rows were found for one()')
+        return self.costs[cost_index]
+
+    def get_indexes(self, ids, known_ids, default):
+        # Ids out of the known ones get the default index
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(known_ids):
+            return np.full(ids.shape, default, dtype=np.int64)
+        indexes = np.minimum(np.searchsorted(known_ids, ids), len(known_ids)-1)
+        return np.where(known_ids[indexes] == ids, indexes, default)
+
+    def get_cost_indexes(self, operator_from_ids, service_ids, operator_to_ids=None):
+        # Recipient ids are -1 for usages without recipient, unresolved usages get negative indexes
+        if operator_to_ids is None:
+            operator_to_ids = np.full(np.shape(service_ids), -1)
+        services = self.get_indexes(service_ids, self.service_ids, -1)
+        operators_from = self.get_indexes(operator_from_ids, self.operator_ids, -1)
+        operators_to = self.get_indexes(operator_to_ids, self.operator_ids, self.no_recipient)
+        known = (services >= 0) & (operators_from >= 0)
+        cost_indexes = np.full(services.shape, self.NO_COST, dtype=np.int64)
+        cost_indexes[known] = self.cost_indexes[services[known], operators_from[known], operators_to[known]]
+        return cost_indexes
+
+
+class StaticCatalog:
+    # In-memory indexes of the rows that don't change after static data generation
+    def __init__(self, session, pricing=None):
+        # Pricing can be given by the parent process, so shards don't load costs
+        self.session = session
+
+        self.countries = {}
+        self.regions = {}
+        self.operators = {}
+        self.pricing = pricing
+        self.services = {}
+        self.tariffs = {}
+        self.phone_numbers = {}
+        self.payment_methods = {}
+
+        self.load()
+
+    def load(self):
+        country_names = {}
+        for country in self.session.query(Country):
+            self.countries[country.name] = country
+            country_names[country.id] = country.name
+
+        region_names = {}
+        for region in self.session.query(Region):
+            self.regions[(country_names.get(region.country_id), region.name)] = region
+            region_names[region.id] = region.name
+
+        for operator in self.session.query(MobileOperator):
+            key = (operator.name, country_names.get(operator.country_id), region_names.get(operator.region_id))
+            self.operators[key] = operator
+
+        if self.pricing is None:
+            self.pricing = PricingMatrix(self.session.query(Cost).order_by(Cost.id))
+
+        for service in self.session.query(Service).filter_by(in_archive=False):
+            indexes = [self.services]
+            if isinstance(service, Tariff):
+                indexes.append(self.tariffs)
+            for index in indexes:
+                for field, value in (('name', service.name), ('code', service.activation_code)):
+                    add_to_index(index, (field, value, service.mobile_operator_id), service)
+                    add_to_index(index, (field, value), service)
+
+        for phone_number in self.session.query(PhoneNumber).order_by(PhoneNumber.id):
+            self.add_phone_number(phone_number)
+
+        for payment_method in self.session.query(PaymentMethod):
+            self.payment_methods[(payment_method.type, payment_method.name)] = payment_method
+
+    def get_country(self, name):
+        try:
+            return self.countries[name]
+        except KeyError:
+            raise NoResultFound('Country %s is not found' % name)
+
+    def get_region(self, country_name, name):
+        try:
+            return self.regions[(country_name, name)]
+        except KeyError:
+            raise NoResultFound('Region %s (%s) is not found' % (name, country_name))
+
+    def get_operator(self, name, country_name, region_name=None):
+        try:
+            return self.operators[(name, country_name, region_name)]
+        except KeyError:
+            raise NoResultFound('Operator %s (%s, %s) is not found' % (name, country_name, region_name))
+
+    def get_cost(self, operator_from_id, service_id, operator_to_id=None):
+        return self.pricing.get_cost(operator_from_id, service_id, operator_to_id)
+
+    def get_service(self, service_type, operator_id, name=None, code=None):
+        index = self.tariffs if service_type == 'tariff' else self.services
+        key = ('name', name) if name else ('code', code)
+        regional_services = index.get(key + (operator_id,), [])
+        if regional_services:
+            return single(regional_services)
+        return single(index.get(key, []))
+
+    def get_phone_number(self, area_code, number):
+        return self.phone_numbers.get((str(area_code), number))
+
+    def add_phone_number(self, phone_number):
+        key = (str(phone_number.area_code), phone_number.number)
+        if key not in self.phone_numbers:
+            self.phone_numbers[key] = phone_number
+
+    def get_payment_method(self, method_type, name=None):
+        if name is None:
+            return single([method for (m_type, m_name), method in self.payment_methods.items()
+                           if m_type == method_type])
+        return self.payment_methods[(method_type, name)]
+
+
+class DeviceServiceIndex:
+    # Services of one device kept in memory, so usages don't query them from base.
+    # Changes are made on the rows themselves and written by the next flush.
+    def __init__(self, device_services):
+        self.device_services = []
+        self.active = {}
+        self.packets = {}
+
+        for device_service in device_services:
+            self.add(device_service)
+
+    def add(self, device_service):
+        self.device_services.append(device_service)
+        if device_service.is_activated:
+            self.index_active(device_service)
+
+    def index_active(self, device_service):
+        service = device_service.service
+        add_to_index(self.active, service.name, device_service)
+        if service.packet:
+            add_to_index(self.packets, service.packet.type, device_service)
+
+    def unindex_active(self, device_service):
+        service = device_service.service
+        self.active[service.name].remove(device_service)
+        if service.packet:
+            self.packets[service.packet.type].remove(device_service)
+
+    def find(self, service, **flags):
+        return [device_service for device_service in self.device_services
+                if device_service.service is service and
+                all(getattr(device_service, name) == value for name, value in flags.items())]
+
+    def get_active(self, service_name):
+        return single(self.active.get(service_name, []))
+
+    def get_packets(self, packet_type):
+        return list(self.packets.get(packet_type, []))
+
+    def activate(self, service):
+        for device_service in self.find(service, is_activated=False):
+            device_service.is_activated = True
+            self.index_active(device_service)
+
+    def deactivate(self, service, date):
+        for device_service in self.find(service, is_activated=True):
+            device_service.is_activated = False
+            device_service.date_to = date
+            self.unindex_active(device_service)
+
+    def set_blocked(self, service, is_blocked):
+        for device_service in self.find(service, is_blocked=not is_blocked):
+            device_service.is_blocked = is_blocked
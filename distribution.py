@@ -1,6 +1,55 @@
+import random
+
 import numpy as np
 
 
+class UniformBuffer:
+    # Pre-generated uniforms shared by all distributions, so scalar draws don't call NumPy every time
+    BUFFER_SIZE = 65536
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.size = size
+        self.buffer = np.empty(0, dtype=np.float64)
+        self.scalars = []
+        self.position = 0
+        self.scalar_position = 0
+
+    def reset(self):
+        self.buffer = np.empty(0, dtype=np.float64)
+        self.scalars = []
+        self.position = 0
+        self.scalar_position = 0
+
+    def next(self):
+        # Python floats are much cheaper to handle one by one than NumPy scalars
+        if self.scalar_position >= len(self.scalars):
+            self.scalars = np.random.random_sample(self.size).tolist()
+            self.scalar_position = 0
+        u = self.scalars[self.scalar_position]
+        self.scalar_position += 1
+        return u
+
+    def take(self, n):
+        if n > self.size:
+            return np.random.random_sample(n)
+        if self.position + n > len(self.buffer):
+            self.buffer = np.random.random_sample(self.size)
+            self.position = 0
+        uniforms = self.buffer[self.position:self.position+n]
+        self.position += n
+        return uniforms
+
+
+uniforms = UniformBuffer()
+
+
+def seed_random(value):
+    # Seeds all random sources used by simulation
+    random.seed(value)
+    np.random.seed(value)
+    uniforms.reset()
+
+
 class Distribution:
     def __init__(self, info):
         self.values_count = info['max_values']
@@ -19,6 +68,15 @@ class Distribution:
 
         self.normalize()
 
+        self.values_array = np.asarray(self.values)
+        if self.values_array.ndim != 1:
+            # Values are not scalars (e.g. lists), keeping them as objects
+            self.values_array = np.empty(len(self.values), dtype=object)
+            self.values_array[:] = self.values
+
+        self.alias_p, self.alias = self.build_alias_table(self.p)
+        self.alias_table = list(zip(self.alias_p.tolist(), self.alias.tolist()))
+
     @staticmethod
     def from_list(values_list):
         # TODO: Refactor from distributions_from_list
@@ -28,13 +86,59 @@ class Distribution:
     def from_dict(values_dict):
         return 1
 
+    @staticmethod
+    def build_alias_table(p):
+        # Vose's alias method: every column holds its own value with probability alias_p[i]
+        # and the value alias[i] otherwise, so a single uniform is enough for one draw
+        n = len(p)
+        scaled = p*n
+        alias_p = np.ones(n, dtype=np.float64)
+        alias = np.arange(n)
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            alias_p[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0-scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Leftovers are equal to 1 up to float error
+        for i in small+large:
+            alias_p[i] = 1.0
+            alias[i] = i
+
+        return alias_p, alias
+
+    def freeze(self):
+        # Shared instances must not be changed by their users
+        for array in (self.p, self.values_array, self.alias_p, self.alias):
+            array.flags.writeable = False
+
     def normalize(self):
-        # TODO: Handle situation when sum is not 1 (due to float error)
+        # Alias table doesn't require the sum to be exactly 1
         sum_p = np.sum(self.p)
         self.p /= sum_p
 
+    def get_index(self):
+        u = uniforms.next()*self.values_count
+        column = min(int(u), self.values_count-1)
+        column_p, column_alias = self.alias_table[column]
+        if u-column < column_p:
+            return column
+        return column_alias
+
+    def get_indices(self, n):
+        u = uniforms.take(n)*self.values_count
+        columns = np.minimum(u.astype(np.intp), self.values_count-1)
+        return np.where(u-columns < self.alias_p[columns], columns, self.alias[columns])
+
     def get_value(self, n=1, return_array=True):
         if return_array:
-            return np.random.choice(self.values, size=n, p=self.p)
+            return self.values_array[self.get_indices(n)]
         else:
-            return np.random.choice(self.values, p=self.p)
+            return self.values[self.get_index()]
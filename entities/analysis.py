@@ -0,0 +1,36 @@
+import sqlalchemy as db
+from sqlalchemy.orm import relationship
+from base import Base
+
+
+class Analysis(Base):
+    __tablename__ = 'analysis'
+
+    id = db.Column(db.Integer, primary_key=True, index=True)
+
+    date_from = db.Column(db.Date)
+    date_to = db.Column(db.Date)
+    created = db.Column(db.DateTime, default=db.func.now())
+
+    algorithm = db.Column(db.String)
+    # Pickled scalers and estimators of all levels with the device clusters, empty for DBSCAN
+    models = db.Column(db.LargeBinary)
+
+    assignments = relationship('ClusterAssignment')
+
+
+class ClusterAssignment(Base):
+    __tablename__ = 'clusterAssignment'
+    __table_args__ = (
+        db.CheckConstraint("level IN ('device', 'account', 'customer')"),
+        db.Index('ix_cluster_assignment_level', 'analysis_id', 'level'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, index=True)
+    analysis_id = db.Column(db.Integer, db.ForeignKey('analysis.id'))
+
+    level = db.Column(db.String)
+    entity_id = db.Column(db.Integer)
+    cluster = db.Column(db.Integer)
+
+    analysis = relationship('Analysis', uselist=False)
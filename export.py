@@ -0,0 +1,104 @@
+from datetime import date, datetime
+from decimal import Decimal
+import glob
+import gzip
+import json
+import os
+
+import sqlalchemy as db
+
+from base import Base
+
+BASE_FILE = 'base.ndjson.gz'
+ACTIVITY_FILE_FORMAT = 'activity-%Y-%m-%dT%H.ndjson.gz'
+ACTIVITY_FILES = 'activity-*.ndjson.gz'
+
+
+def encode_row(table, row):
+    # Dates and decimals are written as strings, they are parsed back by the types of columns
+    return json.dumps([table.name, row], default=str) + '\n'
+
+
+def get_converters(table):
+    converters = {}
+    for column in table.c:
+        if isinstance(column.type, db.DateTime):
+            converters[column.name] = datetime.fromisoformat
+        elif isinstance(column.type, db.Date):
+            converters[column.name] = date.fromisoformat
+        elif isinstance(column.type, db.Numeric) and not isinstance(column.type, db.Float):
+            converters[column.name] = Decimal
+    return converters
+
+
+def read_rows(file_name):
+    converters = {}
+    with gzip.open(file_name, 'rt') as rows_file:
+        for line in rows_file:
+            table_name, row = json.loads(line)
+            table = Base.metadata.tables[table_name]
+            if table not in converters:
+                converters[table] = get_converters(table)
+            for name, convert in converters[table].items():
+                if row.get(name) is not None:
+                    row[name] = convert(row[name])
+            yield table, row
+
+
+class ActivityExport:
+    # Test load written to files: static and preperiod rows go to one file, activity rows go to one file per hour.
+    # Activity comes in time order, so only the file of the current hour is open.
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for file_name in glob.glob(os.path.join(directory, ACTIVITY_FILES)):
+            os.remove(file_name)
+        self.base_file = gzip.open(os.path.join(directory, BASE_FILE), 'wt')
+        self.activity_file = None
+        self.activity_file_name = None
+        self.activity_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, table, rows):
+        self.base_file.writelines(encode_row(table, row) for row in rows)
+
+    def write_activity(self, event_date, table, row):
+        file_name = os.path.join(self.directory, event_date.strftime(ACTIVITY_FILE_FORMAT))
+        if file_name != self.activity_file_name:
+            if self.activity_file is not None:
+                self.activity_file.close()
+            self.activity_file = gzip.open(file_name, 'wt')
+            self.activity_file_name = file_name
+        self.activity_file.write(encode_row(table, row))
+        self.activity_rows += 1
+
+    def close(self):
+        self.base_file.close()
+        if self.activity_file is not None:
+            self.activity_file.close()
+            self.activity_file = None
+
+
+def iter_base_batches(directory, batch_size):
+    # Rows of the same table go in a row, they are grouped in batches for executemany
+    batch_table, batch = None, []
+    for table, row in read_rows(os.path.join(directory, BASE_FILE)):
+        if batch and (table is not batch_table or len(batch) >= batch_size):
+            yield batch_table, batch
+            batch = []
+        batch_table = table
+        batch.append(row)
+    if batch:
+        yield batch_table, batch
+
+
+def iter_activity(directory):
+    # Names of the hourly files are sorted in time order
+    for file_name in sorted(glob.glob(os.path.join(directory, ACTIVITY_FILES))):
+        for table, row in read_rows(file_name):
+            yield row['date_from'], table, row
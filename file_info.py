@@ -1,4 +1,4 @@
-from tools import file_to_json, file_to_config
+from tools import file_to_json, file_to_config, DistributionRegistry
 
 USER_GROUPS_FILE = 'data/clusters/customer_clusters.json'
 AGREEMENTS_FILE = 'data/clusters/agreement_clusters.json'
@@ -14,6 +14,8 @@ devices_info = file_to_json(DEVICES_FILE)
 distributions_info = file_to_json(DISTRIBUTIONS_FILE)
 out_of_funds_info = file_to_json(OUT_OF_FUNDS_FILE)
 
+distribution_registry = DistributionRegistry(distributions_info, out_of_funds_info)
+
 COUNTRIES_FILE_PATH = 'data/countries.json'
 OPERATORS_FILE_PATH = 'data/operators.json'
 TARIFFS_FILE_PATH = 'data/mts_tariffs.json'
@@ -6,17 +6,15 @@ import numpy as np
 from transliterate import translit
 
 from actions import *
-from distribution import Distribution
 from entities.customer import *
 from entities.location import *
 from entities.operator import *
 from entities.service import *
 from entities.payment import *
-from tools import distribution_from_list
 from random_data import *
 from preprocessor import TariffPreprocessor
-from file_info import distributions_info, countries_info, regions_info,\
-    operators_info, tariffs_info, services_info, out_of_funds_info
+from file_info import countries_info, regions_info, operators_info, tariffs_info, services_info,\
+    distribution_registry
 
 
 class MobileOperatorGenerator:
@@ -445,6 +443,7 @@ class AccountActivityGenerator(ActivityGenerator):
 
         self.sim_account = account
         self.distributions = {}
+        self.payment_days = None
 
         self.parse_activity()
 
@@ -452,45 +451,55 @@ class AccountActivityGenerator(ActivityGenerator):
         self.activity_info = self.sim_account.account_cluster_info['activity']
         payment_activity = self.activity_info['Payment']
 
-        method_distribution = distribution_from_list(distributions_info['method'][payment_activity['methods']])
-        self.distributions['method'] = method_distribution
-        sum_distribution = distribution_from_list(distributions_info['sum'][payment_activity['sums']])
-        self.distributions['sum'] = sum_distribution
+        self.distributions['method'] = distribution_registry.get_from_list('method', payment_activity['methods'])
+        self.distributions['sum'] = distribution_registry.get_from_list('sum', payment_activity['sums'])
 
         payment_period_activity = payment_activity['period_activity']
-        day_distribution_info = distributions_info['month'][payment_period_activity['days_activity']]
-        self.days_distribution['Payment'] = Distribution(info=day_distribution_info)
+        self.days_distribution['Payment'] = distribution_registry.get('month',
+                                                                      payment_period_activity['days_activity'])
 
     def generate_timeline(self, date_from, date_to):
-        actions = []
-        actions.extend(self.generate_payments(date_from, date_to))
+        # Account has the only stream of actions
+        return self.generate_payments(date_from, date_to)
 
-        return actions
+    def get_payment_days(self):
+        # Drawn once, so every window of the simulated period takes its days from the same schedule
+        if self.payment_days is None:
+            self.payment_days = self.get_amount_for_period('Payment')
+        return self.payment_days
 
     def generate_payments(self, date_from, date_to):
-        payments = []
-
+        # Yields payments in time order, generating them day by day
         method_distribution = self.distributions['method']
         sum_distribution = self.distributions['sum']
 
-        payment_days = self.get_amount_for_period('Payment')
+        payment_days = self.get_payment_days()
 
         cur_date = date_from
         while cur_date <= date_to:
             day_in_period = self.get_day_in_period(cur_date)
             amount = payment_days[day_in_period]
-            start_times = self.get_start_times(date=cur_date, amount=amount)
+            start_times = sorted(self.get_start_times(date=cur_date, amount=amount))
 
             for i in range(amount):
                 method = method_distribution.get_value(return_array=False).copy()
                 method_name, method_type = method.popitem()
                 payment_sum = int(sum_distribution.get_value(return_array=False))
-                payment = AccountPayment(self.sim_account, start_times[i], method_name, method_type, payment_sum)
-                payments.append(payment)
+                yield AccountPayment(self.sim_account, start_times[i], method_name, method_type, payment_sum)
 
             cur_date += timedelta(days=1)
 
-        return payments
+
+# Columnar representation of generated device actions. Recipient is an index in the generator lookup table
+# of the action kind: recipients for calls and messages, services, tariffs or destinations for other actions
+ACTION_DTYPE = np.dtype([('device', np.int32),
+                         ('kind', np.int8),
+                         ('timestamp', np.int64),  # Seconds since EPOCH
+                         ('duration', np.int32),  # Seconds
+                         ('amount', np.int32),  # Kilobytes for internet sessions
+                         ('recipient', np.int32)])
+
+EPOCH = datetime(1970, 1, 1)
 
 
 class DeviceActivityGenerator(ActivityGenerator):
@@ -499,71 +508,148 @@ class DeviceActivityGenerator(ActivityGenerator):
     basic_services = {'Call', 'Internet', 'SMS', 'MMS'}
     other_activities = {'Traveling', 'Tariff changing'}
 
-    def __init__(self, device, period_start_date):
-        super().__init__(period_start_date)
+    CALL, SMS, MMS, INTERNET, SERVICE, TARIFF_CHANGE, LOCATION_CHANGE = range(7)
+    SECONDS_IN_DAY = 86400
+    CALL_DURATION_ATTEMPTS = 33
 
-        self.sim_device = device
+    def __init__(self, devices, period_start_dates):
+        # All devices must share the same behavior cluster. Generator is kept for the whole simulated period, so
+        # usages of every tariff period are drawn once and windows take their share of them.
+        super().__init__(None)
+
+        self.sim_devices = devices
+        self.period_starts = np.array([period_start.toordinal() for period_start in period_start_dates],
+                                      dtype=np.int64)
+        self.period_usages = {}
         self.duration_distribution = {}
-        self.out_of_funds_distributions = {}
+        self.out_of_funds_distributions = None
+
+        self.recipients = []
+        self.services = []
+        self.tariffs = []
+        self.destinations = None
 
         self.parse_activity()
 
     def parse_activity(self):
-        basic_services_info = self.sim_device.behavior_info['Basic services']
-        other_services_info = self.sim_device.behavior_info['Other services']
-        other_activity_info = self.sim_device.behavior_info['Other activity']
+        behavior_info = self.sim_devices[0].behavior_info
+        basic_services_info = behavior_info['Basic services']
+        other_services_info = behavior_info['Other services']
+        other_activity_info = behavior_info['Other activity']
 
         for service_name in basic_services_info:
             service_info = basic_services_info[service_name]
             self.activity_info[service_name] = service_info
 
             service_activity = service_info['period_activity']
-            day_distribution_info = distributions_info['month'][service_activity['days_activity']]
-            self.days_distribution[service_name] = Distribution(info=day_distribution_info)
+            self.days_distribution[service_name] = distribution_registry.get('month',
+                                                                             service_activity['days_activity'])
 
             if 'duration' in service_activity:
-                dur_distribution_info = distributions_info['duration'][service_activity['duration']]
-                self.duration_distribution[service_name] = Distribution(info=dur_distribution_info)
+                self.duration_distribution[service_name] = distribution_registry.get('duration',
+                                                                                     service_activity['duration'])
 
         for service_name in other_services_info:
             # Writing service info
             service_info = other_services_info[service_name]
             self.activity_info[service_name] = service_info
 
-            # Creating distribution
+            # Getting shared distribution
             service_activity = service_info['period_activity']
-            day_distribution_info = distributions_info['month'][service_activity['days_activity']]
-            self.days_distribution[service_name] = Distribution(info=day_distribution_info)
+            self.days_distribution[service_name] = distribution_registry.get('month',
+                                                                             service_activity['days_activity'])
 
         for activity_name in other_activity_info:
             activity_info = other_activity_info[activity_name]
             self.activity_info[activity_name] = activity_info
 
             period_activity = activity_info['period_activity']
-            day_distribution_info = distributions_info['month'][period_activity['days_activity']]
-            self.days_distribution[activity_name] = Distribution(info=day_distribution_info)
-
-        # TODO: Static for all instances
-        for category_num in out_of_funds_info['trust_category']:
-            category = int(category_num)
-            category_activity = out_of_funds_info['trust_category'][category_num]
-            self.out_of_funds_distributions[category] = {}
-            for action_name in category_activity:
-                actions_info = category_activity[action_name]['actions']
-                action_distribution = distribution_from_list(actions_info)
-                self.out_of_funds_distributions[category][action_name] = action_distribution
+            self.days_distribution[activity_name] = distribution_registry.get('month',
+                                                                              period_activity['days_activity'])
 
-    def generate_timeline(self, date_from, date_to):
-        actions = []
-        actions.extend(self.generate_calls(date_from, date_to))
-        actions.extend(self.generate_messages(date_from, date_to))
-        actions.extend(self.generate_internet_usages(date_from, date_to))
+        self.out_of_funds_distributions = distribution_registry.get_out_of_funds()
 
-        actions.extend(self.generate_other_services(date_from, date_to))
-        actions.extend(self.generate_tariff_changes(date_from, date_to))
-        actions.extend(self.generate_location_changes(date_from, date_to))
+        self.recipients.append(self.get_recipient(None))
+        for service_name in self.activity_info:
+            if service_name not in (self.basic_services | self.other_activities):
+                self.services.append(service_name)
+        self.tariffs = self.activity_info['Tariff changing']['tariffs']
+        self.destinations = distribution_registry.get_from_list('destination',
+                                                                self.activity_info['Traveling']['destinations'])
+
+    def get_period_days(self, activity_name, period):
+        # Devices and days in the tariff period of their usages. Every device has its own tariff periods, so the
+        # period is their number since its start. Totals and days are drawn once per period for all devices.
+        periods = self.period_usages.setdefault(activity_name, {})
+        if period not in periods:
+            devices_count = len(self.sim_devices)
+            period_activity = self.activity_info[activity_name]['period_activity']
+            avg_amount = period_activity['amount']
+            max_deviation = period_activity['max_deviation']
+
+            lower_boundary = max(0, avg_amount-max_deviation)
+            higher_boundary = avg_amount+max_deviation
+
+            if higher_boundary < lower_boundary:
+                lower_boundary, higher_boundary = higher_boundary, lower_boundary
+
+            if lower_boundary == higher_boundary:
+                totals = np.full(devices_count, lower_boundary, dtype=np.int64)
+            else:
+                totals = np.random.randint(lower_boundary, higher_boundary, devices_count)
+
+            devices = np.repeat(np.arange(devices_count), totals)
+            usage_days = self.days_distribution[activity_name].get_value(n=len(devices)).astype(np.int64)
+            periods[period] = devices, usage_days
+        return periods[period]
+
+    def get_period_usages(self, activity_name, date_from, date_to):
+        # Returns device indices and usage timestamps of given activity for all devices at once
+        day_from, day_to = date_from.toordinal(), date_to.toordinal()
+        first_period = int((day_from-self.period_starts).min()) // self.PERIOD_DURATION
+        last_period = int((day_to-self.period_starts).max()) // self.PERIOD_DURATION
+
+        # Windows go in time order, so the periods before this one aren't needed anymore
+        periods = self.period_usages.setdefault(activity_name, {})
+        for period in [period for period in periods if period < first_period]:
+            del periods[period]
+
+        devices, days = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for period in range(first_period, last_period+1):
+            period_devices, usage_days = self.get_period_days(activity_name, period)
+            usage_dates = self.period_starts[period_devices] + period*self.PERIOD_DURATION + usage_days-1
+            in_window = (usage_dates >= day_from) & (usage_dates <= day_to)
+            devices.append(period_devices[in_window])
+            days.append(usage_dates[in_window])
+        devices, days = np.concatenate(devices), np.concatenate(days)
 
-        return actions
+        # TODO: Get from service distribution times
+        timestamps = (days-EPOCH.toordinal())*self.SECONDS_IN_DAY + \
+            np.random.randint(0, self.SECONDS_IN_DAY, len(devices))
+
+        return devices, timestamps
+
+    def make_activity(self, kind, devices, timestamps, duration=0, amount=0, recipient=0):
+        activity = np.zeros(len(devices), dtype=ACTION_DTYPE)
+        activity['device'] = devices
+        activity['kind'] = kind
+        activity['timestamp'] = timestamps
+        activity['duration'] = duration
+        activity['amount'] = amount
+        activity['recipient'] = recipient
+        return activity
+
+    def generate_activity(self, date_from, date_to):
+        activity = np.concatenate((self.generate_calls(date_from, date_to),
+                                   self.generate_messages(date_from, date_to),
+                                   self.generate_internet_usages(date_from, date_to),
+                                   self.generate_other_services(date_from, date_to),
+                                   self.generate_tariff_changes(date_from, date_to),
+                                   self.generate_location_changes(date_from, date_to)))
+
+        # Stable sort keeps original order of kinds for actions with the same time
+        order = np.lexsort((activity['timestamp'], activity['device']))
+        return activity[order]
 
     def get_recipient(self, distribution=None):
         # TODO: Real recipient generation using distribution
@@ -578,132 +664,61 @@ class DeviceActivityGenerator(ActivityGenerator):
         return recipient_info
 
     def generate_calls(self, date_from, date_to):
-        call_actions = []
-        call_day_usages = self.get_amount_for_period('Call')
-        call_duration_distribution = self.duration_distribution['Call']
-        out_of_funds = self.out_of_funds_distributions[self.sim_device.trust_category]['Call']
-
-        cur_date = date_from
-        while cur_date <= date_to:
-            day_in_period = self.get_day_in_period(cur_date)
-            amount = call_day_usages[day_in_period]
+        devices, timestamps = self.get_period_usages('Call', date_from, date_to)
+        order = np.lexsort((timestamps, devices))
+        devices, timestamps = devices[order], timestamps[order]
+        calls_count = len(devices)
 
-            start_times = self.get_start_times(date=cur_date, amount=amount)
-            start_times.sort()
-            deltas = [start_times[i+1]-start_times[i] for i in range(amount-1)] + [None]
+        # Calls of one device can't overlap during the day
+        days = timestamps // self.SECONDS_IN_DAY
+        has_next = (devices[1:] == devices[:-1]) & (days[1:] == days[:-1])
+        maximum_durations = np.zeros(calls_count, dtype=np.int64)
+        maximum_durations[:-1][has_next] = (timestamps[1:]-timestamps[:-1])[has_next]
 
-            for i in range(amount):
-                call = Call(self.sim_device, start_times[i], deltas[i],
-                            self.get_recipient(None), out_of_funds, can_overlap=False)
-                call.generate_duration(call_duration_distribution)
-                call_actions.append(call)
-
-            cur_date += timedelta(days=1)
-
-        return call_actions
+        call_duration_distribution = self.duration_distribution['Call']
+        durations = np.zeros(calls_count, dtype=np.int64)
+        pending = np.arange(calls_count)
+        for i in range(self.CALL_DURATION_ATTEMPTS):
+            if not len(pending):
+                break
+            minutes = call_duration_distribution.get_value(n=len(pending)).astype(np.int64)
+            durations[pending] = minutes*self.SECONDS_IN_MINUTE + np.random.randint(0, 60, len(pending))
+            limits = maximum_durations[pending]
+            pending = pending[(limits > 0) & (durations[pending] >= limits)]
+        # Fail safe - generating fail calls
+        durations[pending] = 1
+
+        return self.make_activity(self.CALL, devices, timestamps, duration=durations)
 
     def generate_messages(self, date_from, date_to):
-        message_actions = []
-        out_of_funds = self.out_of_funds_distributions[self.sim_device.trust_category]['Message']
-
-        for service in ('SMS', 'MMS'):
-            message_day_usages = self.get_amount_for_period(service)
-
-            cur_date = date_from
-            while cur_date <= date_to:
-                day_in_period = self.get_day_in_period(cur_date)
-                amount = message_day_usages[day_in_period]
-
-                start_times = self.get_start_times(date=cur_date, amount=amount)
-                for i in range(amount):
-                    message = Message(self.sim_device, start_times[i], service.lower(),
-                                      self.get_recipient(None), out_of_funds)
-                    message_actions.append(message)
-
-                cur_date += timedelta(days=1)
-
-        return message_actions
+        messages = []
+        for service, kind in (('SMS', self.SMS), ('MMS', self.MMS)):
+            devices, timestamps = self.get_period_usages(service, date_from, date_to)
+            messages.append(self.make_activity(kind, devices, timestamps))
+        return np.concatenate(messages)
 
     def generate_internet_usages(self, date_from, date_to):
-        internet_actions = []
-        internet_day_usages = self.get_amount_for_period('Internet')
+        devices, timestamps = self.get_period_usages('Internet', date_from, date_to)
         session_length_distribution = self.duration_distribution['Internet']
-        out_of_funds = self.out_of_funds_distributions[self.sim_device.trust_category]['Internet']
-
-        cur_date = date_from
-        while cur_date <= date_to:
-            day_in_period = self.get_day_in_period(cur_date)
-            amount = internet_day_usages[day_in_period]
-
-            start_times = self.get_start_times(date=cur_date, amount=amount)
-            for i in range(amount):
-                internet = Internet(self.sim_device, start_times[i], out_of_funds)
-                internet.generate_service_usage(session_length_distribution)
-                internet_actions.append(internet)
-
-            cur_date += timedelta(days=1)
-
-        return internet_actions
+        megabytes = session_length_distribution.get_value(n=len(devices)).astype(np.int64)
+        kilobytes = megabytes*1024 + np.random.randint(0, 1024, len(devices))
+        return self.make_activity(self.INTERNET, devices, timestamps, amount=kilobytes)
 
     def generate_other_services(self, date_from, date_to):
-        service_usages = []
         # TODO: Out of funds?
-
-        for service_name in self.activity_info:
-            if service_name not in (self.basic_services | self.other_activities):
-                info = self.activity_info[service_name]
-                activation_code = info['activation_code']
-                usage_type = info['type']
-                service_days = self.get_amount_for_period(service_name)
-
-                cur_date = date_from
-                while cur_date <= date_to:
-                    day_in_period = self.get_day_in_period(cur_date)
-                    amount = service_days[day_in_period]
-
-                    start_times = self.get_start_times(date=cur_date, amount=amount)
-                    for i in range(amount):
-                        service = OneTimeService(self.sim_device, start_times[i], service_name,
-                                                 activation_code, usage_type, None)
-                        service_usages.append(service)
-
-                    cur_date += timedelta(days=1)
-
-        return service_usages
+        service_usages = [np.zeros(0, dtype=ACTION_DTYPE)]
+        for service_index, service_name in enumerate(self.services):
+            devices, timestamps = self.get_period_usages(service_name, date_from, date_to)
+            service_usages.append(self.make_activity(self.SERVICE, devices, timestamps, recipient=service_index))
+        return np.concatenate(service_usages)
 
     def generate_tariff_changes(self, date_from, date_to):
-        tariff_changes = []
-
-        info = self.activity_info['Tariff changing']
-        potential_tariffs = info['tariffs']
-        change_days = self.get_amount_for_period('Tariff changing')
-        out_of_funds = self.out_of_funds_distributions[self.sim_device.trust_category]['TariffChange']
-
-        cur_date = date_from
-        while cur_date <= date_to:
-            day_in_period = self.get_day_in_period(cur_date)
-            amount = change_days[day_in_period]
-
-            start_times = self.get_start_times(date=cur_date, amount=amount)
-            new_tariffs = [random.choice(potential_tariffs) for _ in range(amount)]
+        devices, timestamps = self.get_period_usages('Tariff changing', date_from, date_to)
+        new_tariffs = np.random.randint(0, len(self.tariffs), len(devices))
+        return self.make_activity(self.TARIFF_CHANGE, devices, timestamps, recipient=new_tariffs)
 
-            for i in range(amount):
-                tariff_info = new_tariffs[i]
-                # FIXME: Delete after adding other tariffs
-                smart_mini_info = {'name': 'Smart mini', 'code': '*111*1023#'}
-                if tariff_info['name'] != 'Smart mini':
-                    tariff_info = smart_mini_info
-                change = TariffChange(self.sim_device, start_times[i], tariff_info['code'], tariff_info['name'],
-                                      out_of_funds)
-                tariff_changes.append(change)
-
-            cur_date += timedelta(days=1)
-
-        return tariff_changes
-
-    def get_location_from_macro(self, macro):
+    def get_location_from_macro(self, macro, home_location):
         # TODO: Full country lists
-        home_location = self.sim_device.home_region
         if macro == 'HOME_COUNTRY_REGION':
             if home_location['country'] == 'Russia':
                 return {'country': 'Russia', 'region': random.choice(self.russian_regions)}
@@ -717,25 +732,49 @@ class DeviceActivityGenerator(ActivityGenerator):
             return {'country': 'United States', 'region': None}
 
     def generate_location_changes(self, date_from, date_to):
-        location_changes = []
-
-        info = self.activity_info['Traveling']
-        destinations = distributions_info['destination'][info['destinations']]
-        dest_distribution = distribution_from_list(destinations)
-        travel_days = self.get_amount_for_period('Traveling')
-
-        cur_date = date_from
-        while cur_date <= date_to:
-            day_in_period = self.get_day_in_period(cur_date)
-            amount = travel_days[day_in_period]
-            start_times = self.get_start_times(date=cur_date, amount=amount)
-
-            new_locations = dest_distribution.get_value(n=amount)
-            for i in range(amount):
-                change = LocationChange(self.sim_device, start_times[i],
-                                        self.get_location_from_macro(new_locations[i]))
-                location_changes.append(change)
-
-            cur_date += timedelta(days=1)
-
-        return location_changes
+        devices, timestamps = self.get_period_usages('Traveling', date_from, date_to)
+        new_locations = self.destinations.get_indices(len(devices))
+        return self.make_activity(self.LOCATION_CHANGE, devices, timestamps, recipient=new_locations)
+
+    def make_action(self, record):
+        # Materializing action from its columnar record
+        sim_device = self.sim_devices[record['device']]
+        kind = record['kind']
+        start_date = EPOCH + timedelta(seconds=int(record['timestamp']))
+        out_of_funds = self.out_of_funds_distributions[sim_device.trust_category]
+
+        if kind == self.CALL:
+            call = Call(sim_device, start_date, None, self.recipients[record['recipient']],
+                        out_of_funds['Call'], can_overlap=False)
+            call.duration = timedelta(seconds=int(record['duration']))
+            return call
+        elif kind == self.SMS or kind == self.MMS:
+            message_type = 'sms' if kind == self.SMS else 'mms'
+            return Message(sim_device, start_date, message_type, self.recipients[record['recipient']],
+                           out_of_funds['Message'])
+        elif kind == self.INTERNET:
+            internet = Internet(sim_device, start_date, out_of_funds['Internet'])
+            internet.megabytes, internet.kilobytes = divmod(int(record['amount']), 1024)
+            return internet
+        elif kind == self.SERVICE:
+            service_name = self.services[record['recipient']]
+            info = self.activity_info[service_name]
+            return OneTimeService(sim_device, start_date, service_name,
+                                  info['activation_code'], info['type'], None)
+        elif kind == self.TARIFF_CHANGE:
+            tariff_info = self.tariffs[record['recipient']]
+            # FIXME: Delete after adding other tariffs
+            smart_mini_info = {'name': 'Smart mini', 'code': '*111*1023#'}
+            if tariff_info['name'] != 'Smart mini':
+                tariff_info = smart_mini_info
+            return TariffChange(sim_device, start_date, tariff_info['code'], tariff_info['name'],
+                                out_of_funds['TariffChange'])
+        else:
+            macro = self.destinations.values[record['recipient']]
+            return LocationChange(sim_device, start_date,
+                                  self.get_location_from_macro(macro, sim_device.home_region))
+
+    def iter_actions(self, activity):
+        # Activity must be sorted by time, actions are created only when they are consumed
+        for record in activity:
+            yield self.make_action(record)
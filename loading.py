@@ -1,15 +1,21 @@
 from datetime import date, datetime, timedelta
+from decimal import Decimal
+import hashlib
+import heapq
 import random
-from itertools import chain
 import numpy as np
+from scipy import sparse
 
-from sqlalchemy import and_, between
-from sqlalchemy.orm.session import make_transient
+from sqlalchemy import and_, select, bindparam, Table, MetaData, Column, Integer
 from entities.customer import *
 from entities.payment import *
 from entities.service import *
 from entities.location import *
 from entities.operator import *
+from base import Base
+from scheduler import ReplayPacer
+from export import ActivityExport, iter_base_batches, iter_activity
+from sampling import ActivitySampler
 
 import logging
 
@@ -21,166 +27,369 @@ import logging
 
 
 class LoadSimulator:
-    def __init__(self, main_session, test_session):
+    # Rows are copied with Core selects and executemany inserts of this size, without ORM objects
+    BATCH_SIZE = 10000
+
+    STATIC_ENTITIES = [Agreement, TermOrCondition, AgreementTermOrCondition, PaymentMethod, CalculationMethod,
+                       Country, Region, MobileOperator, PhoneNumber, Service, Cost, Packet, TariffServices]
+
+    def __init__(self, main_session, test_session, batch_size=BATCH_SIZE):
         self.main_session = main_session
         self.test_session = test_session
+        self.batch_size = batch_size
+        # Customer ids, feature names and event counts of the analyzed period
+        self.customers_activity = None
+
+    def get_entity_tables(self, entity):
+        # Tables of the entity and its subclasses, in order of dependencies
+        tables = {table for mapper in entity.__mapper__.self_and_descendants for table in mapper.tables}
+        return [table for table in Base.metadata.sorted_tables if table in tables]
 
-    def make_transient(self, obj):
-        make_transient(obj)
-        return obj
+    def iter_batches(self, query, session=None):
+        # Rows are read from the main base by default
+        session = self.main_session if session is None else session
+        result = session.connection().execute(query)
+        while True:
+            rows = result.fetchmany(self.batch_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
 
-    def detached_objects(self, objects, to_list=False):
-        if to_list:
-            return list(map(self.make_transient, objects))
+    def insert_rows(self, table, rows, target=None):
+        # Rows go to the test base, or to the target like export files
+        if not rows:
+            return
+        if target is None:
+            self.test_session.connection().execute(table.insert(), rows)
         else:
-            return map(self.make_transient, objects)
+            target.write(table, rows)
+
+    def copy_rows(self, table, query, target=None):
+        # Primary keys are kept, so copied rows reference each other as in the main base
+        ids = []
+        for rows in self.iter_batches(query):
+            self.insert_rows(table, rows, target)
+            if 'id' in table.c:
+                ids.extend(row['id'] for row in rows)
+        return ids
+
+    def copy_entity_rows(self, entity, *criteria, target=None):
+        # Rows of subclass tables share ids with the rows of the entity table
+        entity_table = entity.__table__
+        ids = self.copy_rows(entity_table, select([entity_table]).where(and_(*criteria)), target)
+        for table in self.get_entity_tables(entity):
+            if table is not entity_table:
+                self.copy_rows(table, select([table]).where(table.c.id.in_(ids)), target)
+        return ids
+
+    def get_static_tables(self):
+        tables = {table for entity in self.STATIC_ENTITIES for table in self.get_entity_tables(entity)}
+        return [table for table in Base.metadata.sorted_tables if table in tables]
 
-    def copy_static_data(self):
+    def copy_static_data(self, target=None):
+        # Test base is synchronized, other targets get all the rows
+        if target is None:
+            self.sync_static_data()
+            return
         print('Copying static data')
-        agreements = self.detached_objects(self.main_session.query(Agreement).all())
-        terms = self.detached_objects(self.main_session.query(TermOrCondition).all())
-        payment_methods = self.detached_objects(self.main_session.query(PaymentMethod).all())
-        calc_methods = self.detached_objects(self.main_session.query(CalculationMethod).all())
-        countries = self.detached_objects(self.main_session.query(Country).all())
-        regions = self.detached_objects(self.main_session.query(Region).all())
-        operators = self.detached_objects(self.main_session.query(MobileOperator).all())
-        phone_numbers = self.detached_objects(self.main_session.query(PhoneNumber).all())
-        services = self.detached_objects(self.main_session.query(Service).all())
-        costs = self.detached_objects(self.main_session.query(Cost).all())
-
-        self.test_session.add_all(chain(agreements, terms, payment_methods, calc_methods,
-                                        countries, regions, operators, phone_numbers, services, costs))
-
-    def copy_preperiod_customers_data(self, customer_ids, period_start):
+        for table in self.get_static_tables():
+            self.copy_rows(table, select([table]), target)
+
+    def get_row_key(self, table, row):
+        return tuple(row[column.name] for column in table.primary_key)
+
+    def get_row_digest(self, row):
+        # Decimals are normalized, so the same values read from different databases have the same digest
+        values = tuple(value.normalize() if isinstance(value, Decimal) else value for value in row.values())
+        return hashlib.md5(repr(values).encode()).digest()
+
+    def get_table_digests(self, table, batches):
+        # Digests of rows by their primary keys and fingerprint of the table: amount of rows and their checksum.
+        # Checksum goes over the sorted keys, so it doesn't depend on the order of rows in batches.
+        digests = {}
+        for rows in batches:
+            for row in rows:
+                digests[self.get_row_key(table, row)] = self.get_row_digest(row)
+        checksum = hashlib.md5()
+        for key in sorted(digests):
+            checksum.update(digests[key])
+        return digests, (len(digests), checksum.hexdigest())
+
+    def get_table_batches(self, table, session):
+        return self.iter_batches(select([table]).order_by(*table.primary_key), session)
+
+    def sync_static_data(self, source_batches=None):
+        # Only missing, changed and deleted rows of static tables are copied, so repeated loads skip them.
+        # Rows come from the main base, or from the source giving batches of rows of a table.
+        print('Synchronizing static data')
+        if source_batches is None:
+            source_batches = lambda table: self.get_table_batches(table, self.main_session)
+        test_connection = self.test_session.connection()
+
+        changes = []
+        for table in self.get_static_tables():
+            main_digests, main_fingerprint = self.get_table_digests(table, source_batches(table))
+            test_digests, test_fingerprint = self.get_table_digests(table,
+                                                                    self.get_table_batches(table, self.test_session))
+            if main_fingerprint == test_fingerprint:
+                continue
+            inserted = [key for key, digest in main_digests.items() if key not in test_digests]
+            updated = [key for key, digest in main_digests.items()
+                       if key in test_digests and test_digests[key] != digest]
+            deleted = [key for key in test_digests if key not in main_digests]
+            changes.append((table, inserted, updated, deleted))
+            print('%s: %d new, %d changed, %d deleted rows' % (table.name, len(inserted), len(updated), len(deleted)))
+
+        if not changes:
+            print('Static data is up to date')
+            return
+
+        # Rows are deleted before the rows they reference and inserted after them
+        for table, _, _, deleted in reversed(changes):
+            key_filter = and_(*[column == bindparam('_' + column.name) for column in table.primary_key])
+            if deleted:
+                test_connection.execute(table.delete().where(key_filter),
+                                        [{'_' + column.name: value for column, value in zip(table.primary_key, key)}
+                                         for key in deleted])
+        for table, inserted, updated, _ in changes:
+            key_filter = and_(*[column == bindparam('_' + column.name) for column in table.primary_key])
+            inserted, updated = set(inserted), set(updated)
+            for rows in source_batches(table):
+                self.insert_rows(table, [row for row in rows if self.get_row_key(table, row) in inserted])
+                updates = [dict(row, **{'_' + column.name: row[column.name] for column in table.primary_key})
+                           for row in rows if self.get_row_key(table, row) in updated]
+                if updates:
+                    test_connection.execute(table.update().where(key_filter), updates)
+
+    def clear_loaded_data(self):
+        # Rows of the previous test load, static data is kept for the next one
+        static_tables = set(self.get_static_tables())
+        connection = self.test_session.connection()
+        for table in reversed(Base.metadata.sorted_tables):
+            if table not in static_tables:
+                connection.execute(table.delete())
+
+    def copy_preperiod_customers_data(self, customer_ids, period_start, target=None):
         print('Copying preperiod data')
         period_start_date = datetime(period_start.year, period_start.month, period_start.day, 0, 0, 0)
-        customers = self.detached_objects(self.main_session.query(Customer).
-                                          filter(and_(Customer.id.in_(customer_ids),
-                                                      Customer.date_from < period_start_date)).all(), to_list=True)
-
-        agreements = self.detached_objects(self.main_session.query(CustomerAgreement).
-                                           filter(and_(CustomerAgreement.customer_id.in_(customer_ids),
-                                                       CustomerAgreement.date_from < period_start_date)).all(),
-                                           to_list=True)
-        agreement_ids = [agreement.id for agreement in agreements]
-
-        accounts = self.detached_objects(self.main_session.query(Account).
-                                         filter(and_(Account.agreement_id.in_(agreement_ids),
-                                                     Account.date_from < period_start_date)).all(), to_list=True)
-        account_ids = [account.id for account in accounts]
-
-        balances = self.detached_objects(self.main_session.query(Balance).
-                                         filter(and_(Balance.account_id.in_(account_ids),
-                                                     Balance.date_from < period_start_date)).all(), to_list=True)
-
-        devices = self.detached_objects(self.main_session.query(Device).
-                                        filter(and_(Device.account_id.in_(account_ids),
-                                                    Device.date_from < period_start_date)).all(), to_list=True)
-        device_ids = [device.id for device in devices]
-
-        locations = self.detached_objects(self.main_session.query(Location)
-                                          .join(Device, Device.id == Location.device_id)
-                                          .filter(and_(Device.id.in_(device_ids),
-                                                       Location.date_from < period_start_date)).all(), to_list=True)
-
-        device_services = self.detached_objects(self.main_session.query(DeviceService).
-                                                filter(and_(DeviceService.device_id.in_(device_ids),
-                                                            DeviceService.date_from < period_start_date)).all(),
-                                                to_list=True)
-
-        requests = self.detached_objects(self.main_session.query(Request).
-                                         filter(and_(Request.device_id.in_(device_ids),
-                                                     Request.date_from < period_start_date)).all(), to_list=True)
-
-        self.test_session.add_all(chain(customers, agreements, accounts, balances,
-                                        devices, locations, device_services, requests))
-
-    def copy_period_activity(self, customer_ids, date_from, date_to):
+
+        customer_ids = self.copy_entity_rows(Customer, Customer.id.in_(customer_ids),
+                                             Customer.date_from < period_start_date, target=target)
+        info_ids = select([Individual.info_id]).where(Individual.id.in_(customer_ids))
+        self.copy_rows(IndividualInfo.__table__, select([IndividualInfo.__table__]).
+                       where(IndividualInfo.id.in_(info_ids)), target)
+
+        agreement_ids = self.copy_entity_rows(CustomerAgreement, CustomerAgreement.customer_id.in_(customer_ids),
+                                              CustomerAgreement.date_from < period_start_date, target=target)
+        account_ids = self.copy_entity_rows(Account, Account.agreement_id.in_(agreement_ids),
+                                            Account.date_from < period_start_date, target=target)
+        self.copy_entity_rows(Balance, Balance.account_id.in_(account_ids), Balance.date_from < period_start_date,
+                              target=target)
+
+        device_ids = self.copy_entity_rows(Device, Device.account_id.in_(account_ids),
+                                           Device.date_from < period_start_date, target=target)
+        self.copy_entity_rows(Location, Location.device_id.in_(device_ids), Location.date_from < period_start_date,
+                              target=target)
+        self.copy_entity_rows(DeviceService, DeviceService.device_id.in_(device_ids),
+                              DeviceService.date_from < period_start_date, target=target)
+        self.copy_entity_rows(Request, Request.device_id.in_(device_ids), Request.date_from < period_start_date,
+                              target=target)
+
+    def create_devices_table(self, customer_ids):
+        # Devices of selected customers are joined from the temporary table instead of long IN lists
+        devices = Table('copiedDevices', MetaData(), Column('id', Integer, primary_key=True),
+                        prefixes=['TEMPORARY'])
+        connection = self.main_session.connection()
+        devices.create(connection)
+        connection.execute(devices.insert().from_select(
+            ['id'], select([Device.id]).
+            select_from(Device.__table__.
+                        join(Account.__table__, Account.id == Device.account_id).
+                        join(CustomerAgreement.__table__, CustomerAgreement.id == Account.agreement_id)).
+            where(CustomerAgreement.customer_id.in_(customer_ids))))
+        return devices
+
+    def stream_rows(self, table, query):
+        # Server side cursor where it's supported, rows are fetched by batches
+        query = query.execution_options(stream_results=True)
+        for rows in self.iter_batches(query):
+            for row in rows:
+                yield row['date_from'], table, row
+
+    def get_activity_streams(self, devices, start_date, end_date):
+        def in_period(column):
+            return and_(column >= start_date, column < end_date)
+
+        device_services = DeviceService.__table__.join(devices, devices.c.id == DeviceService.device_id)
+        device_accounts = select([Device.account_id]).select_from(Device.__table__.
+                                                                  join(devices, devices.c.id == Device.id))
+        queries = [
+            (DeviceService.__table__, select([DeviceService.__table__]).select_from(device_services).
+             where(in_period(DeviceService.date_from)).order_by(DeviceService.date_from)),
+            (Balance.__table__, select([Balance.__table__]).
+             where(and_(Balance.account_id.in_(device_accounts), in_period(Balance.date_from))).
+             order_by(Balance.date_from)),
+            (Location.__table__, select([Location.__table__]).
+             select_from(Location.__table__.join(devices, devices.c.id == Location.device_id)).
+             where(in_period(Location.date_from)).order_by(Location.date_from)),
+            (Request.__table__, select([Request.__table__]).
+             select_from(Request.__table__.join(devices, devices.c.id == Request.device_id)).
+             where(in_period(Request.date_from)).order_by(Request.date_from)),
+            (ServiceLog.__table__, select([ServiceLog.__table__]).
+             select_from(ServiceLog.__table__.join(device_services,
+                                                   DeviceService.id == ServiceLog.device_service_id)).
+             where(in_period(ServiceLog.date_from)).order_by(ServiceLog.date_from)),
+            (Bill.__table__, select([Bill.__table__]).
+             select_from(Bill.__table__.
+                         join(ServiceLog.__table__, ServiceLog.id == Bill.service_log_id).
+                         join(device_services, DeviceService.id == ServiceLog.device_service_id)).
+             where(and_(in_period(Bill.date_from), in_period(ServiceLog.date_from))).order_by(Bill.date_from)),
+        ]
+        return [self.stream_rows(table, query) for table, query in queries]
+
+    def write_batch(self, batch, pacer=None, last_date=None):
+        # Rows are in time order inside of every table, tables go in order of dependencies
+        count = sum(len(rows) for rows in batch.values())
+        for table in Base.metadata.sorted_tables:
+            self.insert_rows(table, batch.pop(table, None))
+
+        # Replayed rows must be visible to the test system as soon as they are written
+        if pacer is not None and count:
+            self.test_session.commit()
+            pacer.emitted(last_date, count)
+        return count
+
+    def iter_period_activity(self, customer_ids, date_from, date_to):
         start_date = datetime(date_from.year, date_from.month, date_from.day, 0, 0, 0)
         end_date = datetime(date_to.year, date_to.month, date_to.day, 0, 0, 0) + timedelta(days=1)
 
-        window_hours = 4
-
-        step = timedelta(hours=window_hours)
-        window_begin = start_date
-        window_end = window_begin + timedelta(hours=window_hours)
-
-        devices = self.detached_objects(self.main_session.query(Device)
-                                        .join(Account, Account.id == Device.id)
-                                        .join(CustomerAgreement, CustomerAgreement.id == Account.agreement_id)
-                                        .join(Customer, Customer.id == CustomerAgreement.customer_id)
-                                        .filter(Customer.id.in_(customer_ids)).all(), to_list=True)
-        device_ids = [device.id for device in devices]
-
-        while window_end <= end_date:
-            print('Copying activity from %s to %s' % (window_begin, window_end))
-
-            logs = self.detached_objects(self.main_session.query(ServiceLog)
-                                         .join(DeviceService, DeviceService.id == ServiceLog.device_service_id)
-                                         .join(Device, Device.id == DeviceService.device_id)
-                                         .filter(and_(between(ServiceLog.date_from,
-                                                              window_begin, window_end),
-                                                      Device.id.in_(device_ids))).all(), to_list=True)
-            log_ids = [log.id for log in logs]
-            bills = self.detached_objects(self.main_session.query(Bill)
-                                          .filter(and_(between(Bill.date_from, window_begin, window_end),
-                                                       Bill.service_log_id.in_(log_ids))).all(), to_list=True)
-            locations = self.detached_objects(self.main_session.query(Location)
-                                              .join(Device, Device.id == Location.device_id)
-                                              .filter(and_(Device.id.in_(device_ids),
-                                                           between(Location.date_from,
-                                                                   window_begin, window_end))).all(), to_list=True)
-            requests = self.detached_objects(self.main_session.query(Request)
-                                             .join(Device, Device.id == Request.device_id)
-                                             .filter(and_(Device.id.in_(device_ids),
-                                                          between(Request.date_from,
-                                                                  window_begin, window_end))).all(), to_list=True)
-            device_services = self.detached_objects(self.main_session.query(DeviceService)
-                                                    .join(Device, Device.id == DeviceService.device_id)
-                                                    .filter(and_(Device.id.in_(device_ids),
-                                                                 between(DeviceService.date_from,
-                                                                         window_begin, window_end))).all(),
-                                                    to_list=True)
-            balances = self.detached_objects(self.main_session.query(Balance)
-                                             .join(Account, Account.id == Balance.account_id)
-                                             .join(Device, Device.account_id == Account.id)
-                                             .filter(and_(Device.id.in_(device_ids),
-                                                          between(DeviceService.date_from,
-                                                                  window_begin, window_end))).all(), to_list=True)
-
-            entities = list(chain(logs, bills, locations, requests, device_services, balances))
-
-            if entities:
-                # Shifting dates
-                delta = date.today()-entities[0].date_from.date()
-                for entity in entities:
-                    entity.date_from += delta
-                    # FIXME: TypeError: unsupported operand type(s) for +=: 'NoneType' and 'datetime.timedelta'
-                    # if hasattr(entity, 'date_to'):
-                    #     entity.date_to += delta
-
-                # TODO: Add entities according their time
-                self.test_session.add_all(entities)
-                self.test_session.flush()
-
-            window_begin += step
-            window_end += step
+        devices = self.create_devices_table(customer_ids)
+        try:
+            # Every stream is ordered by time, so merged rows come in the order they happened
+            yield from heapq.merge(*self.get_activity_streams(devices, start_date, end_date),
+                                   key=lambda item: item[0])
+        finally:
+            devices.drop(self.main_session.connection())
+
+    def replay_activity(self, activity, pacer=None):
+        delta = None
+        replay_start, first_date = None, None
+        batch = {}
+        batch_size = 0
+        copied = 0
+        last_date = None
+        for event_date, table, row in activity:
+            # Replayed events that are already due are written before waiting for the next one
+            if batch_size and (batch_size >= self.batch_size or
+                               pacer is not None and pacer.get_delay(event_date) > 0):
+                copied += self.write_batch(batch, pacer, last_date)
+                batch_size = 0
+            if pacer is not None:
+                pacer.wait(event_date)
+
+            if pacer is None:
+                # Copied activity is shifted by whole days to the current date
+                if delta is None:
+                    delta = date.today()-event_date.date()
+                row['date_from'] += delta
+                if row.get('date_to') is not None:
+                    row['date_to'] += delta
+            else:
+                # Replayed events get the time they are emitted at, their spacing is divided by the speedup
+                if replay_start is None:
+                    replay_start, first_date = datetime.now(), event_date
+                row['date_from'] = replay_start+(row['date_from']-first_date)/pacer.speedup
+                if row.get('date_to') is not None:
+                    row['date_to'] = replay_start+(row['date_to']-first_date)/pacer.speedup
+
+            batch.setdefault(table, []).append(row)
+            batch_size += 1
+            last_date = event_date
+        copied += self.write_batch(batch, pacer, last_date)
+        return copied
+
+    def copy_period_activity(self, customer_ids, date_from, date_to, pacer=None):
+        if pacer is None:
+            print('Copying activity from %s to %s' % (date_from, date_to))
+        else:
+            print('Replaying activity from %s to %s with speedup %g' % (date_from, date_to, pacer.speedup))
+        copied = self.replay_activity(self.iter_period_activity(customer_ids, date_from, date_to), pacer)
+        print('Copied %d activity rows' % copied)
+
+    def get_activity_counts(self, customer_ids):
+        # Rows of analyzed activity for given customers, customers that weren't analyzed have no events
+        if self.customers_activity is None:
+            return sparse.csr_matrix((len(customer_ids), 0)), []
+        activity_ids, feature_names, activity = self.customers_activity
+        activity_ids = np.asarray(activity_ids, dtype=np.int64)
+        positions = np.searchsorted(activity_ids, customer_ids).clip(max=max(len(activity_ids)-1, 0))
+        known = np.flatnonzero(activity_ids[positions] == customer_ids) if len(activity_ids) else np.empty(0, int)
+        rows = sparse.coo_matrix((np.ones(len(known)), (known, positions[known])),
+                                 shape=(len(customer_ids), len(activity_ids))).tocsr()
+        return rows @ activity, feature_names
 
     def select_subset_of_customers(self, customer_clusters, load_factor):
-        customer_ids = []
-        for cluster_num in customer_clusters:
-            cluster_size = len(customer_clusters[cluster_num])
-            smaller_size = int(cluster_size*load_factor)
-            ids = np.random.choice(customer_clusters[cluster_num], size=smaller_size, replace=False).tolist()
-            customer_ids.extend(ids)
-        return customer_ids
-
-    def copy_activity(self, customer_clusters, load_factor, date_from, date_to):
+        # Stratified by clusters, with the analyzed activity selected customers reproduce its profile too
+        customer_ids = np.array([customer_id for ids in customer_clusters.values() for customer_id in ids],
+                                dtype=np.int64)
+        clusters = np.repeat(np.arange(len(customer_clusters)), [len(ids) for ids in customer_clusters.values()])
+        counts, feature_names = self.get_activity_counts(customer_ids)
+
+        sampler = ActivitySampler(counts, feature_names, clusters)
+        selected = sampler.sample(load_factor)
+        if feature_names:
+            sampler.print_report(sampler.get_report(selected, load_factor))
+        return customer_ids[selected].tolist()
+
+    def copy_activity(self, customer_clusters, load_factor, date_from, date_to, speedup=None):
+        # With speedup activity is replayed in its own time instead of copying at once
         customer_ids = self.select_subset_of_customers(customer_clusters, load_factor)
 
+        self.clear_loaded_data()
         self.copy_static_data()
         self.test_session.flush()
         self.copy_preperiod_customers_data(customer_ids, date_from)
         self.test_session.commit()
-        self.copy_period_activity(customer_ids, date_from, date_to)
+        pacer = ReplayPacer(speedup) if speedup else None
+        self.copy_period_activity(customer_ids, date_from, date_to, pacer)
+        self.test_session.commit()
+        if pacer is not None:
+            pacer.report()
+
+    def export_activity(self, customer_clusters, load_factor, date_from, date_to, directory):
+        # Exported load can be replayed many times without the main base, dates are kept as they are
+        customer_ids = self.select_subset_of_customers(customer_clusters, load_factor)
+
+        with ActivityExport(directory) as export:
+            self.copy_static_data(export)
+            self.copy_preperiod_customers_data(customer_ids, date_from, export)
+            print('Exporting activity from %s to %s' % (date_from, date_to))
+            for event_date, table, row in self.iter_period_activity(customer_ids, date_from, date_to):
+                export.write_activity(event_date, table, row)
+        print('Exported %d activity rows to %s' % (export.activity_rows, directory))
+
+    def replay_export(self, directory, speedup=None):
+        # Previous load is cleared and static tables are synchronized with the exported ones, so an export can be
+        # replayed many times and after copied loads
+        static_tables = set(self.get_static_tables())
+        static_rows = {}
+        for table, rows in iter_base_batches(directory, self.batch_size):
+            if table in static_tables:
+                static_rows.setdefault(table, []).extend(rows)
+
+        self.clear_loaded_data()
+        self.sync_static_data(lambda table: [static_rows.get(table, [])])
+        self.test_session.flush()
+        print('Loading exported preperiod data')
+        for table, rows in iter_base_batches(directory, self.batch_size):
+            if table not in static_tables:
+                self.insert_rows(table, rows)
+        self.test_session.commit()
+
+        pacer = ReplayPacer(speedup) if speedup else None
+        print('Replaying exported activity')
+        copied = self.replay_activity(iter_activity(directory), pacer)
         self.test_session.commit()
+        print('Replayed %d activity rows' % copied)
+        if pacer is not None:
+            pacer.report()
@@ -1,8 +1,10 @@
+from argparse import ArgumentParser
 from datetime import timedelta
 
 from operator_simulation import MobileOperatorSimulator
 from base import Base
-from user_input import get_period, get_load_factor, get_clustering_algorithm
+from analyzer import ActivityAnalyzer
+from user_input import get_period, get_load_factor, get_clustering_algorithm, get_sweep_algorithms
 
 
 def print_menu():
@@ -16,12 +18,38 @@ def print_menu():
     print('7. Clear main base data')
     print('8. Clean test base data')
     print('9. Change period')
+    print('10. Sweep clustering parameters on main base')
+    print('11. Export decreased activity to files')
+    print('12. Replay exported activity to test base')
     print('0. Exit')
 
 
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes simulating customers or fitting sweep configurations in parallel')
+    parser.add_argument('--analysis-chunk-size', type=int, default=0,
+                        help='number of devices read at once by streaming analysis (0 - analyze all at once)')
+    parser.add_argument('--replay-speedup', type=float, default=0,
+                        help='how many times faster than real time test load is replayed (0 - copy at once)')
+    parser.add_argument('--export-dir', default='export',
+                        help='directory decreased activity is exported to and replayed from')
+    parser.add_argument('--headless', action='store_true',
+                        help='don\'t plot analysis results and print metrics as JSON')
+    parser.add_argument('--metrics-file',
+                        help='file JSON metrics of headless analysis are appended to')
+    parser.add_argument('--silhouette-sample-size', type=int, default=ActivityAnalyzer.SILHOUETTE_SAMPLE_SIZE,
+                        help='number of rows silhouette is computed on (0 - all rows)')
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     base_schema = Base.metadata
     simulator = MobileOperatorSimulator(base_schema)
+    simulator.analyzer.headless = args.headless
+    simulator.analyzer.metrics_file = args.metrics_file
+    simulator.analyzer.silhouette_sample_size = args.silhouette_sample_size
     period_start = None
     period_end = None
     algorithm = None
@@ -37,30 +65,41 @@ def main():
         elif choice == '3':
             if not period_start:
                 period_start, period_end = get_period()
-            simulator.simulate_period(period_start, period_end)
+            simulator.simulate_period(period_start, period_end, workers=args.workers)
         elif choice == '4':
             if not period_start:
                 period_start, period_end = get_period()
             if not algorithm:
                 algorithm = get_clustering_algorithm()
-            simulator.analyze_data(period_start, period_end, 'main', algorithm)
+            simulator.analyze_data(period_start, period_end, 'main', algorithm, args.analysis_chunk_size)
         elif choice == '5':
             if not period_start:
                 period_start, period_end = get_period()
             factor = get_load_factor()
-            simulator.generate_test_load(period_start, period_end, factor)
+            simulator.generate_test_load(period_start, period_end, factor, args.replay_speedup)
         elif choice == '6':
             if not period_start:
                 period_start, period_end = get_period()
             if not algorithm:
                 algorithm = get_clustering_algorithm()
-            simulator.analyze_data(period_start, period_end, 'test', algorithm)
+            simulator.analyze_data(period_start, period_end, 'test', algorithm, args.analysis_chunk_size)
         elif choice == '7':
             simulator.clear_main_base_data()
         elif choice == '8':
             simulator.clear_test_base_data()
         elif choice == '9':
             period_start, period_end = get_period()
+        elif choice == '10':
+            if not period_start:
+                period_start, period_end = get_period()
+            simulator.sweep_clustering(period_start, period_end, 'main', get_sweep_algorithms(), args.workers)
+        elif choice == '11':
+            if not period_start:
+                period_start, period_end = get_period()
+            factor = get_load_factor()
+            simulator.export_test_load(period_start, period_end, factor, args.export_dir)
+        elif choice == '12':
+            simulator.replay_test_load(args.export_dir, args.replay_speedup)
         elif choice == '0':
             return 0
         else:
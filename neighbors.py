@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import hashlib
+
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+
+def filter_graph(graph, radius):
+    # Keeps only neighbors within the radius, explicit zeros of duplicate points are kept too
+    rows = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    mask = graph.data <= radius
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[mask], minlength=graph.shape[0]))))
+    return sparse.csr_matrix((graph.data[mask], graph.indices[mask], indptr), shape=graph.shape)
+
+
+class RadiusNeighborsCache:
+    # Ball trees and radius neighbors graphs of the recently clustered matrices. Graph is kept for the largest
+    # radius asked, smaller ones are cut from it and larger ones are searched in the same tree.
+    MAX_SIZE = 3
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get_key(self, data):
+        data = np.ascontiguousarray(data)
+        return data.shape, hashlib.sha1(data.view(np.uint8)).hexdigest()
+
+    def get_graph(self, data, radius):
+        key = self.get_key(data)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            entry = [NearestNeighbors(algorithm='ball_tree').fit(data), None, None]
+        self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        index, graph, graph_radius = entry
+        if graph is None or graph_radius < radius:
+            # Points are their own neighbors, so DBSCAN finds the diagonal already stored
+            entry[1] = graph = index.radius_neighbors_graph(data, radius=radius, mode='distance')
+            entry[2] = graph_radius = radius
+        if graph_radius > radius:
+            graph = filter_graph(graph, radius)
+        return graph
+
+    def clear(self):
+        self.entries.clear()
+
+
+neighbors_cache = RadiusNeighborsCache()
+
+
+class IndexedDBSCAN:
+    # DBSCAN over the precomputed sparse graph, so neighbors aren't searched again for every eps
+    def __init__(self, eps=0.5, min_samples=5, cache=neighbors_cache):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.cache = cache
+
+    def __getstate__(self):
+        # Cache keeps ball trees and graphs of the fitted data, it's shared and not pickled
+        state = self.__dict__.copy()
+        del state['cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = neighbors_cache
+
+    def fit(self, data):
+        graph = self.cache.get_graph(data, self.eps)
+        self.estimator = DBSCAN(eps=self.eps, min_samples=self.min_samples, metric='precomputed').fit(graph)
+        self.labels_ = self.estimator.labels_
+        self.core_sample_indices_ = self.estimator.core_sample_indices_
+        return self
+
+    def fit_predict(self, data):
+        return self.fit(data).labels_
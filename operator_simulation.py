@@ -1,29 +1,40 @@
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from decimal import Decimal
+import multiprocessing
 from time import time
 import logging
 import os
 
-from sqlalchemy import create_engine, and_, or_
+import numpy as np
+
+from sqlalchemy import create_engine, and_, or_, inspect
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy.orm.exc import MultipleResultsFound
 
 from entities.customer import *
 from entities.location import *
 from entities.operator import *
 from entities.payment import *
 from entities.service import *
-from file_info import user_groups_info, agreements_info, accounts_info, devices_info, distributions_info, config_info
+from file_info import user_groups_info, agreements_info, accounts_info, devices_info, config_info,\
+    distribution_registry
 from generator import MobileOperatorGenerator, AccountActivityGenerator, DeviceActivityGenerator
-from distribution import Distribution
+from distribution import seed_random
 from random_data import *
-from tools import distribution_from_list
 from status import ServiceStatus
 from analyzer import ActivityAnalyzer
 from loading import LoadSimulator
+from scheduler import SimulationScheduler, UsageBatch
+from catalog import StaticCatalog, DeviceServiceIndex
+from billing import BatchBilling
+from writer import WriteBuffer
+from allocator import IdAllocator
+from parallel import get_max_ids, take_static_snapshot, take_shard_snapshot, load_snapshot, diff_snapshot,\
+    merge_changes, split_into_shards
 
 # TODO: Decimal service amount
-# TODO: Global entities cache
 
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d.%m.%Y %H:%M:%S',
 #                    level=logging.INFO)
@@ -31,6 +42,17 @@ logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d.%m.%Y %H:%M:
 #                    filename='activity.log', filemode='w', level=logging.INFO)
 #logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
+# Simulator state inherited by forked worker processes
+parallel_context = None
+
+
+def simulate_shard(shard_num, date_from, date_to, lookahead_days, seed):
+    simulator, shards, static_snapshot, shard_snapshots, max_ids, pricing = parallel_context
+    ids = (shard_num, len(shards), max_ids)
+    return simulator.simulate_shard(shards[shard_num], static_snapshot, shard_snapshots[shard_num], pricing,
+                                    date_from, date_to, lookahead_days, seed, ids)
+
+
 class MobileOperatorSimulator:
     def __init__(self, metadata):
         self.metadata = metadata
@@ -41,7 +63,8 @@ class MobileOperatorSimulator:
         self.generate_schema(self.main_engine)
         self.generate_schema(self.test_engine)
 
-        self.main_session = sessionmaker(bind=self.main_engine)()
+        # Simulator is the only writer of the main base, its rows don't have to be reloaded after commits
+        self.main_session = sessionmaker(bind=self.main_engine, expire_on_commit=False)()
         self.main_session.autoflush = False
         self.test_session = sessionmaker(bind=self.test_engine)()
         self.test_session.autoflush = False
@@ -52,6 +75,8 @@ class MobileOperatorSimulator:
 
         self.customers = []
         self.customer_clusters = {}
+        # Usages are billed by batches, without it they are billed one by one as they happen
+        self.batch_billing = True
 
     def generate_schema(self, engine):
         self.metadata.create_all(engine, checkfirst=True)
@@ -65,8 +90,8 @@ class MobileOperatorSimulator:
             size = group_info['size']
             customer_type = group_info['customer_type']
             if customer_type == 'individual':
-                age_distribution = Distribution(info=distributions_info['age'][group_info['ages']])
-                gender_distribution = distribution_from_list(distributions_info['gender'][group_info['gender']])
+                age_distribution = distribution_registry.get('age', group_info['ages'])
+                gender_distribution = distribution_registry.get_from_list('gender', group_info['gender'])
 
             for i in range(size):
                 if customer_type == 'individual':
@@ -81,48 +106,219 @@ class MobileOperatorSimulator:
                 c.generate_hierarchy(generation_date)
                 self.customers.append(c)
 
-        self.main_session.commit()
+        self.system.commit()
         end_time = time()
         print('Customers generation done in %f seconds' % (end_time-start_time))
 
-    def simulate_period(self, date_from, date_to):
+    def simulate_period(self, date_from, date_to, lookahead_days=1, workers=1):
+        if lookahead_days < 1:
+            raise ValueError('Lookahead window must be at least one day, got %s' % lookahead_days)
         print('Simulating customers activity from %s to %s' % (date_from, date_to))
         start_time = time()
-        for customer in self.customers:
-            customer.simulate_period(date_from, date_to)
+
+        if workers > 1:
+            performed = self.simulate_period_parallel(date_from, date_to, lookahead_days, workers)
+        else:
+            performed = self.run_period(self.customers, self.system, date_from, date_to, lookahead_days)
+
         end_time = time()
-        print('Customers simulation done in %f seconds' % (end_time-start_time))
+        print('Customers simulation done in %f seconds (%d actions)' % (end_time-start_time, performed))
+
+    def run_period(self, customers, operator_system, date_from, date_to, lookahead_days):
+        accounts = [account for customer in customers for account in customer.accounts]
+        devices = [device for account in accounts for device in account.devices]
+        payment_generators = [account.get_payments_generator(date_from) for account in accounts]
+        device_generators = get_clusters_generators(devices)
+        scheduler = SimulationScheduler(UsageBatch(operator_system) if self.batch_billing else None)
+
+        # Actions of all customers are performed in time order, but only lookahead window is generated at once
+        window_start = date_from
+        while window_start <= date_to:
+            window_end = min(window_start+timedelta(days=lookahead_days-1), date_to)
+            logging.info('Simulating window from %s to %s' % (window_start, window_end))
+
+            for gen in payment_generators:
+                scheduler.add_stream(gen.generate_timeline(window_start, window_end))
+            for gen in device_generators:
+                activity = gen.generate_activity(window_start, window_end)
+                scheduler.add_stream(gen.iter_actions(activity[np.argsort(activity['timestamp'], kind='stable')]))
+
+            scheduler.run()
+            operator_system.commit()
+            window_start = window_end+timedelta(days=1)
+
+        return scheduler.performed
+
+    def simulate_period_parallel(self, date_from, date_to, lookahead_days, workers):
+        # Customers don't interact, so their shards are simulated in separate processes. Every process gets static
+        # data and the rows of its own customers.
+        global parallel_context
+
+        self.system.commit()
+        shards = split_into_shards(self.customers, workers, key=lambda customer: customer.cluster_id)
+        max_ids = get_max_ids(self.main_engine)
+        static_snapshot = take_static_snapshot(self.main_engine)
+        shard_snapshots = [take_shard_snapshot(self.main_engine, [customer.customer.id for customer in shard])
+                           for shard in shards]
+        # Costs aren't in the static snapshot, shards price usages by the matrix of the parent
+        pricing = self.system.get_catalog().pricing
+        seed = np.random.randint(2**31-len(shards))
+
+        parallel_context = (self, shards, static_snapshot, shard_snapshots, max_ids, pricing)
+        performed = 0
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(simulate_shard, shard_num, date_from, date_to, lookahead_days, seed+shard_num)
+                           for shard_num in range(len(shards))]
+
+                # Shards take ids from disjoint blocks, so their rows are merged as they are
+                for shard_num, future in enumerate(futures):
+                    shard_performed, changes = future.result()
+                    print('Merging shard %d of %d (%d actions)' % (shard_num+1, len(shards), shard_performed))
+                    merge_changes(self.main_engine, changes)
+                    performed += shard_performed
+        finally:
+            parallel_context = None
+
+        # Shards could register new phone numbers and connect services
+        self.main_session.expire_all()
+        self.system.reset_caches()
+        return performed
+
+    def simulate_shard(self, customers, static_snapshot, shard_snapshot, pricing, date_from, date_to, lookahead_days,
+                       seed, ids):
+        seed_random(seed)
+
+        engine = create_engine('sqlite://')
+        self.generate_schema(engine)
+        load_snapshot(engine, static_snapshot, shard_snapshot)
+        session = sessionmaker(bind=engine, expire_on_commit=False)()
+        session.autoflush = False
+
+        shard_num, shards_count, max_ids = ids
+        system = MobileOperatorSystem(session, IdAllocator(session, shard_num=shard_num, shards_count=shards_count,
+                                                           max_ids=max_ids), pricing)
+        for customer in customers:
+            customer.rebind(session, system)
+
+        performed = self.run_period(customers, system, date_from, date_to, lookahead_days)
+        return performed, diff_snapshot(engine, shard_snapshot, max_ids)
+
+    def generate_test_load(self, date_from, date_to, load_factor, speedup=None):
+        if not self.customer_clusters:
+            print('Analyze data first')
+        else:
+            self.load_simulator.copy_activity(self.customer_clusters, load_factor, date_from, date_to, speedup)
 
-    def generate_test_load(self, date_from, date_to, load_factor):
+    def export_test_load(self, date_from, date_to, load_factor, directory):
         if not self.customer_clusters:
             print('Analyze data first')
         else:
-            self.load_simulator.copy_activity(self.customer_clusters, load_factor, date_from, date_to)
+            self.load_simulator.export_activity(self.customer_clusters, load_factor, date_from, date_to, directory)
+
+    def replay_test_load(self, directory, speedup=None):
+        self.load_simulator.replay_export(directory, speedup)
 
     def generate_static_data(self):
         gen = MobileOperatorGenerator(verbose=True)
         gen.generate_static_data(self.main_session)
+        self.system.reset_caches()
+        self.system.load_catalog()
 
     def clear_main_base_data(self):
         self.metadata.drop_all(self.main_engine)
         self.generate_schema(self.main_engine)
         self.customer_clusters = {}
+        self.load_simulator.customers_activity = None
+        self.system.reset_caches()
 
     def clear_test_base_data(self):
         self.metadata.drop_all(self.test_engine)
         self.generate_schema(self.test_engine)
 
-    def analyze_data(self, date_from, date_to, base_type, algorithm):
+    def analyze_data(self, date_from, date_to, base_type, algorithm, chunk_size=None):
         if base_type == 'main':
-            self.customer_clusters = self.analyzer.analyze(date_from, date_to, base_type, algorithm)
+            self.customer_clusters = self.analyzer.analyze(date_from, date_to, base_type, algorithm, chunk_size)
+            self.load_simulator.customers_activity = self.analyzer.get_customers_activity(date_from, date_to,
+                                                                                          self.main_session)
+            self.main_session.commit()
+        else:
+            self.analyzer.analyze(date_from, date_to, base_type, algorithm, chunk_size)
+            self.test_session.commit()
+
+    def sweep_clustering(self, date_from, date_to, base_type, algorithms, workers=1):
+        return self.analyzer.sweep(date_from, date_to, base_type, algorithms, workers)
+
+
+def get_clusters_generators(sim_devices):
+    # Activity of devices with the same behavior is generated in one batch
+    clusters = {}
+    for sim_device in sim_devices:
+        cluster_id = sim_device.behavior_info['cluster_id']
+        if cluster_id not in clusters:
+            clusters[cluster_id] = [sim_device]
         else:
-            self.analyzer.analyze(date_from, date_to, base_type, algorithm)
+            clusters[cluster_id].append(sim_device)
+
+    generators = []
+    for cluster_devices in clusters.values():
+        period_start_dates = [sim_device.system.get_tariff_period(sim_device.device)[0]
+                              for sim_device in cluster_devices]
+        generators.append(DeviceActivityGenerator(cluster_devices, period_start_dates))
+
+    return generators
+
+
+def as_date(value):
+    # Rows created in this session keep the dates they were given, loaded rows have datetimes
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
 
 class MobileOperatorSystem:
-    def __init__(self, session):
+    def __init__(self, session, ids=None, pricing=None):
         self.session = session
+        self.pricing = pricing
         self.initial_balance = 200.0
         self.next_free_number = 0
+        self.catalog = None
+        self.billing = None
+        self.device_services = {}
+        self.latest_locations = {}
+        self.ids = ids if ids is not None else IdAllocator(session)
+        self.writer = WriteBuffer(session, self.ids)
+
+    def reset_caches(self):
+        self.catalog = None
+        self.billing = None
+        self.device_services = {}
+        self.latest_locations = {}
+        self.ids.reset()
+
+    def commit(self):
+        self.writer.flush()
+        self.session.commit()
+
+    def load_catalog(self):
+        self.catalog = StaticCatalog(self.session, self.pricing)
+        self.billing = None
+
+    def get_catalog(self):
+        if self.catalog is None:
+            self.load_catalog()
+        return self.catalog
+
+    def get_billing(self):
+        if self.billing is None:
+            self.billing = BatchBilling(self.get_catalog().pricing)
+        return self.billing
+
+    def get_device_services(self, device):
+        if device not in self.device_services:
+            self.device_services[device] = DeviceServiceIndex(device.services)
+        return self.device_services[device]
 
     def get_active_balance_for_device(self, device):
         return device.account.balances[-1]
@@ -151,6 +347,7 @@ class MobileOperatorSystem:
 
     def get_unpaid_bills(self, account, check_date=None):
         # TODO: Handle date
+        self.writer.flush()
         return self.session.query(Bill).\
             join(ServiceLog, Bill.service_log_id == ServiceLog.id).\
             join(DeviceService, ServiceLog.device_service_id == DeviceService.id).\
@@ -159,19 +356,19 @@ class MobileOperatorSystem:
                                Account.id == account.id)).\
             filter(Bill.debt > 0).all()
 
-    def handle_request(self, request):
+    def handle_request(self, device, request, service=None, tariff=None):
         logging.info('Handling request')
 
-        request_date = request.date_from
+        request_date = request['date_from']
 
-        if request.type == 'activation':
-            if request.service:
-                return self.connect_service(request.device, request.service, connection_date=request_date)
-            elif request.tariff:
-                return self.connect_tariff(request.device, request.tariff, connection_date=request_date)
-        elif request.type == 'deactivation':
+        if request['type'] == 'activation':
+            if service:
+                return self.connect_service(device, service, connection_date=request_date)
+            elif tariff:
+                return self.connect_tariff(device, tariff, connection_date=request_date)
+        elif request['type'] == 'deactivation':
             raise NotImplementedError
-        elif request.type == 'status':
+        elif request['type'] == 'status':
             logging.info('Doing nothing')
             return ServiceStatus.success
 
@@ -179,13 +376,13 @@ class MobileOperatorSystem:
         logging.info('Handling payment')
 
         balance = self.get_active_balance_for_account(account)
-        payment.balance = balance
+        self.writer.update(Payment, payment['id'], balance_id=balance.id)
 
-        balance.amount += Decimal(payment.amount)
-        logging.info('Replenishing %s balance at %f RUB' % (balance.type, payment.amount))
+        balance.amount += Decimal(payment['amount'])
+        logging.info('Replenishing %s balance at %f RUB' % (balance.type, payment['amount']))
         # TODO: Implement bonuses charging
         if balance.type == 'credit':
-            available_money = payment.amount
+            available_money = payment['amount']
             # Paying unpaid bills
             unpaid_bills = self.get_unpaid_bills(account)
             for bill in unpaid_bills:
@@ -206,13 +403,13 @@ class MobileOperatorSystem:
         logging.info('Handling connected service')
         # TODO: Pass date through parameter
         connection_date = service_info.date_from
-        log = ServiceLog(device_service=service_info,
-                         date_from=connection_date,
-                         action_type='activation',
-                         amount=1)
+        log = self.writer.add(ServiceLog,
+                              device_service_id=service_info.id,
+                              date_from=connection_date,
+                              action_type='activation',
+                              amount=1)
 
         service = service_info.service
-        self.session.add(log)
 
         if free_activation or service.activation_cost == Decimal(0):
             # logging.info('Activation is free')
@@ -221,9 +418,9 @@ class MobileOperatorSystem:
             # TODO: Charge activation sum if latest tariff change was less than month ago
             # TODO: Handle charging subscription cost for current period
             logging.info('Writing bill: need to pay %f' % service.activation_cost)
-            bill = Bill(date_from=connection_date, service_log=log, debt=service.activation_cost)
-            log.bill = bill
-            self.handle_bill(bill)
+            bill = self.writer.add(Bill, date_from=connection_date, service_log_id=log['id'],
+                                   debt=service.activation_cost)
+            self.handle_bill(bill, service_info)
 
     def can_activate_service(self, device, service):
         balance = self.get_active_balance_for_device(device)
@@ -246,30 +443,17 @@ class MobileOperatorSystem:
                                                             Location.date_to >= change_date))).one()
 
     def get_device_packet_services(self, device, service_name):
-        return self.session.query(DeviceService).\
-            join(Service, and_(DeviceService.service_id == Service.id,
-                               DeviceService.device_id == device.id)).\
-            join(Packet, and_(Packet.service_id == Service.id,
-                              Packet.type == service_name)).\
-            filter(DeviceService.is_activated).all()
+        return self.get_device_services(device).get_packets(service_name)
 
     def get_regional_operator(self, operator_info):
-        country = self.session.query(Country).filter_by(name=operator_info['country']).one()
-        if 'region' in operator_info and operator_info['region'] is not None:
-            region = self.session.query(Region).filter_by(country=country, name=operator_info['region']).one()
-        else:
-            region = None
-        operator = self.session.query(MobileOperator).filter_by(name=operator_info['name'],
-                                                                country=country, region=region).one()
-        return operator
+        region_name = operator_info.get('region')
+        return self.get_catalog().get_operator(operator_info['name'], operator_info['country'], region_name)
 
     def get_phone_number(self, operator_info, phone_info):
-        phone_numbers = self.session.query(PhoneNumber).filter_by(area_code=phone_info['code'],
-                                                                  number=phone_info['number']).all()  # FIXME: One
-        if not phone_numbers:
+        phone_number = self.get_catalog().get_phone_number(phone_info['code'], phone_info['number'])
+        if phone_number is None:
             phone_number = self.register_phone_number(operator_info, phone_info)
         else:
-            phone_number = phone_numbers[0]  # FIXME: Dirty hack
             logging.info('Phone number is already registered in base and belongs to operator %s %s' %
                          (phone_number.mobile_operator.name, phone_number.mobile_operator.country.iso3_code))
         return phone_number
@@ -278,11 +462,12 @@ class MobileOperatorSystem:
         logging.info('Registering phone number %s of operator %s' % (phone_info, operator_info))
 
         regional_operator = self.get_regional_operator(operator_info)
-        phone_number = PhoneNumber(area_code=phone_info['code'],
+        phone_number = PhoneNumber(id=self.ids.reserve(PhoneNumber),
+                                   area_code=phone_info['code'],
                                    number=phone_info['number'],
                                    mobile_operator=regional_operator)
         self.session.add(phone_number)
-        self.session.flush([phone_number])
+        self.get_catalog().add_phone_number(phone_number)
 
         return phone_number
 
@@ -302,46 +487,43 @@ class MobileOperatorSystem:
         # FIXME: Correct rounding (up to 200 kilobytes)
         return megabytes
 
-    def handle_bill(self, bill):
-        device_service = bill.service_log.device_service
+    def handle_bill(self, bill, device_service):
         service = device_service.service
         device = device_service.device
-        logging.info('Handling bill for service %s. Need to pay: %f' % (service.name, bill.debt))
+        logging.info('Handling bill for service %s. Need to pay: %f' % (service.name, bill['debt']))
         balance = self.get_active_balance_for_device(device)
 
         if balance.type == 'advance':
             if balance.amount > 0:
                 # Decreasing balance and paying bill
-                logging.info('Debiting %s RUB from advance balance with %s RUS' % (bill.debt,
+                logging.info('Debiting %s RUB from advance balance with %s RUS' % (bill['debt'],
                                                                                    balance.amount))
-                balance.amount -= bill.debt
-                bill.paid = bill.debt
-                bill.debt = 0
+                balance.amount -= bill['debt']
+                self.writer.update(Bill, bill['id'], paid=bill['debt'], debt=0)
                 return ServiceStatus.success
             else:
                 return ServiceStatus.out_of_funds
         elif balance.type == 'credit':
             if balance.amount > -balance.account.credit_limit:
                 # Decreasing balance, but the bill is still unpaid
-                logging.info('Debiting %s RUB from credit balance with %s RUB' % (bill.debt,
+                logging.info('Debiting %s RUB from credit balance with %s RUB' % (bill['debt'],
                                                                                   balance.amount))
                 # TODO: Write due date to bill
-                balance.amount -= bill.debt
+                balance.amount -= bill['debt']
                 return ServiceStatus.success
             else:
                 return ServiceStatus.out_of_funds
 
-    def handle_used_service(self, service_log):
+    def handle_used_service(self, service_log, service_info, recipient_phone_number=None):
         logging.info('Handling used service')
 
-        service_info = service_log.device_service
         service = service_info.service
         device = service_info.device
 
-        if service_log.is_free:
+        if service_log['is_free']:
             return ServiceStatus.success
 
-        unpaid_service_amount = service_log.amount
+        unpaid_service_amount = service_log['amount']
 
         packet_services = self.get_device_packet_services(device, service.name)
         if packet_services:
@@ -376,34 +558,107 @@ class MobileOperatorSystem:
                 # It is "unlimited", so additional charge is not required
                 logging.info('Internet is now 64 kbit/sec')
             else:
-                device_operator = device.phone_number.mobile_operator
+                device_operator_id = device.phone_number.mobile_operator_id
                 # TODO: Handle roaming
-                if service_log.recipient_phone_number:
-                    # It is outgoing call, sms, mms or internet
-                    recipient_operator = service_log.recipient_phone_number.mobile_operator
-                    try:
-                        cost = self.session.query(Cost).filter(Cost.operator_from == device_operator,
-                                                               Cost.operator_to == recipient_operator,
-                                                               Cost.service == service).one()
-                    except NoResultFound:
-                        cost = self.session.query(Cost).filter(Cost.operator_from == device_operator,
-                                                               Cost.service == service).one()
-                else:
-                    cost = self.session.query(Cost).filter(Cost.operator_from == device_operator,
-                                                           Cost.service == service).one()
+                # Recipient is known for outgoing calls, sms, mms and internet, fallbacks are in the pricing matrix.
+                # Numbers registered since the last flush have no operator id yet, so it's taken from the operator.
+                recipient_operator_id = recipient_phone_number.mobile_operator.id if recipient_phone_number else None
+                cost = self.get_catalog().get_cost(device_operator_id, service.id, recipient_operator_id)
 
                 logging.info('Writing bill: need to pay %f (%d * %f)' % (unpaid_service_amount*cost.use_cost,
                                                                          unpaid_service_amount,
                                                                          cost.use_cost))
-                bill = Bill(service_log=service_log,
-                            date_from=service_log.date_from,
-                            debt=cost.use_cost*service_log.amount)
-                service_log.bill = bill
-                self.session.add(bill)
-                return self.handle_bill(bill)
+                bill = self.writer.add(Bill,
+                                       service_log_id=service_log['id'],
+                                       date_from=service_log['date_from'],
+                                       debt=cost.use_cost*service_log['amount'])
+                return self.handle_bill(bill, service_info)
         else:
             return ServiceStatus.success
 
+    def get_packet_charge_order(self, device, packet_services):
+        # Same order as the charge queue of handle_used_service: additional packets from the last, then tariff ones
+        tariff_packets = [packet for packet in packet_services if packet in device.tariff.attached_services]
+        additional_packets = [packet for packet in packet_services if packet not in device.tariff.attached_services]
+        return additional_packets[::-1]+tariff_packets
+
+    def handle_used_services(self, usages):
+        # Batch version of handle_used_service for (service_log, service_info, recipient_phone_number) in time order.
+        # Usages must not be interleaved with payments and service changes. Usages of a balance after its first out
+        # of funds one are not handled, their indexes are returned with the statuses and they get None status.
+        logging.info('Handling %d used services' % len(usages))
+        billing = self.get_billing()
+
+        events = {name: [] for name in ('amount', 'is_free', 'service_id', 'operator_from_id', 'operator_to_id',
+                                        'unlimited', 'packets', 'balance')}
+        packet_groups, packets, balances = {}, [], {}
+        for service_log, service_info, recipient_phone_number in usages:
+            service = service_info.service
+            device = service_info.device
+
+            group = -1
+            packet_services = self.get_device_packet_services(device, service.name)
+            if packet_services:
+                key = (device, service.name)
+                if key not in packet_groups:
+                    packet_groups[key] = len(packet_groups)
+                    for packet_service in self.get_packet_charge_order(device, packet_services):
+                        packets.append((packet_groups[key], packet_service))
+                group = packet_groups[key]
+
+            balance = self.get_active_balance_for_device(device)
+            if balance not in balances:
+                balances[balance] = len(balances)
+
+            events['amount'].append(service_log['amount'])
+            events['is_free'].append(service_log['is_free'])
+            events['service_id'].append(service.id)
+            events['operator_from_id'].append(device.phone_number.mobile_operator_id)
+            events['operator_to_id'].append(recipient_phone_number.mobile_operator.id
+                                            if recipient_phone_number else -1)
+            events['unlimited'].append(service.name == 'internet')
+            events['packets'].append(group)
+            events['balance'].append(balances[balance])
+
+        # Balance pays while it is above zero for advance and above the credit limit for credit
+        headrooms = [billing.to_units(balance.amount+(balance.account.credit_limit if balance.type == 'credit' else 0))
+                     for balance in balances]
+        packet_group_ids = [group for group, _ in packets]
+        packet_left = [packet_service.packet_left for _, packet_service in packets]
+        result = billing.rate(events, packet_group_ids, packet_left, headrooms)
+
+        # Rating doesn't change anything, so the usages before the deferred ones are rated again without them
+        handled = np.arange(len(usages))
+        deferred = billing.get_deferred(events['balance'], result)
+        if deferred.any():
+            handled = np.flatnonzero(~deferred)
+            result = billing.rate({name: np.asarray(values)[handled] for name, values in events.items()},
+                                  packet_group_ids, packet_left, headrooms)
+
+        for (_, packet_service), left in zip(packets, result['packet_left']):
+            packet_service.packet_left = int(left)
+        for balance, debit in zip(balances, result['debits']):
+            if debit:
+                balance.amount -= billing.to_money(debit)
+
+        statuses = [None]*len(usages)
+        for i in handled:
+            statuses[i] = ServiceStatus.success
+        # Unlimited internet got slower, handle_used_service has no status for it
+        for i in handled[result['slowed']]:
+            statuses[i] = None
+        bills = []
+        for i, debt, charged in zip(handled[result['billed']], result['debts'], result['charged']):
+            service_log, service_info, _ = usages[i]
+            paid_now = charged and self.get_active_balance_for_device(service_info.device).type == 'advance'
+            bills.append({'service_log_id': service_log['id'], 'date_from': service_log['date_from'],
+                          'paid': billing.to_money(debt) if paid_now else 0,
+                          'debt': 0 if paid_now else billing.to_money(debt)})
+            if not charged:
+                statuses[i] = ServiceStatus.out_of_funds
+        self.writer.add_many(Bill, bills)
+        return statuses, np.flatnonzero(deferred).tolist()
+
     def connect_tariff(self, device, tariff, free_activation=False, connection_date=db.func.now()):
         logging.info('Connecting tariff: %s' % tariff.name)
 
@@ -428,17 +683,17 @@ class MobileOperatorSystem:
         device.tariff = tariff
         # Connecting tariff as a service
         self.connect_service(device, tariff, connection_date, free_activation=free_activation,
-                             ability_check=False, flush=False)
+                             ability_check=False)
 
         # Add to user basic services (like calls, sms, mms, internet)
         for service in tariff.attached_services:
             self.connect_service(device, service, connection_date, free_activation=free_activation,
-                                 ability_check=False, flush=False)
+                                 ability_check=False)
 
         return ServiceStatus.success
 
     def connect_service(self, device, service, connection_date,
-                        free_activation=False, ability_check=True, flush=True):
+                        free_activation=False, ability_check=True):
         logging.info('Connecting service: %s' % service.name)
 
         if ability_check:
@@ -454,103 +709,72 @@ class MobileOperatorSystem:
         else:
             date_to = connection_date + timedelta(days=service_duration)
 
-        device_service = DeviceService(device=device, service=service, date_from=connection_date, date_to=date_to)
+        device_services = self.get_device_services(device)
+        # DeviceService stays mapped, its packets and flags are changed in place
+        device_service = DeviceService(id=self.ids.reserve(DeviceService),
+                                       device=device, service=service, date_from=connection_date, date_to=date_to,
+                                       is_activated=True, is_blocked=False)
         logging.info('Connected service %s from %s to %s' % (service.name, connection_date, date_to))
         if service.packet:
             device_service.packet_left = service.packet.amount
         device.services.append(device_service)
+        device_services.add(device_service)
 
         self.session.add(device_service)
 
-        if flush:
-            self.session.flush([device_service])
-
         self.handle_connected_service(device_service, free_activation=free_activation)
 
-    def activate_service(self, device, service, date, flush=True):
+    def activate_service(self, device, service, date, flush=False):
         # TODO: Date?
         logging.info('Activating service: %s' % service.name)
-        self.session.query(DeviceService).\
-            filter_by(device=device, service=service, is_activated=False).\
-            update({'is_activated': True},
-                   synchronize_session='fetch')
+        self.get_device_services(device).activate(service)
         if flush:
             self.session.flush()
 
-    def deactivate_service(self, device, service, date, flush=True):
+    def deactivate_service(self, device, service, date, flush=False):
         # TODO: Date?
         logging.info('Deactivating service: %s' % service.name)
-        self.session.query(DeviceService).\
-            filter_by(device=device, service=service, is_activated=True).\
-            update({'is_activated': False,
-                    'date_to': date},
-                   synchronize_session='fetch')
+        self.get_device_services(device).deactivate(service, date)
         if flush:
             self.session.flush()
 
-    def block_service(self, device, service, date, flush=True):
+    def block_service(self, device, service, date, flush=False):
         # TODO: Date?
         logging.info('Blocking service: %s' % service.name)
-        self.session.query(DeviceService).\
-            filter_by(device=device, service=service, is_blocked=False).\
-            update({'is_blocked': True},
-                   synchronize_session='fetch')
+        self.get_device_services(device).set_blocked(service, True)
         if flush:
             self.session.flush()
 
-    def unlock_service(self, device, service, date, flush=True):
+    def unlock_service(self, device, service, date, flush=False):
         # TODO: Date?
         logging.info('Blocking service: %s' % service.name)
-        self.session.query(DeviceService).\
-            filter_by(device=device, service=service, is_blocked=True).\
-            update({'is_blocked': False},
-                   synchronize_session='fetch')
+        self.get_device_services(device).set_blocked(service, False)
         if flush:
             self.session.flush()
 
     def get_service(self, service_type='service', operator=None, name=None, code=None):
         logging.info('Getting service (type: %s) %s (code %s)' % (service_type, name, code))
-        if service_type == 'service':
-            service_entity = Service
-        else:
-            service_entity = Tariff
-
-        if name:
-            try:
-                service = self.session.query(service_entity).filter_by(name=name, in_archive=False,
-                                                                       operator=operator).one()
-            except NoResultFound:
-                service = self.session.query(service_entity).filter_by(name=name, in_archive=False).one()
-            except MultipleResultsFound:
-                print('ERROR: The tariff or service is not defined for region %s' % operator.region.name)
-        else:  # activation code
-            try:
-                service = self.session.query(service_entity).filter_by(activation_code=code,
-                                                                       in_archive=False,
-                                                                       operator=operator).one()
-            except NoResultFound:
-                service = self.session.query(service_entity).filter_by(activation_code=code, in_archive=False).one()
-            except MultipleResultsFound:
-                print('ERROR: The tariff or service is not defined for region %s' % operator.region.name)
-
-        return service
+        operator_id = operator.id if operator is not None else None
+        try:
+            return self.get_catalog().get_service(service_type, operator_id, name=name, code=code)
+        except MultipleResultsFound:
+            print('ERROR: The tariff or service is not defined for region %s' % operator.region.name)
+            raise
 
     def get_tariff_period(self, device):
-        # TODO: Use subquery
-        tariff_name = self.session.query(Tariff.name).join(Device, and_(Device.tariff_id == Tariff.id,
-                                                                        Device.id == device.id)).one().name
-
         # TODO: Check date (it should be usable within simulation date)
-        tariff_device_service = self.session.query(DeviceService).\
-            join(Service, and_(DeviceService.service_id == Service.id)).\
-            filter(and_(Service.name == tariff_name,
-                        DeviceService.device_id == device.id,
-                        DeviceService.is_activated)).one()
-
-        period_start = tariff_device_service.date_from.date()
-        period_end = tariff_device_service.date_to.date()
+        tariff_device_service = self.get_device_services(device).get_active(device.tariff.name)
+
+        period_start = as_date(tariff_device_service.date_from)
+        period_end = as_date(tariff_device_service.date_to)
         return period_start, period_end
 
+    def get_latest_location_id(self, device):
+        if device.id not in self.latest_locations:
+            latest_location = self.session.query(Location.id).filter_by(device=device, date_to=None).one()
+            self.latest_locations[device.id] = latest_location.id
+        return self.latest_locations[device.id]
+
     def get_free_phone_number(self):
         logging.info('Getting free phone number')
         self.next_free_number += 1
@@ -564,6 +788,7 @@ class SimulatedCustomer:
         self.session = session
         self.system = operator_system
         self.customer = customer
+        self.cluster_id = customer.cluster_id
         self.agreement_cluster_names = agreement_cluster_names
         self.verbose = verbose
 
@@ -572,6 +797,14 @@ class SimulatedCustomer:
 
         session.add(self.customer)
 
+    def rebind(self, session, operator_system):
+        # Attaching simulated hierarchy to the same rows of another base
+        self.session = session
+        self.system = operator_system
+        self.customer = session.query(Customer).get(inspect(self.customer).identity)
+        for account in self.accounts:
+            account.rebind(session, operator_system)
+
     def generate_hierarchy(self, generation_date):
         logging.info('Generating agreements')
         for agreement_cluster_name in self.agreement_cluster_names:
@@ -617,7 +850,7 @@ class SimulatedCustomer:
 
         balance = Balance(date_from=registration_date,
                           type=calc_method.type,
-                          amount=self.system.initial_balance)
+                          amount=Decimal(self.system.initial_balance))
 
         account = Account(date_from=registration_date,
                           cluster_id=account_info['cluster_id'],
@@ -629,10 +862,8 @@ class SimulatedCustomer:
         agreement.accounts.append(account)
         return account
 
-    def simulate_period(self, date_from, date_to):
-        for account in self.accounts:
-            account.simulate_period(date_from, date_to)
-        self.session.commit()
+    def get_devices(self):
+        return [device for account in self.accounts for device in account.devices]
 
 
 class SimulatedAccount:
@@ -645,6 +876,13 @@ class SimulatedAccount:
 
         self.devices = []
 
+    def rebind(self, session, operator_system):
+        self.session = session
+        self.system = operator_system
+        self.account = session.query(Account).get(inspect(self.account).identity)
+        for device in self.devices:
+            device.rebind(session, operator_system)
+
     def add_device(self, device_info):
         logging.info('Attaching device to account: %s' % device_info)
         registration_date = device_info['date']
@@ -672,7 +910,8 @@ class SimulatedAccount:
 
         home_operator = phone_number.mobile_operator
 
-        initial_location = Location(country=home_operator.country, region=home_operator.region,
+        initial_location = Location(id=self.system.ids.reserve(Location),
+                                    country=home_operator.country, region=home_operator.region,
                                     date_from=registration_date)
         device.locations.append(initial_location)
 
@@ -687,7 +926,7 @@ class SimulatedAccount:
         for initial_service_name in device_info['initial_services']:
             service = self.system.get_service(service_type='service', name=initial_service_name, operator=home_operator)
             self.system.connect_service(device, service, free_activation=True,
-                                        connection_date=registration_date, flush=False)
+                                        connection_date=registration_date)
 
         self.session.add(device)
         return device
@@ -695,21 +934,16 @@ class SimulatedAccount:
     def generate_devices(self, generation_date):
         probabilistic = self.account_cluster_info['probabilistic']
 
-        # Generating country distributions
-        home_locations_info = distributions_info['location'][self.account_cluster_info['home_locations']]
-        countries_distribution = distribution_from_list(home_locations_info)
-        regions_distribution = {}
-
-        for country_info in home_locations_info:
-            country_name = country_info['name']
-            if 'regions' in country_info:
-                regions_distribution[country_name] = distribution_from_list(country_info['regions'])
+        # Getting country distributions
+        home_locations_name = self.account_cluster_info['home_locations']
+        countries_distribution = distribution_registry.get_from_list('location', home_locations_name)
 
         # Getting home location
         home_country = countries_distribution.get_value(return_array=False)
         home_region = None
-        if home_country in regions_distribution:
-            home_region = regions_distribution[home_country].get_value(return_array=False)
+        regions_distribution = distribution_registry.get_regions(home_locations_name, home_country)
+        if regions_distribution:
+            home_region = regions_distribution.get_value(return_array=False)
 
         if not probabilistic:  # fixed device clusters
             device_cluster_names = self.account_cluster_info['devices']
@@ -717,13 +951,13 @@ class SimulatedAccount:
                 device_cluster_info = devices_info[device_cluster_name]
 
                 # Getting initial tariff name
-                tariff_distribution_info = distributions_info['tariff'][device_cluster_info['Initial tariffs']]
-                tariff_distribution = distribution_from_list(tariff_distribution_info)
+                tariff_distribution = distribution_registry.get_from_list('tariff',
+                                                                          device_cluster_info['Initial tariffs'])
                 initial_tariff_name = tariff_distribution.get_value(return_array=False)
 
                 # Getting initial services amount and names
-                initial_services_info = distributions_info['service'][device_cluster_info['Initial services']['services']]
-                service_distribution = distribution_from_list(initial_services_info)
+                service_distribution = distribution_registry.get_from_list('service',
+                                                                           device_cluster_info['Initial services']['services'])
                 avg_amount = device_cluster_info['Initial services']['amount']
                 max_deviation = device_cluster_info['Initial services']['max_deviation']
                 amount = random.randint(max(0, avg_amount-max_deviation), avg_amount+max_deviation)
@@ -757,33 +991,20 @@ class SimulatedAccount:
         logging.info('Making payment: %s' % payment_info)
         if payment_info['method'] == 'third_party':
             name = payment_info['name']
-            payment_method = self.session.query(ThirdPartyCollection).filter_by(name=name).one()
+            payment_method = self.system.get_catalog().get_payment_method('third_party', name)
         elif payment_info['method'] == 'cash':
-            payment_method = self.session.query(Cash).one()
+            payment_method = self.system.get_catalog().get_payment_method('cash')
         else:  # credit card
             # TODO: Implement credit card payment
             raise NotImplementedError
 
         payment_date = payment_info['date']
-        payment = Payment(date=payment_date, amount=payment_info['amount'], method=payment_method)
-
-        self.session.add(payment)
+        payment = self.system.writer.add(Payment, date=payment_date, amount=payment_info['amount'],
+                                         method_id=payment_method.id)
         return self.system.handle_payment(self.account, payment)
 
-    def simulate_period(self, date_from, date_to):
-        gen = AccountActivityGenerator(self, date_from)  # TODO: When to start?
-        account_actions = gen.generate_timeline(date_from, date_to)
-
-        device_actions = []
-        for device in self.devices:
-            device_actions.extend(device.generate_period_actions(date_from, date_to))
-
-        actions = account_actions+device_actions
-
-        # TODO: Handle system changes every day
-        for action in sorted(actions, key=lambda action: action.start_date):
-            logging.info(action)
-            action.perform()
+    def get_payments_generator(self, period_start):
+        return AccountActivityGenerator(self, period_start)  # TODO: When to start?
 
 
 class SimulatedDevice:
@@ -798,6 +1019,11 @@ class SimulatedDevice:
         self.trust_category = trust_category
         self.verbose = verbose
 
+    def rebind(self, session, operator_system):
+        self.session = session
+        self.system = operator_system
+        self.device = session.query(Device).get(inspect(self.device).identity)
+
     def set_device_location(self, location_info):
         country_name, region_name, place_name = None, None, None
         country_name = location_info['country']
@@ -811,23 +1037,24 @@ class SimulatedDevice:
         logging.info('Changing location to: Country = %s, Region = %s, Place = %s' % (country_name, region_name,
                                                                                       place_name))
 
-        latest_location = self.session.query(Location).filter_by(device=self.device, date_to=None).one()
-        latest_location.date_to = location_date
+        writer = self.system.writer
+        writer.update(Location, self.system.get_latest_location_id(self.device), date_to=location_date)
 
         region, place = None, None
 
-        country = self.session.query(Country).filter_by(name=country_name).one()
+        country = self.system.get_catalog().get_country(country_name)
         if region_name:
-            region = self.session.query(Region).filter_by(country=country, name=region_name).one()
+            region = self.system.get_catalog().get_region(country_name, region_name)
         if place_name:
             place = self.session.query(Place).filter_by(region=region, name=place_name).one()
 
-        new_location = Location(device=self.device, date_from=location_date,
-                                country=country, region=region, place=place)
-        self.device.locations.append(new_location)
-        self.session.flush([latest_location, new_location])
+        new_location = writer.add(Location, device_id=self.device.id, date_from=location_date,
+                                  country_id=country.id,
+                                  region_id=region.id if region else None,
+                                  place_id=place.id if place else None)
+        self.system.latest_locations[self.device.id] = new_location['id']
 
-    def use_service(self, service_info, amount=1):
+    def log_usage(self, service_info, amount=1):
         recipient_phone_number = None
         usage_date = service_info['date']
 
@@ -836,37 +1063,42 @@ class SimulatedDevice:
             phone_number_info = service_info['phone_number']
             recipient_phone_number = self.system.get_phone_number(operator_info, phone_number_info)
 
-        device_service = self.session.query(DeviceService).\
-            join(Service, and_(DeviceService.service_id == Service.id,
-                               DeviceService.device_id == self.device.id,
-                               DeviceService.is_activated,
-                               Service.name == service_info['name'])).one()
+        device_service = self.system.get_device_services(self.device).get_active(service_info['name'])
 
-        log = ServiceLog(device_service=device_service,
-                         amount=amount,
-                         action_type='usage',
-                         date_from=usage_date,
-                         is_free=service_info['is_free'],
-                         recipient_phone_number=recipient_phone_number)
+        log = self.system.writer.add(ServiceLog,
+                                     device_service_id=device_service.id,
+                                     amount=amount,
+                                     action_type='usage',
+                                     date_from=usage_date,
+                                     is_free=service_info['is_free'],
+                                     recipient_phone_number_id=recipient_phone_number.id
+                                     if recipient_phone_number else None)
+        return log, device_service, recipient_phone_number
+
+    def use_service(self, service_info, amount=1):
+        return self.system.handle_used_service(*self.log_usage(service_info, amount))
 
-        self.session.add(log)
-        return self.system.handle_used_service(log)
+    def get_usage_amount(self, service_info):
+        # Units of the used service: started minutes of calls, megabytes of internet and messages
+        if service_info['name'] == 'outgoing_call':
+            return self.system.round_call_duration(service_info['minutes'], service_info['seconds'])
+        elif service_info['name'] == 'internet':
+            return self.system.round_internet_session(service_info['megabytes'], service_info['kilobytes'])
+        return 1
 
     def make_call(self, call_info):
         logging.info('Making call to phone number %s' % (call_info['phone_number']['code'] +
                                                          ' ' + call_info['phone_number']['number']))
-        return self.use_service(call_info, self.system.round_call_duration(call_info['minutes'],
-                                                                           call_info['seconds']))
+        return self.use_service(call_info, self.get_usage_amount(call_info))
 
     def send_message(self, message_info):
         phone_number = message_info['phone_number']['code'] + ' ' + message_info['phone_number']['number']
         logging.info('Sending %s message to phone number %s' % (message_info['name'], phone_number))
-        return self.use_service(message_info, amount=1)
+        return self.use_service(message_info, self.get_usage_amount(message_info))
 
     def use_internet(self, session_info):
         logging.info('Using internet: %s' % session_info)
-        return self.use_service(session_info, self.system.round_internet_session(session_info['megabytes'],
-                                                                                 session_info['kilobytes']))
+        return self.use_service(session_info, self.get_usage_amount(session_info))
 
     def ussd_request(self, request_info):
         logging.info('Making request: %s' % request_info)
@@ -874,23 +1106,15 @@ class SimulatedDevice:
         regional_operator = self.device.phone_number.mobile_operator
         request_date = request_info['date']
 
+        service, tariff = None, None
         if request_info['service_type'] == 'service':
             service = self.system.get_service(service_type='service', operator=regional_operator,
                                               code=request_info['code'])
-            request = Request(date_from=request_date, type=request_info['type'],
-                              device=self.device, service=service)
         else:
             tariff = self.system.get_service(service_type='tariff', operator=regional_operator,
                                              code=request_info['code'])
-            request = Request(date_from=request_date, type=request_info['type'],
-                              device=self.device, tariff=tariff)
-        self.session.add(request)
-        return self.system.handle_request(request)
-
-    def generate_period_actions(self, date_from, date_to):
-        period_start, period_end = self.system.get_tariff_period(self.device)
-
-        gen = DeviceActivityGenerator(self, period_start)
-        actions = gen.generate_timeline(date_from, date_to)
-
-        return actions
+        request = self.system.writer.add(Request, date_from=request_date, type=request_info['type'],
+                                         device_id=self.device.id,
+                                         service_id=service.id if service else None,
+                                         tariff_id=tariff.id if tariff else None)
+        return self.system.handle_request(self.device, request, service=service, tariff=tariff)
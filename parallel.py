@@ -0,0 +1,207 @@
+from sqlalchemy import select, bindparam, func, and_
+
+from base import Base
+from entities.analysis import *
+from entities.customer import *
+from entities.location import *
+from entities.operator import *
+from entities.payment import *
+from entities.service import *
+
+# Customers hierarchy and their activity, shards get only the rows of their own customers simulation reads
+SHARD_ENTITIES = [Customer, IndividualInfo, CreditProfile, CustomerAgreement, Account, Balance, Device, DeviceService,
+                  Location, Payment, Request, ServiceLog, Bill]
+# Not read by simulation
+SKIPPED_ENTITIES = [Analysis, ClusterAssignment]
+# Read only through the pricing matrix, shards get it from the parent instead of the rows
+PRICING_ENTITIES = [Cost]
+# Rows of these tables are added or changed by simulation. Static rows are read only, except recipient phone
+# numbers registered by shards.
+WRITTEN_ENTITIES = [PhoneNumber, Device, DeviceService, Balance, Location, Payment, Request, ServiceLog, Bill]
+
+# Ids are selected by parts, so the amount of query parameters stays under the limits of databases
+IN_CHUNK_SIZE = 500
+
+
+def get_entities_tables(entities):
+    # Tables of the entities and their subclasses, in order of dependencies
+    tables = {table for entity in entities for mapper in entity.__mapper__.self_and_descendants
+              for table in mapper.tables}
+    return [table for table in Base.metadata.sorted_tables if table in tables]
+
+
+def get_static_tables():
+    excluded = set(get_entities_tables(SHARD_ENTITIES+SKIPPED_ENTITIES))
+    return [table for table in Base.metadata.sorted_tables if table not in excluded]
+
+
+def id_tables(tables):
+    # Tables with integer surrogate key, association tables are static
+    return [table for table in tables if 'id' in table.c and table.c.id.primary_key]
+
+
+def select_rows(connection, table, *criteria):
+    return [dict(row) for row in connection.execute(select([table]).where(and_(*criteria)))]
+
+
+def select_rows_in(connection, entity, column, values, *criteria):
+    rows = []
+    values = list(values)
+    for i in range(0, len(values), IN_CHUNK_SIZE):
+        rows.extend(select_rows(connection, entity.__table__, column.in_(values[i:i+IN_CHUNK_SIZE]), *criteria))
+    return rows
+
+
+def get_max_ids(engine):
+    # Shards reserve ids after these ones, so the rows above them are the new rows of the shard
+    with engine.connect() as connection:
+        return {table.name: connection.execute(select([func.max(table.c.id)])).scalar() or 0
+                for table in id_tables(Base.metadata.sorted_tables)}
+
+
+def take_static_snapshot(engine):
+    # Shared by all shards, they only read it
+    snapshot = {}
+    pricing_tables = set(get_entities_tables(PRICING_ENTITIES))
+    with engine.connect() as connection:
+        for table in get_static_tables():
+            if table in pricing_tables:
+                continue
+            snapshot[table.name] = [dict(row) for row in connection.execute(select([table]))]
+    return snapshot
+
+
+def take_shard_snapshot(engine, customer_ids):
+    # Hierarchy of the shard customers with their open locations and unpaid bills
+    snapshot = {table.name: [] for table in get_entities_tables(SHARD_ENTITIES)}
+
+    def add(entity, rows):
+        snapshot[entity.__table__.name].extend(rows)
+        return [row['id'] for row in rows]
+
+    with engine.connect() as connection:
+        add(Customer, select_rows_in(connection, Customer, Customer.id, customer_ids))
+        add(Individual, select_rows_in(connection, Individual, Individual.__table__.c.id, customer_ids))
+        add(Organization, select_rows_in(connection, Organization, Organization.__table__.c.id, customer_ids))
+        info_ids = {row['info_id'] for row in snapshot[Individual.__table__.name] if row['info_id'] is not None}
+        add(IndividualInfo, select_rows_in(connection, IndividualInfo, IndividualInfo.id, info_ids))
+        add(CreditProfile, select_rows_in(connection, CreditProfile, CreditProfile.customer_id, customer_ids))
+
+        agreement_ids = add(CustomerAgreement, select_rows_in(connection, CustomerAgreement,
+                                                              CustomerAgreement.customer_id, customer_ids))
+        account_ids = add(Account, select_rows_in(connection, Account, Account.agreement_id, agreement_ids))
+        add(Balance, select_rows_in(connection, Balance, Balance.account_id, account_ids))
+        device_ids = add(Device, select_rows_in(connection, Device, Device.account_id, account_ids))
+        device_service_ids = add(DeviceService, select_rows_in(connection, DeviceService, DeviceService.device_id,
+                                                               device_ids))
+        add(Location, select_rows_in(connection, Location, Location.device_id, device_ids,
+                                     Location.date_to.is_(None)))
+
+        # Unpaid bills are paid by the next payments, payments find them through their service logs
+        unpaid_bills = Bill.__table__.join(ServiceLog.__table__, Bill.service_log_id == ServiceLog.id)
+        for i in range(0, len(device_service_ids), IN_CHUNK_SIZE):
+            query = select([Bill.__table__]).select_from(unpaid_bills).\
+                where(and_(ServiceLog.device_service_id.in_(device_service_ids[i:i+IN_CHUNK_SIZE]), Bill.debt > 0))
+            add(Bill, [dict(row) for row in connection.execute(query)])
+        service_log_ids = {row['service_log_id'] for row in snapshot[Bill.__table__.name]}
+        add(ServiceLog, select_rows_in(connection, ServiceLog, ServiceLog.id, service_log_ids))
+    return snapshot
+
+
+def load_snapshot(engine, *snapshots):
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            rows = [row for snapshot in snapshots for row in snapshot.get(table.name, [])]
+            if rows:
+                connection.execute(table.insert(), rows)
+
+
+def diff_snapshot(engine, snapshot, max_ids):
+    # Rows created in the id blocks of the shard and the rows of its customers changed since the snapshot.
+    # Only the tables written by simulation are read.
+    new_rows, changed_rows = {}, {}
+    with engine.connect() as connection:
+        for table in id_tables(get_entities_tables(WRITTEN_ENTITIES)):
+            new_rows[table.name] = select_rows(connection, table, table.c.id > max_ids[table.name])
+
+            original_rows = {row['id']: row for row in snapshot.get(table.name, [])}
+            changed_rows[table.name] = []
+            original_ids = list(original_rows)
+            for i in range(0, len(original_ids), IN_CHUNK_SIZE):
+                for row in select_rows(connection, table, table.c.id.in_(original_ids[i:i+IN_CHUNK_SIZE])):
+                    if row != original_rows[row['id']]:
+                        changed_rows[table.name].append(row)
+    return new_rows, changed_rows
+
+
+def move_sequences(connection, tables):
+    # Merged rows have explicit ids, PostgreSQL sequences are moved after them, so nextval doesn't give them again
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        sequence_name = connection.execute(select([func.pg_get_serial_sequence('"%s"' % table.name, 'id')])).scalar()
+        if sequence_name is not None:
+            connection.execute(select([func.setval(sequence_name, select([func.max(table.c.id)]).as_scalar())]))
+
+
+def get_references(table):
+    # Columns of all tables referencing the table
+    return [(referencing, fk.parent.name) for referencing in Base.metadata.sorted_tables
+            for fk in referencing.foreign_keys if fk.column.table is table]
+
+
+def remap_phone_numbers(connection, changes):
+    # Every shard registers recipient numbers on its own, numbers already registered in main base by other shards
+    # are dropped and references to them are moved to the main rows
+    new_rows, changed_rows = changes
+    table = PhoneNumber.__table__
+    numbers = {(row['area_code'], row['number']): row['id'] for row in new_rows.get(table.name, [])}
+    id_map = {}
+    keys = list(numbers)
+    for i in range(0, len(keys), IN_CHUNK_SIZE):
+        area_codes = {area_code for area_code, _ in keys[i:i+IN_CHUNK_SIZE]}
+        query = select([table.c.id, table.c.area_code, table.c.number]).\
+            where(and_(table.c.area_code.in_(area_codes),
+                       table.c.number.in_([number for _, number in keys[i:i+IN_CHUNK_SIZE]])))
+        for row in connection.execute(query):
+            shard_id = numbers.get((row.area_code, row.number))
+            if shard_id is not None:
+                id_map[shard_id] = row.id
+    if not id_map:
+        return
+
+    new_rows[table.name] = [row for row in new_rows[table.name] if row['id'] not in id_map]
+    for referencing, column in get_references(table):
+        for rows in (new_rows.get(referencing.name, []), changed_rows.get(referencing.name, [])):
+            for row in rows:
+                if row.get(column) in id_map:
+                    row[column] = id_map[row[column]]
+
+
+def merge_changes(engine, changes):
+    # Shards reserve disjoint ids, so their rows and references are valid in the main base
+    new_rows, changed_rows = changes
+    with engine.begin() as connection:
+        remap_phone_numbers(connection, changes)
+        inserted_tables = []
+        for table in Base.metadata.sorted_tables:
+            rows = new_rows.get(table.name)
+            if rows:
+                connection.execute(table.insert(), rows)
+                inserted_tables.append(table)
+
+            rows = changed_rows.get(table.name)
+            if rows:
+                for row in rows:
+                    row['_id'] = row.pop('id')
+                connection.execute(table.update().where(table.c.id == bindparam('_id')), rows)
+
+        move_sequences(connection, id_tables(inserted_tables))
+
+
+def split_into_shards(items, shards_count, key):
+    # Every shard gets equal part of every group
+    shards = [[] for _ in range(shards_count)]
+    for i, item in enumerate(sorted(items, key=key)):
+        shards[i % shards_count].append(item)
+    return [shard for shard in shards if shard]
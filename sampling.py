@@ -0,0 +1,132 @@
+import numpy as np
+from scipy import sparse
+
+
+def get_cluster_sizes(cluster_counts, fraction):
+    # Largest remainder rounding keeps the total, but every nonempty cluster gets at least one customer
+    quotas = cluster_counts*fraction
+    sizes = np.floor(quotas).astype(np.int64)
+    remainder = int(round(quotas.sum()))-sizes.sum()
+    if remainder > 0:
+        sizes[np.argsort(sizes-quotas, kind='stable')[:remainder]] += 1
+    sizes = np.maximum(sizes, (cluster_counts > 0) & (fraction > 0))
+    return np.minimum(sizes, cluster_counts)
+
+
+class ActivitySampler:
+    # Selects customers so the selected ones make the target fraction of events of every action type and every
+    # hour of day. Sample is stratified by clusters and then improved by swaps of customers inside of clusters,
+    # all candidate swaps of an iteration are evaluated at once.
+    TOLERANCE = 0.05
+    MAX_ITERATIONS = 200
+    MAX_CANDIDATES = 100000
+
+    def __init__(self, counts, feature_names, clusters, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS,
+                 max_candidates=MAX_CANDIDATES):
+        self.counts = sparse.csr_matrix(counts, dtype=np.float64)
+        self.feature_names = feature_names
+        self.clusters = np.asarray(clusters)
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.max_candidates = max_candidates
+        self.totals = np.asarray(self.counts.sum(axis=0)).ravel()
+
+    def get_initial_sample(self, fraction, cluster_index, cluster_counts):
+        # Random order inside of every cluster, first customers of the order are taken
+        order = np.lexsort((np.random.random(len(cluster_index)), cluster_index))
+        starts = np.concatenate(([0], np.cumsum(cluster_counts)[:-1]))
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))-starts[cluster_index[order]]
+        return ranks < get_cluster_sizes(cluster_counts, fraction)[cluster_index]
+
+    def get_candidates(self, selected, cluster_index, clusters_amount):
+        # Unselected customers paired with random selected ones of the same cluster
+        selected_ids = np.flatnonzero(selected)
+        selected_ids = selected_ids[np.argsort(cluster_index[selected_ids], kind='stable')]
+        selected_counts = np.bincount(cluster_index[selected_ids], minlength=clusters_amount)
+        selected_starts = np.concatenate(([0], np.cumsum(selected_counts)[:-1]))
+
+        unselected_ids = np.flatnonzero(~selected)
+        unselected_ids = unselected_ids[selected_counts[cluster_index[unselected_ids]] > 0]
+        if len(unselected_ids) > self.max_candidates:
+            unselected_ids = np.random.choice(unselected_ids, self.max_candidates, replace=False)
+        clusters = cluster_index[unselected_ids]
+        offsets = (np.random.random(len(unselected_ids))*selected_counts[clusters]).astype(np.int64)
+        return unselected_ids, selected_ids[selected_starts[clusters]+offsets]
+
+    def sample(self, fraction):
+        cluster_values, cluster_index = np.unique(self.clusters, return_inverse=True)
+        cluster_counts = np.bincount(cluster_index, minlength=len(cluster_values))
+        selected = self.get_initial_sample(fraction, cluster_index, cluster_counts)
+
+        # Contributions relative to the targets, so every feature has to sum up to 1
+        targets = self.totals*fraction
+        scale = np.divide(1.0, targets, out=np.zeros_like(targets), where=targets > 0)
+        relative = self.counts @ sparse.diags(scale)
+        norms = np.asarray(relative.multiply(relative).sum(axis=1)).ravel()
+        deviation = np.asarray(relative[selected].sum(axis=0)).ravel()-(targets > 0)
+
+        # Swaps are evaluated independently, so only the best part of them is applied at once. The part grows
+        # while it decreases the deviation and shrinks when the swaps overshoot.
+        step = 1
+        for iteration in range(self.max_iterations):
+            if np.abs(deviation).max(initial=0) <= self.tolerance:
+                break
+            added, removed = self.get_candidates(selected, cluster_index, len(cluster_values))
+            if not len(added):
+                break
+
+            # Decrease of squared deviation: -(|x_added - x_removed|^2 + 2*deviation*(x_added - x_removed))
+            dots = relative @ deviation
+            cross = np.asarray(relative[added].multiply(relative[removed]).sum(axis=1)).ravel()
+            gains = -(norms[added]+norms[removed]-2*cross+2*(dots[added]-dots[removed]))
+            improving = np.flatnonzero(gains > 0)
+            if not len(improving):
+                continue
+
+            # Every customer takes part in one swap at most
+            improving = improving[np.argsort(-gains[improving], kind='stable')]
+            _, first_added = np.unique(added[improving], return_index=True)
+            improving = improving[np.sort(first_added)]
+            _, first_removed = np.unique(removed[improving], return_index=True)
+            improving = improving[np.sort(first_removed)]
+
+            while step >= 1:
+                swaps = improving[:step]
+                change = np.asarray(relative[added[swaps]].sum(axis=0) -
+                                    relative[removed[swaps]].sum(axis=0)).ravel()
+                if np.square(deviation+change).sum() < np.square(deviation).sum():
+                    break
+                step //= 2
+            if step < 1:
+                step = 1
+                continue
+
+            selected[added[swaps]] = True
+            selected[removed[swaps]] = False
+            deviation += change
+            step = min(step*2, len(selected))
+
+        return selected
+
+    def get_report(self, selected, fraction):
+        achieved = np.asarray(self.counts[selected].sum(axis=0)).ravel()
+        known = self.totals > 0
+        ratios = np.divide(achieved, self.totals, out=np.zeros_like(achieved), where=known)
+        errors = np.where(known, np.abs(ratios-fraction)/fraction, 0.0) if fraction else np.zeros_like(ratios)
+        return {
+            'customers': int(selected.sum()),
+            'customers_fraction': float(selected.mean()) if len(selected) else 0.0,
+            'events_fraction': float(achieved.sum()/self.totals.sum()) if self.totals.sum() else 0.0,
+            'target_fraction': fraction,
+            'features': {name: float(ratio) for name, ratio, is_known in zip(self.feature_names, ratios, known)
+                         if is_known},
+            'max_error': float(errors.max(initial=0)),
+            'max_error_feature': self.feature_names[int(errors.argmax())] if len(errors) else None,
+        }
+
+    def print_report(self, report):
+        print('Selected %(customers)d customers (%(customers_fraction).3f of all), '
+              'they make %(events_fraction).3f of events (target %(target_fraction).3f)' % report)
+        print('Largest relative deviation from target: %.1f%% (%s)'
+              % (report['max_error']*100, report['max_error_feature']))
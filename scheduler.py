@@ -0,0 +1,142 @@
+import heapq
+import logging
+import time
+
+from actions import AccountAction, Call, Message, Internet
+from status import ServiceStatus
+
+
+class SimulationScheduler:
+    # Discrete-event scheduler: performs actions of all added streams in the order of their start dates.
+    # Every stream must be time-ordered, only its nearest action is kept in the queue.
+    def __init__(self, batch=None):
+        self.queue = []
+        self.sequence = 0  # Keeps FIFO order for the actions with the same start date
+        self.performed = 0
+        self.batch = batch  # Usages are billed by the batch instead of one by one
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add_stream(self, stream):
+        stream = iter(stream)
+        action = next(stream, None)
+        if action is not None:
+            heapq.heappush(self.queue, (action.start_date, self.sequence, action, stream))
+            self.sequence += 1
+
+    def run(self):
+        while self.queue:
+            start_date, sequence, action, stream = heapq.heappop(self.queue)
+            logging.info(action)
+            if self.batch is not None:
+                self.batch.perform(action)
+            else:
+                action.perform()
+            self.performed += 1
+            self.add_stream(stream)
+        if self.batch is not None:
+            self.batch.flush()
+
+
+class UsageBatch:
+    # Usages are logged when they happen and billed together by handle_used_services. Accounts don't affect each
+    # other's billing, so the usages are billed before the next other action of an account that has them.
+    # Out of funds is handled in time order, as without batching, so it draws the same random solutions.
+    USAGE_ACTIONS = (Call, Message, Internet)
+
+    def __init__(self, system):
+        self.system = system
+        self.usages = []
+        self.accounts = set()
+
+    def get_account(self, action):
+        return action.account if isinstance(action, AccountAction) else action.device.account
+
+    def perform(self, action):
+        if isinstance(action, self.USAGE_ACTIONS):
+            service_info = action.to_dict_info()
+            usage = action.device.log_usage(service_info, action.device.get_usage_amount(service_info))
+            self.usages.append((action, usage))
+            self.accounts.add(self.get_account(action))
+        else:
+            if self.get_account(action) in self.accounts:
+                self.flush()
+            action.perform()
+
+    def flush(self):
+        usages, self.usages, self.accounts = self.usages, [], set()
+        rated = list(range(len(usages)))
+        waiting = []  # Out of funds usages which are not handled yet
+        while rated:
+            statuses, deferred = self.system.handle_used_services([usages[i][1] for i in rated])
+            waiting = sorted(waiting + [i for i, status in zip(rated, statuses)
+                                        if status == ServiceStatus.out_of_funds])
+            rated = [rated[k] for k in deferred]
+
+            # Deferred usages can run out of funds too, so only the earlier ones are handled before rating them
+            limit = rated[0] if rated else len(usages)
+            for i in waiting:
+                if i < limit:
+                    usages[i][0].handle_out_of_funds()
+            waiting = [i for i in waiting if i >= limit]
+
+
+class ReplayPacer:
+    # Paces replayed events by the monotonic clock: event happens when as much time passed since the first one
+    # as between their dates, divided by the speedup
+    REPORT_INTERVAL = 10  # Seconds between the progress reports
+
+    def __init__(self, speedup=1.0, report_interval=REPORT_INTERVAL, clock=time.monotonic, sleep=time.sleep):
+        self.speedup = speedup
+        self.report_interval = report_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.first_date = None
+        self.started = None
+        self.last_report = None
+        self.events = 0
+        self.last_offset = 0.0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def get_offset(self, event_date):
+        # Wall clock seconds from the start of replay to the event
+        if self.first_date is None:
+            self.first_date = event_date
+            self.started = self.last_report = self.clock()
+        return (event_date-self.first_date).total_seconds()/self.speedup
+
+    def get_delay(self, event_date):
+        offset = self.get_offset(event_date)
+        return self.started+offset-self.clock()
+
+    def wait(self, event_date):
+        delay = self.get_delay(event_date)
+        if delay > 0:
+            self.sleep(delay)
+
+    def emitted(self, event_date, count=1):
+        # Lag is how late the events were emitted comparing to their schedule
+        self.events += count
+        self.last_offset = self.get_offset(event_date)
+        self.lag = max(0.0, self.clock()-self.started-self.last_offset)
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.clock()-self.last_report >= self.report_interval:
+            self.report()
+
+    def get_stats(self):
+        elapsed = self.clock()-self.started if self.started is not None else 0.0
+        return {
+            'events': self.events,
+            'elapsed': elapsed,
+            'achieved_rate': self.events/elapsed if elapsed else 0.0,
+            'target_rate': self.events/self.last_offset if self.last_offset else 0.0,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+        }
+
+    def report(self):
+        self.last_report = self.clock()
+        print('Replayed %(events)d events in %(elapsed).1f s: %(achieved_rate).1f events/s '
+              '(target %(target_rate).1f), lag %(lag).3f s (max %(max_lag).3f s)' % self.get_stats())
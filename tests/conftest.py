@@ -0,0 +1,28 @@
+from datetime import date, timedelta
+import os
+import sys
+
+import pytest
+
+# Modules are imported from the root of the repository and read their data files relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from base import Base
+from distribution import seed_random
+from operator_simulation import MobileOperatorSimulator
+
+PERIOD_START = date(2016, 5, 1)
+PERIOD_END = date(2016, 5, 1)
+
+
+@pytest.fixture(scope='session')
+def simulator():
+    # Main base with one simulated day, it's shared by tests, so they don't change it
+    seed_random(1)
+    simulator = MobileOperatorSimulator(Base.metadata)
+    simulator.generate_static_data()
+    simulator.generate_customers(PERIOD_START-timedelta(days=1))
+    simulator.simulate_period(PERIOD_START, PERIOD_END)
+    return simulator
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import sqlalchemy as db
+from sqlalchemy import and_, or_, between
+
+from analyzer import ActivityAnalyzer, get_algorithms_grid
+from entities.analysis import Analysis, ClusterAssignment
+from entities.customer import Device
+from entities.location import Location
+from entities.service import DeviceService, Request, Service, ServiceLog
+from conftest import PERIOD_START, PERIOD_END
+
+
+def get_device_features(device, date_begin, date_end, db_session):
+    # Features of one device as they were extracted by queries for every device
+    features = {'type=%s' % device.type: 1, 'tariff=%s' % device.tariff.name: 1,
+                'location_changes': db_session.query(Location).filter(
+                    Location.device_id == device.id, between(Location.date_from, date_begin, date_end)).count()}
+    requests = db_session.query(Service.name, db.func.count(Request.id)).\
+        join(Request, and_(Request.service_id == Service.id, Request.device_id == device.id,
+                           between(Request.date_from, date_begin, date_end))).\
+        group_by(Service.name)
+    for service_name, request_count in requests:
+        name = 'balance_checks' if service_name == 'Balance request' else 'other_requests'
+        features[name] = features.get(name, 0) + request_count
+
+    connected_services = db_session.query(DeviceService).\
+        filter(DeviceService.device_id == device.id,
+               or_(DeviceService.date_to.is_(None), DeviceService.date_to >= date_begin))
+    for device_service in connected_services:
+        total_usage, usage_amount = db_session.query(db.func.count(ServiceLog.id), db.func.sum(ServiceLog.amount)).\
+            filter(ServiceLog.device_service_id == device_service.id, ServiceLog.action_type == 'usage',
+                   between(ServiceLog.date_from, date_begin, date_end)).one()
+        usage_amount = usage_amount or 0
+        name = device_service.service.name
+        if name == 'outgoing_call':
+            features['calls'] = total_usage
+            features['avg_call_duration'] = usage_amount/total_usage if total_usage else 0
+        elif name in ('sms', 'mms'):
+            features[name] = total_usage
+        elif name == 'internet':
+            features['internet_sessions_count'] = usage_amount
+            features['internet_usage'] = total_usage*usage_amount
+        else:
+            features['other_usages'] = features.get('other_usages', 0) + total_usage
+    return features
+
+
+def test_grouped_device_features_match_device_queries(simulator):
+    analyzer = ActivityAnalyzer(simulator.main_session, None)
+    db_session = simulator.main_session
+    features, feature_names, _, device_ids = analyzer.get_devices_info(PERIOD_START, PERIOD_END, db_session)
+
+    date_begin = datetime.combine(PERIOD_START, datetime.min.time())
+    date_end = datetime.combine(PERIOD_END, datetime.max.time().replace(microsecond=0))
+    devices = db_session.query(Device).order_by(Device.id).all()
+    assert device_ids == [device.id for device in devices]
+    for row, device in zip(features, devices):
+        device_features = get_device_features(device, date_begin, date_end, db_session)
+        expected = [device_features.get(name, 0) for name in feature_names]
+        assert np.allclose(row, expected), device.id
+
+
+def test_grouped_device_features_sum_services_with_same_name(simulator):
+    # Usages of a reconnected service are added to the ones of the previous connection
+    analyzer = ActivityAnalyzer(simulator.main_session, None)
+    db_session = simulator.main_session
+    previous = db_session.query(DeviceService).join(Service, DeviceService.service_id == Service.id).\
+        filter(Service.name == 'outgoing_call').order_by(DeviceService.device_id).first()
+    call_time = datetime.combine(PERIOD_START, datetime.min.time()) + timedelta(hours=12)
+    row = [device.id for device in db_session.query(Device).order_by(Device.id)].index(previous.device_id)
+    try:
+        reconnected = DeviceService(device_id=previous.device_id, service_id=previous.service_id)
+        db_session.add(reconnected)
+        db_session.flush()
+        features, feature_names, _, _ = analyzer.get_devices_info(PERIOD_START, PERIOD_END, db_session)
+        calls_before, duration_before = features[row, feature_names.index('calls')], \
+            features[row, feature_names.index('avg_call_duration')]*features[row, feature_names.index('calls')]
+
+        db_session.add_all([ServiceLog(device_service_id=previous.id, date_from=call_time, amount=60),
+                            ServiceLog(device_service_id=reconnected.id, date_from=call_time, amount=120)])
+        db_session.flush()
+        features, _, _, _ = analyzer.get_devices_info(PERIOD_START, PERIOD_END, db_session)
+        calls = features[row, feature_names.index('calls')]
+        assert calls == calls_before + 2
+        assert np.isclose(features[row, feature_names.index('avg_call_duration')], (duration_before+180)/calls)
+    finally:
+        db_session.rollback()
+
+
+def test_sweep_fits_configurations(simulator):
+    analyzer = ActivityAnalyzer(simulator.main_session, None)
+    algorithms = get_algorithms_grid(['K-Means', 'BIRCH'], clusters=(None, 3))
+    results = analyzer.sweep(PERIOD_START, PERIOD_END, 'main', algorithms)
+
+    assert [result[0] for result in results] == [algorithm.describe() for algorithm in algorithms]
+    for description, levels_metrics, _, error in results:
+        assert error is None, description
+        assert set(levels_metrics) == {'device', 'account', 'customer'}
+
+
+def test_saved_analysis_replaces_only_same_one(simulator):
+    analyzer = ActivityAnalyzer(simulator.main_session, None)
+    analyzer.headless = True
+    db_session = simulator.main_session
+    k_means, birch = get_algorithms_grid(['K-Means', 'BIRCH'])
+    try:
+        analyzer.analyze(PERIOD_START, PERIOD_END, 'main', k_means)
+        analyzer.analyze(PERIOD_START, PERIOD_END, 'main', birch)
+        first_ids = {row.algorithm: row.id for row in db_session.query(Analysis)}
+        assert set(first_ids) == {'K-Means', 'BIRCH'}
+
+        # Extending K-Means analysis keeps BIRCH one with its assignments
+        analyzer.analyze(PERIOD_START, PERIOD_END, 'main', k_means)
+        ids = {row.algorithm: row.id for row in db_session.query(Analysis)}
+        assert ids['BIRCH'] == first_ids['BIRCH'] and ids['K-Means'] != first_ids['K-Means']
+        assert {row.analysis_id for row in db_session.query(ClusterAssignment.analysis_id).distinct()} == \
+            set(ids.values())
+    finally:
+        # Nothing is committed by the analysis, so the shared base is left intact
+        db_session.rollback()
+    assert db_session.query(Analysis).count() == 0
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from sqlalchemy import select
+
+from actions import DeviceAction
+from base import Base
+from distribution import seed_random
+from entities.payment import Balance, Bill, Payment
+from entities.service import DeviceService, ServiceLog
+from operator_simulation import MobileOperatorSimulator
+from conftest import PERIOD_START
+
+PERIOD_END = PERIOD_START+timedelta(days=2)
+
+
+def simulate(batch_billing, monkeypatch):
+    # Same seed, so both simulators generate the same customers and actions
+    seed_random(2)
+    simulator = MobileOperatorSimulator(Base.metadata)
+    simulator.batch_billing = batch_billing
+    simulator.generate_static_data()
+    simulator.generate_customers(PERIOD_START-timedelta(days=1))
+
+    out_of_funds = []
+    handle_out_of_funds = DeviceAction.handle_out_of_funds
+
+    def record_out_of_funds(action):
+        out_of_funds.append((action.start_date, type(action).__name__, action.device.device.id))
+        handle_out_of_funds(action)
+
+    with monkeypatch.context() as context:
+        context.setattr(DeviceAction, 'handle_out_of_funds', record_out_of_funds)
+        simulator.simulate_period(PERIOD_START, PERIOD_END)
+    return simulator, out_of_funds
+
+
+def get_billing_state(session):
+    # Ids of logs, bills and payments depend on the order they were written in, so they are compared by contents
+    usages = session.execute(select([ServiceLog.device_service_id, ServiceLog.date_from, ServiceLog.action_type,
+                                     ServiceLog.amount, ServiceLog.is_free, ServiceLog.recipient_phone_number_id,
+                                     Bill.date_from, Bill.paid, Bill.debt]).
+                             select_from(ServiceLog.__table__.outerjoin(Bill.__table__,
+                                                                        Bill.service_log_id == ServiceLog.id)))
+    payments = session.execute(select([Payment.date, Payment.amount, Payment.method_id, Payment.balance_id]))
+    return {
+        'usages': sorted(map(repr, usages)),
+        'payments': sorted(map(repr, payments)),
+        'balances': session.query(Balance.id, Balance.amount).order_by(Balance.id).all(),
+        'packets': session.query(DeviceService.id, DeviceService.packet_left).order_by(DeviceService.id).all(),
+    }
+
+
+def test_batch_billing_matches_billing_by_event(monkeypatch):
+    by_event, by_event_out_of_funds = simulate(False, monkeypatch)
+    batch, batch_out_of_funds = simulate(True, monkeypatch)
+
+    state = get_billing_state(by_event.main_session)
+    assert len(state['usages']) > 1000
+    assert by_event_out_of_funds
+    assert get_billing_state(batch.main_session) == state
+    assert batch_out_of_funds == by_event_out_of_funds
@@ -0,0 +1,72 @@
+from itertools import product
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+
+from base import Base
+from catalog import PricingMatrix
+from entities.payment import Cost
+
+# (service, operator from, operator to): exact costs, costs without recipient, single and several recipient costs,
+# a cost without recipient next to recipient ones and duplicates of the same exact cost
+COSTS = [(1, 1, 2), (1, 1, 3), (1, 1, None), (1, 2, None), (2, 1, 3), (2, 2, 1), (2, 2, 3), (3, 1, 2), (3, 1, 2),
+         (3, 2, None), (3, 2, None)]
+SERVICES = [1, 2, 3, 4]
+OPERATORS = [1, 2, 3, 4]
+
+
+def query_cost(session, operator_from_id, service_id, operator_to_id=None):
+    # Lookup of handle_used_service before the pricing matrix
+    if operator_to_id is not None:
+        try:
+            return session.query(Cost).filter(Cost.operator_from_id == operator_from_id,
+                                              Cost.operator_to_id == operator_to_id,
+                                              Cost.service_id == service_id).one()
+        except NoResultFound:
+            pass
+    return session.query(Cost).filter(Cost.operator_from_id == operator_from_id, Cost.service_id == service_id).one()
+
+
+def resolve(get_cost, *args):
+    try:
+        return get_cost(*args).id
+    except NoResultFound:
+        return 'none'
+    except MultipleResultsFound:
+        return 'multiple'
+
+
+@pytest.fixture
+def costs_session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine, tables=[Cost.__table__])
+    session = sessionmaker(bind=engine)()
+    session.add_all([Cost(service_id=service_id, operator_from_id=operator_from_id, operator_to_id=operator_to_id,
+                          use_cost=1) for service_id, operator_from_id, operator_to_id in COSTS])
+    session.commit()
+    return session
+
+
+def test_pricing_matrix_resolves_costs_as_queries(costs_session):
+    pricing = PricingMatrix(costs_session.query(Cost).order_by(Cost.id))
+    for service_id, operator_from_id, operator_to_id in product(SERVICES, OPERATORS, OPERATORS+[None]):
+        args = (operator_from_id, service_id, operator_to_id)
+        assert resolve(pricing.get_cost, *args) == resolve(lambda *key: query_cost(costs_session, *key), *args), args
+
+
+def test_cost_indexes_match_single_lookups(costs_session):
+    pricing = PricingMatrix(costs_session.query(Cost).order_by(Cost.id))
+    keys = np.array(list(product(OPERATORS, SERVICES, OPERATORS+[-1])))
+    cost_indexes = pricing.get_cost_indexes(keys[:, 0], keys[:, 1], keys[:, 2])
+    for (operator_from_id, service_id, operator_to_id), cost_index in zip(keys.tolist(), cost_indexes):
+        expected = resolve(pricing.get_cost, operator_from_id, service_id,
+                           operator_to_id if operator_to_id >= 0 else None)
+        if cost_index == PricingMatrix.NO_COST:
+            assert expected == 'none'
+        elif cost_index == PricingMatrix.MULTIPLE_COSTS:
+            assert expected == 'multiple'
+        else:
+            assert pricing.costs[cost_index].id == expected
@@ -0,0 +1,42 @@
+import numpy as np
+
+from distribution import Distribution, seed_random
+
+PROBABILITIES = [0.1, 0.25, 0, 0.4, 0.25]
+
+
+def get_distribution():
+    return Distribution({'max_values': len(PROBABILITIES), 'values': ['a', 'b', 'c', 'd', 'e'],
+                         'probabilities': PROBABILITIES})
+
+
+def test_indices_follow_probabilities():
+    seed_random(7)
+    distribution = get_distribution()
+    indices = distribution.get_indices(200000)
+    frequencies = np.bincount(indices, minlength=len(PROBABILITIES))/len(indices)
+    assert np.allclose(frequencies, PROBABILITIES, atol=0.01)
+    assert frequencies[2] == 0
+
+
+def test_scalar_draws_follow_probabilities():
+    # Actions draw one value at a time
+    seed_random(8)
+    distribution = get_distribution()
+    draws = 50000
+    indices = [distribution.get_index() for _ in range(draws)]
+    frequencies = np.bincount(indices, minlength=len(PROBABILITIES))/draws
+    assert np.allclose(frequencies, PROBABILITIES, atol=0.015)
+
+    values = [distribution.get_value(return_array=False) for _ in range(draws)]
+    assert all(isinstance(value, str) for value in values)
+    value_frequencies = [values.count(value)/draws for value in distribution.values]
+    assert np.allclose(value_frequencies, PROBABILITIES, atol=0.015)
+
+
+def test_probabilities_are_padded_and_normalized():
+    distribution = Distribution({'max_values': 4, 'probabilities': [2, 2]})
+    assert distribution.values == [1, 2, 3, 4]
+    assert np.allclose(distribution.p, [0.5, 0.5, 0, 0])
+    seed_random(9)
+    assert set(distribution.get_value(n=1000).tolist()) == {1, 2}
@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from distribution import seed_random
+from generator import DeviceActivityGenerator, EPOCH
+
+PERIOD_DURATION = DeviceActivityGenerator.PERIOD_DURATION
+# Window of two periods, every device has one whole tariff period in it and parts of two others
+WINDOW_START = date(2016, 5, 1)
+WINDOW_END = WINDOW_START+timedelta(days=2*PERIOD_DURATION-1)
+
+
+def get_generator(simulator):
+    devices = [device for customer in simulator.customers for account in customer.accounts
+               for device in account.devices]
+    cluster_id = devices[0].behavior_info['cluster_id']
+    cluster_devices = [device for device in devices if device.behavior_info['cluster_id'] == cluster_id]
+    # Tariff periods of devices start on different days before the window
+    period_starts = [WINDOW_START-timedelta(days=i % PERIOD_DURATION) for i in range(len(cluster_devices))]
+    return DeviceActivityGenerator(cluster_devices, period_starts), period_starts
+
+
+def get_bounds(gen, activity_name):
+    period_activity = gen.activity_info[activity_name]['period_activity']
+    return (max(0, period_activity['amount']-period_activity['max_deviation']),
+            period_activity['amount']+period_activity['max_deviation'])
+
+
+def test_period_totals_are_within_deviation(simulator):
+    seed_random(4)
+    gen, _ = get_generator(simulator)
+    for activity_name in ('Call', 'SMS', 'MMS', 'Internet', 'Traveling'):
+        lower_boundary, higher_boundary = get_bounds(gen, activity_name)
+        for period in range(3):
+            devices, _ = gen.get_period_days(activity_name, period)
+            totals = np.bincount(devices, minlength=len(gen.sim_devices))
+            assert totals.min() >= lower_boundary
+            assert totals.max() <= higher_boundary
+
+
+def test_usage_days_map_to_dates_of_tariff_periods(simulator):
+    seed_random(5)
+    gen, period_starts = get_generator(simulator)
+    devices, timestamps = gen.get_period_usages('Call', WINDOW_START, WINDOW_END)
+    dates = [(EPOCH+timedelta(seconds=int(timestamp))).date() for timestamp in timestamps]
+    assert all(WINDOW_START <= usage_date <= WINDOW_END for usage_date in dates)
+
+    usages = {}
+    for device, usage_date in zip(devices, dates):
+        period, day = divmod((usage_date-period_starts[device]).days, PERIOD_DURATION)
+        usages.setdefault((int(device), period), []).append(day+1)
+
+    for period in range(3):
+        period_devices, usage_days = gen.get_period_days('Call', period)
+        for device in range(len(gen.sim_devices)):
+            drawn_days = sorted(usage_days[period_devices == device])
+            period_start = period_starts[device]+timedelta(days=period*PERIOD_DURATION)
+            # Only the days of the period inside the window are used
+            expected_days = [day for day in drawn_days
+                             if WINDOW_START <= period_start+timedelta(days=int(day)-1) <= WINDOW_END]
+            assert sorted(usages.get((device, period), [])) == expected_days
+
+
+def test_calls_of_device_do_not_overlap(simulator):
+    seed_random(6)
+    gen, _ = get_generator(simulator)
+    calls = gen.generate_calls(WINDOW_START, WINDOW_END)
+    assert len(calls)
+
+    seconds_in_day = DeviceActivityGenerator.SECONDS_IN_DAY
+    same_day = (calls['device'][1:] == calls['device'][:-1]) & \
+        (calls['timestamp'][1:] // seconds_in_day == calls['timestamp'][:-1] // seconds_in_day)
+    gaps = (calls['timestamp'][1:]-calls['timestamp'][:-1])[same_day]
+    durations = calls['duration'][:-1][same_day]
+    # Calls that can't fit get the fail safe duration of one second
+    assert ((durations < gaps) | (durations == 1)).all()
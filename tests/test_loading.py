@@ -0,0 +1,76 @@
+import hashlib
+
+from sqlalchemy import event, select
+
+from base import Base
+from entities.customer import Customer
+from entities.location import Country
+from conftest import PERIOD_START, PERIOD_END
+
+
+def dump_test_base(simulator):
+    # Amount and checksum of the rows of every table
+    tables = {}
+    for table in Base.metadata.sorted_tables:
+        rows = sorted(repr(tuple(row)) for row in simulator.test_session.execute(select([table])))
+        tables[table.name] = (len(rows), hashlib.md5(''.join(rows).encode()).hexdigest())
+    return tables
+
+
+def export_load(simulator, directory):
+    customer_ids = [customer_id for customer_id, in simulator.main_session.query(Customer.id)]
+    simulator.customer_clusters = {0: customer_ids}
+    simulator.export_test_load(PERIOD_START, PERIOD_END, 0.5, directory)
+
+
+def test_export_is_replayed_many_times(simulator, tmp_path):
+    export_load(simulator, str(tmp_path))
+
+    simulator.replay_test_load(str(tmp_path))
+    replayed = dump_test_base(simulator)
+    assert replayed['serviceLog'][0] > 0
+
+    simulator.replay_test_load(str(tmp_path))
+    assert dump_test_base(simulator) == replayed
+
+
+def test_export_is_replayed_after_copied_load(simulator, tmp_path):
+    export_load(simulator, str(tmp_path))
+    simulator.replay_test_load(str(tmp_path))
+    replayed = dump_test_base(simulator)
+
+    simulator.generate_test_load(PERIOD_START, PERIOD_END, 0.5)
+    simulator.replay_test_load(str(tmp_path))
+    assert dump_test_base(simulator) == replayed
+
+
+def test_static_sync_rewrites_only_changed_rows(simulator):
+    loader = simulator.load_simulator
+    loader.sync_static_data()
+    country = Country.__table__
+    connection = simulator.test_session.connection()
+    changed_id, deleted_id, added_id = 1, 2, connection.execute(select([country.c.id]).
+                                                              order_by(country.c.id.desc())).scalar()+1
+    connection.execute(country.update().where(country.c.id == changed_id).values(name='Changed'))
+    connection.execute(country.delete().where(country.c.id == deleted_id))
+    connection.execute(country.insert(), {'id': added_id, 'name': 'Added'})
+
+    # Keys of the rows written by every statement of the sync
+    written = []
+
+    def record(conn, clauseelement, multiparams, params):
+        if getattr(clauseelement, 'table', None) is not None:
+            rows = multiparams[0] if multiparams and isinstance(multiparams[0], list) else list(multiparams)
+            written.append((clauseelement.__visit_name__, clauseelement.table.name,
+                            sorted(row.get('id', row.get('_id')) for row in rows)))
+
+    event.listen(simulator.test_engine, 'before_execute', record)
+    try:
+        loader.sync_static_data()
+    finally:
+        event.remove(simulator.test_engine, 'before_execute', record)
+
+    assert sorted(written) == [('delete', 'country', [added_id]), ('insert', 'country', [deleted_id]),
+                               ('update', 'country', [changed_id])]
+    main_rows = simulator.main_session.execute(select([country]).order_by(country.c.id)).fetchall()
+    assert connection.execute(select([country]).order_by(country.c.id)).fetchall() == main_rows
@@ -0,0 +1,58 @@
+import copy
+
+from sqlalchemy import func
+
+import operator_simulation
+from base import Base
+from distribution import seed_random
+from entities.operator import PhoneNumber
+from entities.payment import Balance, Bill
+from entities.service import ServiceLog
+from operator_simulation import MobileOperatorSimulator
+from parallel import get_entities_tables, id_tables, WRITTEN_ENTITIES
+from conftest import PERIOD_START, PERIOD_END
+
+
+def test_shards_are_merged_into_consistent_base(monkeypatch):
+    seed_random(3)
+    simulator = MobileOperatorSimulator(Base.metadata)
+    simulator.generate_static_data()
+    simulator.generate_customers(PERIOD_START)
+    session = simulator.main_session
+    bills_count = session.query(Bill).count()
+    logs_count = session.query(ServiceLog).count()
+
+    # Changes are recorded before merging, it rewrites them
+    shard_changes = []
+    merge_changes = operator_simulation.merge_changes
+
+    def record_changes(engine, changes):
+        shard_changes.append(copy.deepcopy(changes))
+        merge_changes(engine, changes)
+
+    monkeypatch.setattr(operator_simulation, 'merge_changes', record_changes)
+    simulator.simulate_period(PERIOD_START, PERIOD_END, workers=2)
+    assert len(shard_changes) == 2
+
+    # Shards take ids from disjoint blocks
+    for table in id_tables(get_entities_tables(WRITTEN_ENTITIES)):
+        shard_ids = [{row['id'] for row in new_rows.get(table.name, [])} for new_rows, _ in shard_changes]
+        assert not shard_ids[0] & shard_ids[1]
+
+    duplicates = session.query(PhoneNumber.area_code, PhoneNumber.number).\
+        group_by(PhoneNumber.area_code, PhoneNumber.number).having(func.count() > 1).all()
+    assert duplicates == []
+
+    new_bills = sum(len(new_rows.get('bill', [])) for new_rows, _ in shard_changes)
+    new_logs = sum(len(new_rows.get('serviceLog', [])) for new_rows, _ in shard_changes)
+    assert new_bills > 0
+    assert session.query(Bill).count() == bills_count+new_bills
+    assert session.query(ServiceLog).count() == logs_count+new_logs
+
+    # Every shard changes only the balances of its own customers
+    shard_balances = [{row['id']: row['amount'] for row in changed_rows.get('balance', [])}
+                      for _, changed_rows in shard_changes]
+    assert not set(shard_balances[0]) & set(shard_balances[1])
+    for balances in shard_balances:
+        for balance_id, amount in balances.items():
+            assert session.query(Balance.amount).filter(Balance.id == balance_id).scalar() == amount
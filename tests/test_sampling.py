@@ -0,0 +1,37 @@
+import numpy as np
+
+from distribution import seed_random
+from sampling import ActivitySampler, get_cluster_sizes
+
+
+def get_counts(customers, features, clusters_amount):
+    # Poisson counts of events with rates of the customer's cluster, some customers are much more active
+    clusters = np.random.randint(clusters_amount, size=customers)
+    rates = np.random.uniform(0.5, 5, size=(clusters_amount, features))
+    activity = np.random.lognormal(0, 0.5, size=customers)
+    return np.random.poisson(rates[clusters]*activity[:, None]), clusters
+
+
+def test_cluster_sizes_round_largest_remainders():
+    # Small clusters get one customer above their quota
+    assert get_cluster_sizes(np.array([1, 3, 10, 0, 86]), 0.1).tolist() == [1, 1, 1, 0, 9]
+    assert get_cluster_sizes(np.array([15, 25, 60]), 0.1).tolist() == [2, 2, 6]
+    assert get_cluster_sizes(np.array([2, 5]), 1.0).tolist() == [2, 5]
+
+
+def test_sample_respects_cluster_sizes_and_tolerance():
+    seed_random(5)
+    counts, clusters = get_counts(2000, 24*3, 4)
+    feature_names = ['feature_%d' % i for i in range(counts.shape[1])]
+    sampler = ActivitySampler(counts, feature_names, clusters)
+    fraction = 0.1
+
+    selected = sampler.sample(fraction)
+    cluster_values, cluster_index = np.unique(clusters, return_inverse=True)
+    cluster_counts = np.bincount(cluster_index)
+    assert np.array_equal(np.bincount(cluster_index[selected], minlength=len(cluster_values)),
+                          get_cluster_sizes(cluster_counts, fraction))
+
+    report = sampler.get_report(selected, fraction)
+    assert report['customers'] == selected.sum()
+    assert report['max_error'] <= sampler.tolerance
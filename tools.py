@@ -36,3 +36,48 @@ def distribution_from_list(records_info):
     }
 
     return Distribution(info=dist_info)
+
+
+class DistributionRegistry:
+    # Builds every named distribution once and shares it between all generators
+    def __init__(self, distributions_info, out_of_funds_info):
+        self.distributions_info = distributions_info
+        self.out_of_funds_info = out_of_funds_info
+        self.cache = {}
+        self.out_of_funds_table = None
+
+    def cached(self, key, builder):
+        if key not in self.cache:
+            distribution = builder()
+            distribution.freeze()
+            self.cache[key] = distribution
+        return self.cache[key]
+
+    def get(self, kind, name):
+        return self.cached((kind, name),
+                           lambda: Distribution(info=self.distributions_info[kind][name]))
+
+    def get_from_list(self, kind, name):
+        return self.cached((kind, name),
+                           lambda: distribution_from_list(self.distributions_info[kind][name]))
+
+    def get_regions(self, locations_name, country_name):
+        for country_info in self.distributions_info['location'][locations_name]:
+            if country_info['name'] == country_name and 'regions' in country_info:
+                return self.cached(('location', locations_name, country_name),
+                                   lambda: distribution_from_list(country_info['regions']))
+        return None
+
+    def get_out_of_funds(self):
+        if self.out_of_funds_table is None:
+            table = {}
+            for category_num in self.out_of_funds_info['trust_category']:
+                category = int(category_num)
+                category_activity = self.out_of_funds_info['trust_category'][category_num]
+                table[category] = {}
+                for action_name in category_activity:
+                    actions_info = category_activity[action_name]['actions']
+                    table[category][action_name] = self.cached(('out_of_funds', category, action_name),
+                                                               lambda: distribution_from_list(actions_info))
+            self.out_of_funds_table = table
+        return self.out_of_funds_table
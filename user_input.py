@@ -1,5 +1,5 @@
 from datetime import date
-from analyzer import ClusteringAlgorithm
+from analyzer import ClusteringAlgorithm, get_algorithms_grid
 
 
 def input_to_date(user_input):
@@ -70,3 +70,28 @@ def get_clustering_algorithm():
         else:
             print('Incorrect algorithm')
             continue
+
+
+def input_to_list(user_input, value_type, default):
+    if not user_input:
+        return default
+    return [value_type(value) for value in user_input.split(',')]
+
+
+def get_sweep_algorithms():
+    while True:
+        try:
+            algorithms = input_to_list(input('Enter clustering algorithms separated by commas '
+                                             '(default - K-Means, DBSCAN, BIRCH): '),
+                                       str.strip, ['K-Means', 'DBSCAN', 'BIRCH'])
+            clusters = input_to_list(input('Enter numbers of device clusters for K-Means and BIRCH '
+                                           '(default - number of original clusters): '), int, [None])
+            eps = input_to_list(input('Enter epsilons for DBSCAN (default - 0.1, 0.3, 0.5, 1.0): '),
+                                float, [0.1, 0.3, 0.5, 1.0])
+            thresholds = input_to_list(input('Enter thresholds for BIRCH (default - 0.5): '), float, [0.5])
+            branchings = input_to_list(input('Enter branching factors for BIRCH (default - 50): '), int, [50])
+            return get_algorithms_grid(algorithms, clusters, eps, thresholds, branchings)
+        except ValueError:
+            print('Incorrect value')
+        except NotImplementedError:
+            print('Incorrect algorithm')
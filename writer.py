@@ -0,0 +1,91 @@
+from sqlalchemy import bindparam
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from base import Base
+
+
+def group_by_columns(rows):
+    # executemany needs the same set of columns in every row
+    groups = {}
+    for row in rows:
+        key = tuple(sorted(row))
+        if key not in groups:
+            groups[key] = [row]
+        else:
+            groups[key].append(row)
+    return groups.values()
+
+
+class WriteBuffer:
+    # Write-behind buffer for the rows appended during simulation. Rows are kept as dicts and inserted
+    # with executemany on flush. Ids are given on creation, so rows can reference each other before that.
+    BATCH_SIZE = 50000
+
+    def __init__(self, session, ids, batch_size=BATCH_SIZE):
+        self.session = session
+        self.ids = ids
+        self.batch_size = batch_size
+        self.rows = {}
+        self.updates = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, entity, **values):
+        table = entity.__table__
+        values['id'] = self.ids.reserve(entity)
+        self.rows.setdefault(table, {})[values['id']] = values
+        self.size += 1
+        if self.size >= self.batch_size:
+            self.flush()
+        return values
+
+    def add_many(self, entity, rows):
+        # Ids are given in the order of rows
+        table = entity.__table__
+        table_rows = self.rows.setdefault(table, {})
+        for values in rows:
+            values['id'] = self.ids.reserve(entity)
+            table_rows[values['id']] = values
+        self.size += len(rows)
+        if self.size >= self.batch_size:
+            self.flush()
+        return rows
+
+    def update(self, entity, row_id, **values):
+        # Rows can be already written by the batch flush, so changes must go through here
+        table = entity.__table__
+        row = self.rows.get(table, {}).get(row_id)
+        if row is not None:
+            row.update(values)
+        else:
+            self.updates.setdefault(table, {}).setdefault(row_id, {}).update(values)
+            self.size += 1
+
+            # Mapped instance of the row would not see the change otherwise
+            instance = self.session.identity_map.get(identity_key(entity, row_id))
+            if instance is not None:
+                for name, value in values.items():
+                    set_committed_value(instance, name, value)
+
+    def flush(self):
+        if not self.size:
+            return
+
+        # Mapped rows go first, buffered rows can reference them
+        self.session.flush()
+        connection = self.session.connection()
+        for table in Base.metadata.sorted_tables:
+            rows = self.rows.pop(table, {})
+            for group in group_by_columns(rows.values()):
+                connection.execute(table.insert(), group)
+
+        for table in Base.metadata.sorted_tables:
+            updates = self.updates.pop(table, {})
+            rows = [dict(values, _id=row_id) for row_id, values in updates.items()]
+            for group in group_by_columns(rows):
+                connection.execute(table.update().where(table.c.id == bindparam('_id')), group)
+
+        self.size = 0